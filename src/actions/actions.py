@@ -13,26 +13,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import sys
+import time
 
 # Load modules from $CHARM_DIR/lib
 sys.path.append('lib')
 
-from charms.layer import basic
-basic.bootstrap_charm_deps()
-basic.init_config_states()
+# Only the standard library is imported here, so loading this module is
+# cheap; the modules an action needs are imported when it runs.
+#
+# Actions that neither use the reactive flags nor act on the config, and so
+# don't need the reactive config states set up.
+STATELESS_ACTIONS = ('benchmark', 'rate-limit-stats', 'hook-stats')
+
+
+def start(action_name):
+    """Bootstrap the charm's venv, and set up the reactive config states
+    for the actions that use them."""
+    from charms.layer import basic
+    basic.bootstrap_charm_deps()
+    if action_name not in STATELESS_ACTIONS:
+        basic.init_config_states()
 
-import charms.reactive as reactive
-import charmhelpers.core.hookenv as hookenv
-import charms_openstack.charm
 
-# import the barbican module to get the charm definitions created.
-import charm.openstack.barbican  # noqa
+def charm_instance():
+    """Provide the charm instance, importing charms.openstack and the charm
+    definitions on first use."""
+    import charms_openstack.charm
+    # import the barbican module to get the charm definitions created.
+    import charm.openstack.barbican  # noqa
+    return charms_openstack.charm.provide_charm_instance()
 
 
 def generate_mkek_action(*args):
     """Generate an MKEK in the backend HSM"""
+    import charms.reactive as reactive
+    import charmhelpers.core.hookenv as hookenv
     # try and get the reactive relation instance for hsm:
     # We only do this because there's no @action(<name>) yet that we could
     # access from the reactive file.
@@ -42,12 +60,14 @@ def generate_mkek_action(*args):
             "Can't generate an MKEK in associated HSM because HSM is not "
             "available.")
         return
-    with charms_openstack.charm.provide_charm_instance as barbican_charm:
-        barbican_charm.generate_mkek(hsm)
+    with charm_instance() as barbican_charm:
+        barbican_charm.action_generate_mkek(hsm)
 
 
 def generate_hmac_action(*args):
     """Generate an HMAC in the backend HSM"""
+    import charms.reactive as reactive
+    import charmhelpers.core.hookenv as hookenv
     # try and get the reactive relation instance for hsm:
     # We only do this because there's no @action(<name>) yet that we could
     # access from the reactive file.
@@ -56,8 +76,91 @@ def generate_hmac_action(*args):
         hookenv.action_fail(
             "Can't generate an HMAC in associated HSM because HSM is not "
             "available.")
-    with charms_openstack.charm.provide_charm_instance as barbican_charm:
-        barbican_charm.generate_hmac(hsm)
+        return
+    with charm_instance() as barbican_charm:
+        barbican_charm.action_generate_hmac(hsm)
+
+
+def provision_hsm_keys_action(*args):
+    """Check for, and create, the MKEK and HMAC on every HSM slot"""
+    import charms.reactive as reactive
+    import charmhelpers.core.hookenv as hookenv
+    hsm = reactive.RelationBase.from_state('hsm.available')
+    if hsm is None:
+        hookenv.action_fail(
+            "Can't provision keys in associated HSM because HSM is not "
+            "available.")
+        return
+    with charm_instance() as barbican_charm:
+        results = barbican_charm.provision_hsm_keys(
+            hsm,
+            verify_only=hookenv.action_get('verify-only'),
+            timeout=hookenv.action_get('timeout'))
+    hookenv.action_set({'keys': json.dumps(results, sort_keys=True)})
+    if not results:
+        hookenv.action_fail("No HSM slots are available.")
+        return
+    failed = [r for r in results if r['result'] not in ('present', 'created')]
+    if failed:
+        hookenv.action_fail(
+            "{} of {} keys are not provisioned: {}".format(
+                len(failed), len(results),
+                ', '.join('{} on slot {} ({})'.format(
+                    r['key'], r['slot'], r['result']) for r in failed)))
+
+
+def start_profiling_action(*args):
+    """Serve the API through the profiling pipeline for a bounded window"""
+    import charmhelpers.core.hookenv as hookenv
+    duration = hookenv.action_get('duration')
+    with charm_instance() as barbican_charm:
+        expires = barbican_charm.start_profiling(duration)
+    hookenv.action_set({
+        'expires': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(expires)),
+    })
+
+
+def stop_profiling_action(*args):
+    """Stop profiling the API and summarise the output"""
+    import charmhelpers.core.hookenv as hookenv
+    top = hookenv.action_get('top')
+    with charm_instance() as barbican_charm:
+        archive, summary = barbican_charm.stop_profiling(top)
+    hookenv.action_set({'archive': archive, 'summary': summary})
+
+
+def benchmark_action(*args):
+    """Benchmark the local API and report throughput and latency"""
+    import charmhelpers.core.hookenv as hookenv
+    with charm_instance() as barbican_charm:
+        results = barbican_charm.run_benchmark(
+            hookenv.action_get('workload'),
+            hookenv.action_get('count'),
+            hookenv.action_get('concurrency'))
+    hookenv.action_set({k: v for k, v in results.items() if v is not None})
+
+
+def rate_limit_stats_action(*args):
+    """Report the counters of the API rate limiter"""
+    import charmhelpers.core.hookenv as hookenv
+    import charm.openstack.reports as reports
+    stats = reports.rate_limit_stats()
+    results = {'totals.{}'.format(k): v for k, v in stats['totals'].items()}
+    results['in-flight'] = stats['in-flight']
+    results['projects'] = json.dumps(stats['projects'], sort_keys=True)
+    hookenv.action_set(results)
+
+
+def hook_stats_action(*args):
+    """Summarise the hook timings recorded with hook-timing"""
+    import charmhelpers.core.hookenv as hookenv
+    import charm.openstack.reports as reports
+    stats = reports.hook_stats(hookenv.action_get('top'))
+    hookenv.action_set({
+        'hooks': stats['hooks'],
+        'summary': json.dumps(stats['summary'], sort_keys=True),
+        'slowest': json.dumps(stats['slowest'], sort_keys=True),
+    })
 
 
 # Actions to function mapping, to allow for illegal python action names that
@@ -65,6 +168,12 @@ def generate_hmac_action(*args):
 ACTIONS = {
     "generate-mkek": generate_mkek_action,
     "generate-hmac": generate_hmac_action,
+    "provision-hsm-keys": provision_hsm_keys_action,
+    "start-profiling": start_profiling_action,
+    "stop-profiling": stop_profiling_action,
+    "benchmark": benchmark_action,
+    "rate-limit-stats": rate_limit_stats_action,
+    "hook-stats": hook_stats_action,
 }
 
 
@@ -75,9 +184,11 @@ def main(args):
     except KeyError:
         return "Action %s undefined" % action_name
     else:
+        start(action_name)
         try:
             action(args)
         except Exception as e:
+            import charmhelpers.core.hookenv as hookenv
             hookenv.action_fail(str(e))
 
 
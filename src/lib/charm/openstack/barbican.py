@@ -16,16 +16,43 @@
 # bare functions are provided to the reactive handlers to perform the functions
 # needed on the class.
 
+import base64
+import binascii
 import collections
+import configparser
+import contextlib
+import hashlib
+import json
+import math
+import os
+import re
+import ssl
 import subprocess
+import time
+import urllib.error
+import urllib.request
+
+import psutil
 
 import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.host as ch_host
+import charmhelpers.core.unitdata as unitdata
+import charmhelpers.contrib.hahelpers.cluster as ch_cluster
+import charmhelpers.contrib.openstack.policyd as policyd
+
+import charms.reactive as reactive
 
 import charms_openstack.charm
 import charms_openstack.adapters
 import charms_openstack.ip as os_ip
 import charms_openstack.plugins as ch_plugins
 
+import charm.openstack.benchmark as benchmark
+import charm.openstack.hsm_slots as hsm_slots
+import charm.openstack.profiling as api_profiling
+import charm.openstack.reports as reports
+import charm.openstack.restarts as restarts
+
 PACKAGES = [
     'barbican-common', 'barbican-api', 'barbican-worker',
     'python3-barbican', 'libapache2-mod-wsgi-py3',
@@ -40,8 +67,169 @@ BARBICAN_DIR = '/etc/barbican/'
 BARBICAN_CONF = BARBICAN_DIR + "barbican.conf"
 BARBICAN_API_PASTE_CONF = BARBICAN_DIR + "barbican-api-paste.ini"
 BARBICAN_WSGI_CONF = '/etc/apache2/conf-available/barbican-api.conf'
+# The system python3 that barbican is installed for.  Hooks and actions run
+# in the charm's venv, which doesn't see the system site-packages.
+SYSTEM_PYTHON = '/usr/bin/python3'
+BARBICAN_RETRY_SERVICE = 'barbican-retry'
+BARBICAN_RETRY_UNIT = '/etc/systemd/system/barbican-retry.service'
+# The rate limiting paste filter is rendered from the charm's templates onto
+# the python-path of the API daemons.
+RATELIMIT_PYTHON_PATH = '/usr/share/barbican-charm/python'
+RATELIMIT_MODULE = os.path.join(RATELIMIT_PYTHON_PATH,
+                                'barbican_charm_ratelimit.py')
+
+# The minimal restart actions for a change to each file; BARBICAN_CONF is
+# planned per section through BARBICAN_CONF_SECTION_ACTIONS, with sections
+# not listed there being used by both the API and the worker.
+RESTART_PLAN = {
+    BARBICAN_WSGI_CONF: (restarts.RELOAD_API, ),
+    BARBICAN_API_PASTE_CONF: (restarts.RESTART_API, ),
+    BARBICAN_CONF: (restarts.RESTART_API, restarts.RESTART_WORKER),
+    RATELIMIT_MODULE: (restarts.RESTART_API, ),
+}
+BARBICAN_CONF_SECTION_ACTIONS = {
+    'keystone_authtoken': (restarts.RESTART_API, ),
+    'oslo_middleware': (restarts.RESTART_API, ),
+    'cors': (restarts.RESTART_API, ),
+    'retry_scheduler': (restarts.RESTART_WORKER, ),
+}
 
 OPENSTACK_RELEASE_KEY = 'barbican-charm.openstack-release-version'
+# leader settings recording the last database migration
+DB_REVISION_KEY = 'db-revision'
+DB_MIGRATION_KEY = 'db-migration'
+WSGI_PROCESS_MODEL_KEY = 'barbican-charm.wsgi-process-model'
+RENDER_FINGERPRINT_KEY = 'barbican-charm.render-fingerprint'
+
+# The last full status assessment that left the unit active is cached under
+# STATUS_CACHE_KEY.  update-status reuses it, after a bounded systemctl
+# probe of the services, until the config, the reactive flags or the
+# restart state change or it is STATUS_CACHE_MAX_AGE seconds old.
+STATUS_CACHE_KEY = 'barbican-charm.status-cache'
+STATUS_CACHE_MAX_AGE = 3600
+STATUS_PROBE_TIMEOUT = 10
+
+# The sha256 of the last policyd-override resource processed and, if it was
+# rejected, why.  oslo.policy picks up changes to policy.d by itself, so the
+# overrides are applied without restarting the services.
+POLICYD_STATE_KEY = 'barbican-charm.policyd-override'
+
+# With 'hook-timing' set the wall time of each handler and charm phase run
+# in a hook is recorded, together with the hook's total, in the last
+# HOOK_TIMINGS_MAX hooks kept under reports.HOOK_TIMINGS_KEY.
+HOOK_TIMINGS_MAX = 200
+
+# set by charms.openstack while the API is served over TLS, by apache in front
+# of the API's vhosts, with certificates from the certificates relation
+SSL_ENABLED_FLAG = 'ssl.enabled'
+
+HAPROXY_BALANCE_ALGORITHMS = ('leastconn', 'roundrobin', 'static-rr',
+                              'first', 'source')
+# the timeouts, in ms, haproxy.cfg uses when the haproxy-*-timeout options
+# are unset
+HAPROXY_DEFAULT_TIMEOUTS = {
+    'queue': 9000,
+    'client': 90000,
+    'server': 90000,
+}
+# With wsgi-admin-mode 'shared' the admin vhost is served by the public
+# daemons, so the admin backend gets this share of their capacity and the
+# public backend the rest.
+HAPROXY_SHARED_ADMIN_SHARE = 0.25
+
+# Sizing hints for the 'wsgi-auto-size' mode.  A barbican-api daemon process
+# is roughly WSGI_PROCESS_RSS_MB resident once loaded, and the API daemons are
+# allowed WSGI_MEMORY_FRACTION of the unit's memory.  As the API is mostly
+# waiting on MySQL and the HSM, WSGI_REQUESTS_PER_CPU requests are kept in
+# flight per CPU, spread over at most WSGI_MAX_THREADS threads per process.
+WSGI_PROCESS_RSS_MB = 128
+WSGI_MEMORY_FRACTION = 0.5
+WSGI_REQUESTS_PER_CPU = 4
+WSGI_MAX_THREADS = 16
+# A daemon process counts as having loaded the application, for the
+# 'wsgi-warmup-timeout' wait, once it is WSGI_LOADED_RSS_MB resident and, after
+# a restart, wasn't running before it.  The processes are found by their
+# display-name, '(wsgi:<group>)'.
+WSGI_LOADED_RSS_MB = WSGI_PROCESS_RSS_MB // 2
+WSGI_DISPLAY_NAME_PREFIX = '(wsgi:barbican-api'
+
+# How the admin (9312) vhost is served: by its own daemon group the size of
+# the public one, by the public daemon group, or by its own small group of
+# 'wsgi-admin-processes' processes.
+WSGI_ADMIN_MODES = ('separate', 'shared', 'dedicated')
+
+PKEK_CACHE_KEY = 'barbican-charm.pkek-cache'
+# the last count of the projects with an active KEK, refreshed in update-status
+PKEK_PROJECTS_KEY = 'barbican-charm.pkek-projects'
+# With 'pkek-cache-limit-auto' the project KEK cache holds this many times
+# the number of projects with an active KEK.
+PKEK_CACHE_HEADROOM = 1.25
+# Counts the projects with an active KEK in the database whose URL is read
+# from stdin; run with the system python3 that barbican itself uses.
+PKEK_PROJECT_COUNT_SCRIPT = """
+import sys
+import sqlalchemy
+engine = sqlalchemy.create_engine(sys.stdin.read().strip())
+with engine.connect() as conn:
+    print(conn.execute(sqlalchemy.text(
+        'SELECT COUNT(DISTINCT project_id) FROM kek_data '
+        'WHERE active = 1 AND deleted = 0')).scalar())
+"""
+
+SECRETS_RELATION = 'secrets'
+# leader setting holding the generated KEK of the software secret store
+SOFTWARE_STORE_KEK_KEY = 'simple-crypto-kek'
+SOFTWARE_STORE_KEK_BYTES = 32
+MEMCACHE_RELATION = 'memcache'
+IDENTITY_RELATION = 'identity-service'
+MEMCACHE_DEFAULT_PORT = 11211
+
+# Defaults for the automatically sized oslo.db connection pool
+DB_POOL_TIMEOUT = 30
+DB_CONNECTION_RECYCLE_TIME = 3600
+
+# oslo.messaging tuning for each 'messaging-profile', as {section: settings}.
+# 'default' leaves the oslo.messaging defaults alone.  'high-throughput'
+# keeps more connections and executor threads and lets each consumer
+# prefetch a batch of messages, while 'low-latency' dispatches one message at
+# a time and detects a dead RabbitMQ connection sooner.
+AMQP_RELATION = 'amqp'
+MESSAGING_PROFILES = {
+    'default': {},
+    'high-throughput': {
+        'DEFAULT': {
+            'rpc_conn_pool_size': 100,
+            'executor_thread_pool_size': 128,
+        },
+        'oslo_messaging_rabbit': {
+            'rabbit_qos_prefetch_count': 64,
+            'heartbeat_timeout_threshold': 60,
+        },
+    },
+    'low-latency': {
+        'DEFAULT': {
+            'rpc_conn_pool_size': 30,
+            'executor_thread_pool_size': 64,
+        },
+        'oslo_messaging_rabbit': {
+            'rabbit_qos_prefetch_count': 1,
+            'heartbeat_timeout_threshold': 20,
+            'heartbeat_rate': 4,
+        },
+    },
+}
+# options that override a single profile value: {option: (section, key)}
+MESSAGING_OVERRIDES = {
+    'rpc-conn-pool-size': ('DEFAULT', 'rpc_conn_pool_size'),
+    'executor-thread-pool-size': ('DEFAULT', 'executor_thread_pool_size'),
+    'rabbit-qos-prefetch-count': ('oslo_messaging_rabbit',
+                                  'rabbit_qos_prefetch_count'),
+    'rabbit-heartbeat-timeout-threshold': ('oslo_messaging_rabbit',
+                                           'heartbeat_timeout_threshold'),
+    'rabbit-heartbeat-rate': ('oslo_messaging_rabbit', 'heartbeat_rate'),
+    'rabbit-quorum-queues': ('oslo_messaging_rabbit', 'rabbit_quorum_queue'),
+    'rabbit-stream-fanout': ('oslo_messaging_rabbit', 'rabbit_stream_fanout'),
+}
 
 
 # select the default release function
@@ -50,6 +238,41 @@ OPENSTACK_RELEASE_KEY = 'barbican-charm.openstack-release-version'
 charms_openstack.charm.use_defaults('charm.default-select-release',
                                     'config.changed')
 
+
+# timings of the running hook, see BarbicanCharm.timed()
+_hook_timing = {}
+
+
+def record_hook_timing():
+    """Add the timings of the running hook to the bounded store.  Run when
+    the hook exits."""
+    if not _hook_timing:
+        return
+    timing = dict(_hook_timing)
+    _hook_timing.clear()
+    try:
+        started = psutil.Process().create_time()
+    except psutil.Error:
+        started = timing['start']
+    record = {
+        'hook': timing['hook'],
+        'time': started,
+        'total': round(time.time() - started, 3),
+        'phases': {name: round(seconds, 3)
+                   for name, seconds in timing['phases'].items()},
+    }
+    kv = unitdata.kv()
+    records = kv.get(reports.HOOK_TIMINGS_KEY) or []
+    records = records[-(HOOK_TIMINGS_MAX - 1):] + [record]
+    kv.set(reports.HOOK_TIMINGS_KEY, records)
+
+
+# Registered as the module is loaded, before any handler can register a
+# callback: the callbacks run in reverse order, so this one runs last and
+# includes the status assessment, which charms.openstack runs from a callback.
+hookenv.atexit(record_hook_timing)
+
+
 ###
 # Implementation of the Barbican Charm classes
 
@@ -62,28 +285,31 @@ charms_openstack.charm.use_defaults('charm.default-select-release',
 @charms_openstack.adapters.adapter_property('hsm')
 def library_path(hsm):
     """Provide a library_path property to the template if it exists"""
-    try:
-        return hsm.relation.plugin_data['library_path']
-    except Exception:
-        return ''
+    return hsm_slots.primary(hsm.relation).get('library_path', '')
 
 
 @charms_openstack.adapters.adapter_property('hsm')
 def login(hsm):
     """Provide a login property to the template if it exists"""
-    try:
-        return hsm.relation.plugin_data['login']
-    except Exception:
-        return ''
+    return hsm_slots.primary(hsm.relation).get('login', '')
 
 
 @charms_openstack.adapters.adapter_property('hsm')
 def slot_id(hsm):
     """Provide a slot_id property to the template if it exists"""
-    try:
-        return hsm.relation.plugin_data['slot_id']
-    except Exception:
-        return ''
+    return hsm_slots.primary(hsm.relation).get('slot_id', '')
+
+
+@charms_openstack.adapters.adapter_property('hsm')
+def token_labels(hsm):
+    """Provide the labels of the HSM tokens to fail over between, starting
+    with the primary one, if the HSMs publish token labels"""
+    primary = hsm_slots.primary(hsm.relation)
+    labels = [primary.get('token_label')]
+    labels.extend(slot.get('token_label')
+                  for slot in hsm_slots.plugin_data(hsm.relation))
+    return ', '.join(collections.OrderedDict.fromkeys(
+        label for label in labels if label))
 
 
 @charms_openstack.adapters.adapter_property('secrets')
@@ -98,6 +324,82 @@ def plugins_string(secrets):
     return secrets.relation.plugins_string
 
 
+@charms_openstack.adapters.config_property
+def software_store_kek(config):
+    """Provide the KEK of the software secret store to the template.  Not
+    called 'simple_crypto_kek', which is the name of the option."""
+    return config.charm_instance.software_store_kek()
+
+
+@charms_openstack.adapters.config_property
+def wsgi_daemon(config):
+    """Provide the mod_wsgi daemon process settings to the template"""
+    return config.charm_instance.wsgi_process_model(
+        config.wsgi_worker_context)
+
+
+@charms_openstack.adapters.config_property
+def haproxy_backend(config):
+    """Provide the haproxy backend balance, maxconn and TLS ports to the
+    template"""
+    settings = config.charm_instance.haproxy_backend_settings(
+        config.wsgi_daemon)
+    settings['tls_ports'] = config.charm_instance.haproxy_tls_ports()
+    return settings
+
+
+@charms_openstack.adapters.config_property
+def rate_limit_filter(config):
+    """Provide the API rate limiting filter settings to the templates.  Not
+    called 'rate_limit', which is the name of the option turning it on."""
+    return config.charm_instance.rate_limit_settings(config.wsgi_daemon)
+
+
+@charms_openstack.adapters.config_property
+def database_pool(config):
+    """Provide the oslo.db connection pool settings to the template"""
+    return config.charm_instance.database_pool_settings(config.wsgi_daemon)
+
+
+@charms_openstack.adapters.config_property
+def memcache(config):
+    """Provide the keystonemiddleware token cache settings to the template"""
+    return config.charm_instance.memcache_settings()
+
+
+@charms_openstack.adapters.config_property
+def pkek_cache(config):
+    """Provide the PKCS#11 project KEK settings to the template"""
+    return config.charm_instance.pkek_cache_settings()
+
+
+@charms_openstack.adapters.config_property
+def messaging(config):
+    """Provide the oslo.messaging tuning to the template"""
+    return config.charm_instance.messaging_settings()
+
+
+@charms_openstack.adapters.config_property
+def profiling(config):
+    """Provide the API profiling window and output files to the template"""
+    return {
+        'enabled': api_profiling.is_active(),
+        'log_filename': api_profiling.PROFILE_LOG,
+        'cachegrind_filename': api_profiling.PROFILE_CACHEGRIND,
+    }
+
+
+class BarbicanAdapters(charms_openstack.adapters.OpenStackAPIRelationAdapters):
+    """Adapt the optional read-replica database relation in the same way as
+    the shared-db one, so that it has a uri to render as slave_connection.
+    """
+
+    relation_adapters = {
+        'cluster': charms_openstack.adapters.PeerHARelationAdapter,
+        'shared_db_replica': charms_openstack.adapters.DatabaseRelationAdapter,
+    }
+
+
 class BarbicanCharm(ch_plugins.PolicydOverridePlugin,
                     charms_openstack.charm.HAOpenStackCharm):
     """BarbicanCharm provides the specialisation of the OpenStackCharm
@@ -121,11 +423,14 @@ class BarbicanCharm(ch_plugins.PolicydOverridePlugin,
     }
     service_type = 'barbican'
     default_service = 'barbican-worker'
+    adapters_class = BarbicanAdapters
     services = ['apache2', 'barbican-worker']
 
     # Note that the hsm interface is optional - defined in config.yaml
     required_relations = ['shared-db', 'amqp', 'identity-service']
 
+    # Note that restart_on_change() plans the minimal restarts for these
+    # files with RESTART_PLAN rather than restarting all of the services.
     restart_map = {
         BARBICAN_CONF: services,
         BARBICAN_API_PASTE_CONF: services,
@@ -134,6 +439,201 @@ class BarbicanCharm(ch_plugins.PolicydOverridePlugin,
 
     ha_resources = ['vips', 'haproxy', 'dnsha']
 
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Record the wall time spent in the wrapped block as 'phase' of the
+        running hook when 'hook-timing' is set.  Nested phases are recorded
+        under dotted names, e.g. 'render_stuff.configure_ssl'.
+
+        :param phase: name of the phase
+        """
+        if not hookenv.config('hook-timing'):
+            yield
+            return
+        if not _hook_timing:
+            _hook_timing.update({
+                'hook': hookenv.hook_name(),
+                'start': time.time(),
+                'phases': {},
+                'stack': [],
+            })
+        stack = _hook_timing['stack']
+        stack.append(phase)
+        name = '.'.join(stack)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            phases = _hook_timing['phases']
+            phases[name] = (phases.get(name, 0) +
+                            time.monotonic() - start)
+            stack.pop()
+
+    def _assess_status(self):
+        """Assess the unit's status, taking the cheap path in update-status
+        when nothing has changed since the last assessment left the unit
+        active.
+
+        The full assessment checks the relations, the services and their
+        ports.  In update-status, if the cached assessment still applies,
+        only the services are probed, and the ready message is rebuilt so
+        that the worker counts stay current.
+        """
+        with self.timed('assess_status'):
+            fingerprint = self.status_fingerprint()
+            if hookenv.hook_name() == 'update-status':
+                cached = unitdata.kv().get(STATUS_CACHE_KEY)
+                age = time.time() - cached['time'] if cached else None
+                if (cached and cached['fingerprint'] == fingerprint and
+                        age < STATUS_CACHE_MAX_AGE and
+                        self.services_active()):
+                    state, message = self.custom_assess_status_last_check()
+                    if state is not None:
+                        hookenv.status_set(state, message)
+                        return
+            super(BarbicanCharm, self)._assess_status()
+            state, message = hookenv.status_get()
+            if state == 'active':
+                unitdata.kv().set(STATUS_CACHE_KEY, {
+                    'fingerprint': fingerprint,
+                    'time': time.time(),
+                })
+            else:
+                unitdata.kv().unset(STATUS_CACHE_KEY)
+
+    @staticmethod
+    def status_fingerprint():
+        """Fingerprint the inputs to the status assessment that can change
+        without the services going down: the charm options, the reactive
+        flags (which follow the relations), the pause and restart state and
+        the policyd override state.
+
+        :returns: hex digest string
+        """
+        kv = unitdata.kv()
+        context = {
+            'config': dict(hookenv.config()),
+            'flags': sorted(reactive.get_flags()),
+            'paused': kv.get('unit-paused'),
+            'pending-restart': kv.get(restarts.PENDING_RESTART_KEY),
+            'policyd': kv.get(POLICYD_STATE_KEY),
+        }
+        return hashlib.sha256(
+            json.dumps(context, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+
+    def services_active(self):
+        """Check that all of the charm's services are active with a single,
+        time bounded, systemctl call.
+
+        :returns: boolean
+        """
+        try:
+            subprocess.check_call(
+                ['systemctl', 'is-active', '--quiet'] +
+                list(self.full_service_list),
+                timeout=STATUS_PROBE_TIMEOUT)
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired, OSError):
+            return False
+        return True
+
+    # The policyd overrides are handled by policyd_overrides() rather than
+    # by the PolicydOverridePlugin, so its hook methods are skipped over.
+
+    def install(self):
+        super(ch_plugins.PolicydOverridePlugin, self).install()
+        self.policyd_overrides()
+
+    def upgrade_charm(self):
+        super(ch_plugins.PolicydOverridePlugin, self).upgrade_charm()
+        self.policyd_overrides()
+
+    def config_changed(self):
+        """Time the config-changed handling, including the policyd override
+        handling, when 'hook-timing' is set."""
+        with self.timed('config_changed'):
+            super(ch_plugins.PolicydOverridePlugin, self).config_changed()
+            with self.timed('policyd_overrides'):
+                self.policyd_overrides()
+
+    def policyd_overrides(self):
+        """Apply, or clear, the policyd overrides.
+
+        The resource is only extracted when its hash differs from the last
+        one processed, and only once every file in it has been validated, so
+        that a bad resource leaves the current overrides in place.  Nothing
+        is restarted as oslo.policy re-reads policy.d itself.
+        """
+        if not policyd.is_policyd_override_valid_on_this_release(
+                self.release):
+            return
+        service = self.policyd_service_name
+        kv = unitdata.kv()
+        state = kv.get(POLICYD_STATE_KEY)
+        if not hookenv.config(policyd.POLICYD_CONFIG_NAME):
+            if state or policyd.is_policy_success_file_set():
+                policyd.clean_policyd_dir_for(service)
+                policyd.remove_policy_success_file()
+                kv.unset(POLICYD_STATE_KEY)
+            return
+        resource = policyd.get_policy_resource_filename()
+        digest = ch_host.file_hash(resource, hash_type='sha256')
+        if state and state['hash'] == digest and (
+                state['error'] or policyd.is_policy_success_file_set()):
+            hookenv.log("policyd-override resource unchanged, skipping",
+                        level=hookenv.DEBUG)
+            return
+        error = self.policyd_resource_error(resource)
+        if error is None and not policyd.process_policy_resource_file(
+                resource, service):
+            error = 'failed to install the overrides'
+        if error:
+            hookenv.log("policyd-override resource rejected: {}"
+                        .format(error), level=hookenv.ERROR)
+        kv.set(POLICYD_STATE_KEY, {'hash': digest, 'error': error})
+
+    @staticmethod
+    def policyd_resource_error(resource):
+        """Validate every policy file in the policyd-override resource.
+
+        :param resource: path of the resource zip file, or None
+        :returns: why the resource is unusable, or None if it is good
+        """
+        if not resource:
+            return 'resource not attached'
+        try:
+            with policyd.open_and_filter_yaml_files(resource) as (zfp, gen):
+                for name, ext, filename, zipinfo in gen:
+                    if ext in policyd.POLICYD_TEMPLATE_EXTS:
+                        raise policyd.BadPolicyZipFile(
+                            "{} is a template, which isn't supported"
+                            .format(filename))
+                    with zfp.open(zipinfo) as fp:
+                        policyd.read_and_validate_yaml(fp.read())
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+        return None
+
+    @property
+    def full_service_list(self):
+        """Add the barbican-retry scheduler when it is enabled."""
+        services = super().full_service_list
+        if hookenv.config('enable-retry-scheduler'):
+            services.append(BARBICAN_RETRY_SERVICE)
+        return services
+
+    @property
+    def full_restart_map(self):
+        """Render the barbican-retry systemd unit and the rate limiting
+        filter when they are enabled."""
+        _restart_map = dict(super().full_restart_map)
+        if hookenv.config('enable-retry-scheduler'):
+            _restart_map[BARBICAN_RETRY_UNIT] = [BARBICAN_RETRY_SERVICE]
+        if hookenv.config('rate-limit'):
+            _restart_map[RATELIMIT_MODULE] = ['apache2']
+        return _restart_map
+
     # Package for release version detection
     release_pkg = 'barbican-common'
 
@@ -152,10 +652,16 @@ class BarbicanCharm(ch_plugins.PolicydOverridePlugin,
 
     # This is the command to sync the database
     sync_cmd = ['sudo', '-u', 'barbican', 'barbican-manage', 'db', 'upgrade']
+    # These report the database's current and the code's head alembic
+    # revisions
+    db_current_cmd = ['sudo', '-u', 'barbican', 'barbican-manage', 'db',
+                      'current']
+    db_history_cmd = ['sudo', '-u', 'barbican', 'barbican-manage', 'db',
+                      'history']
 
     # policyd override constants
     policyd_service_name = 'barbican'
-    policyd_restart_on_change = True
+    policyd_restart_on_change = False
 
     def get_amqp_credentials(self):
         """Provide the default amqp username and vhost as a tuple.
@@ -183,59 +689,1126 @@ class BarbicanCharm(ch_plugins.PolicydOverridePlugin,
                 username='barbican', )
         ]
 
+    def db_revisions(self):
+        """Read the current alembic revision of the database and the head
+        revision of the installed code.
+
+        :returns: (current, head), either of which is None if it can't be
+                  determined
+        """
+        def _run(cmd):
+            try:
+                return subprocess.check_output(
+                    cmd, stderr=subprocess.STDOUT, universal_newlines=True)
+            except (subprocess.CalledProcessError, OSError) as e:
+                hookenv.log("Couldn't run {}: {}".format(cmd, e),
+                            level=hookenv.WARNING)
+                return ''
+
+        current = re.search(r'\b([0-9a-f]{12})\b', _run(self.db_current_cmd))
+        head = re.search(r'\b([0-9a-f]{12})\s*\(head\)',
+                         _run(self.db_history_cmd))
+        return (current.group(1) if current else None,
+                head.group(1) if head else None)
+
+    def db_sync(self):
+        """Upgrade the database, unless it is already at the head revision.
+
+        Only the leader migrates the database.  The revisions moved between
+        and the time the migration took are recorded in leader settings.
+
+        :returns: True if a migration was run
+        """
+        if not hookenv.is_leader():
+            return False
+        current, head = self.db_revisions()
+        if current and current == head:
+            hookenv.log("Database already at head revision {}, skipping "
+                        "migration".format(head), level=hookenv.INFO)
+            hookenv.leader_set({'db-sync-done': True,
+                                DB_REVISION_KEY: head})
+            return False
+        start = time.time()
+        subprocess.check_call(self.sync_cmd)
+        duration = time.time() - start
+        revision = self.db_revisions()[0] or head
+        hookenv.log("Migrated database from {} to {} in {:.1f}s"
+                    .format(current, revision, duration),
+                    level=hookenv.INFO)
+        hookenv.leader_set({
+            'db-sync-done': True,
+            DB_REVISION_KEY: revision,
+            DB_MIGRATION_KEY: json.dumps({
+                'from': current,
+                'to': revision,
+                'duration': round(duration, 3),
+                'time': start,
+            }),
+        })
+        return True
+
     def action_generate_mkek(self, hsm):
         """Generate an MKEK on a connected HSM.  Requires that an HSM is
         avaiable via the barbican-hsm-plugin interface, generically known as
-        'hsm'.
+        'hsm'.  The MKEK is generated once, on the primary slot; the other
+        slots are replicas of it.
 
         Uses the barbican-manage command.
 
         :param hsm: instance of BarbicanRequires() class from the
                     barbican-hsm-plugin interface
         """
-        plugin_data = hsm.plugin_data
-        cmd = [
-            'barbican-manage', 'hsm', 'gen_mkek',
-            '--library-path', plugin_data['library_path'],
-            '--passphrase', plugin_data['login'],
-            '--slot-id', plugin_data['slot_id'],
-            '--length', str(hookenv.config('mkek-key-length')),
-            '--label', hookenv.config('label-mkek'),
-        ]
-        try:
-            subprocess.check_call(cmd)
-            hookenv.log("barbican-mangage hsm gen_mkek succeeded")
-        except subprocess.CalledProcessError:
-            str_err = "barbican-manage hsm gen_mkek failed."
-            hookenv.log(str_err)
-            raise Exception(str_err)
+        hsm_slots.generate_key(hsm, 'gen_mkek',
+                               hookenv.config('mkek-key-length'),
+                               hookenv.config('label-mkek'))
 
     def action_generate_hmac(self, hsm):
         """Generate an HMAC on a connected HSM.  Requires that an HSM is
         avaiable via the barbican-hsm-plugin interface, generically known as
-        'hsm'.
+        'hsm'.  The HMAC is generated once, on the primary slot; the other
+        slots are replicas of it.
 
         Uses the barbican-manage command.
 
         :param hsm: instance of BarbicanRequires() class from the
                     barbican-hsm-plugin interface
         """
-        plugin_data = hsm.plugin_data
-        cmd = [
-            'barbican-manage', 'hsm', 'gen_hmac',
-            '--library-path', plugin_data['library_path'],
-            '--passphrase', plugin_data['login'],
-            '--slot-id', plugin_data['slot_id'],
-            '--length', str(hookenv.config('hmac-key-length')),
-            '--label', hookenv.config('label-hmac'),
-        ]
+        hsm_slots.generate_key(hsm, 'gen_hmac',
+                               hookenv.config('hmac-key-length'),
+                               hookenv.config('label-hmac'))
+
+    def provision_hsm_keys(self, hsm, verify_only=False,
+                           timeout=hsm_slots.HSM_PROVISION_TIMEOUT):
+        """Check for, and unless verify_only create, the MKEK and HMAC on
+        the HSM slots; see hsm_slots.provision_keys().
+
+        :param hsm: the hsm relation instance
+        :param verify_only: only check for the keys
+        :param timeout: seconds the whole run may take
+        :returns: list of dicts, one per slot and key
+        """
+        return hsm_slots.provision_keys(hsm, verify_only=verify_only,
+                                        timeout=timeout)
+
+    def render_fingerprint(self, interfaces):
+        """Fingerprint everything that goes into rendering the configuration.
+
+        This covers the charm options, the available relation adapters, the
+        reactive flags, the data on every relation (including the HSM plugin
+        data and the secrets plugins, but not the keys only used to
+        coordinate rolling restarts), the unit's address, the selected
+        OpenStack release, the charm's own templates and code, the last
+        project count used to size the project KEK cache and the software
+        store's KEK, so that a change to any of them produces a different
+        fingerprint.  The flags marking a change in the current hook are left
+        out as they are cleared again at the end of it.
+
+        :param interfaces: the relation interfaces that will be rendered with
+        :returns: hex digest string
+        """
+        relations = {}
+        for relation_name in hookenv.relation_types():
+            for rid in hookenv.relation_ids(relation_name):
+                for unit in hookenv.related_units(rid):
+                    data = hookenv.relation_get(rid=rid, unit=unit) or {}
+                    if relation_name == restarts.CLUSTER_RELATION:
+                        data = {
+                            key: value for key, value in data.items()
+                            if key not in restarts.RESTART_COORDINATION_KEYS}
+                    relations['{}:{}'.format(rid, unit)] = data
+        context = {
+            'config': dict(hookenv.config()),
+            'flags': sorted(
+                flag for flag in reactive.get_flags()
+                if not re.search(r'\.changed(\.|$)', flag)),
+            'interfaces': sorted(
+                str(getattr(i, 'relation_name', None) or
+                    getattr(i, 'endpoint_name', None) or i)
+                for i in interfaces),
+            'relations': relations,
+            'address': hookenv.unit_get('private-address'),
+            'release': self.release,
+            'charm': self._charm_digest(),
+            'profiling': api_profiling.is_active(),
+            'pkek-projects': unitdata.kv().get(PKEK_PROJECTS_KEY),
+            'software-store-kek': self.software_store_kek(),
+        }
+        return hashlib.sha256(
+            json.dumps(context, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+
+    @staticmethod
+    def _charm_digest():
+        """Digest the charm's templates and every module of the
+        charm.openstack package.
+
+        :returns: hex digest string
+        """
+        digest = hashlib.sha256()
+        package = os.path.dirname(os.path.abspath(__file__))
+        paths = [os.path.join(package, f) for f in sorted(os.listdir(package))
+                 if f.endswith('.py')]
+        templates = os.path.join(hookenv.charm_dir(), 'templates')
+        for root, _, files in sorted(os.walk(templates)):
+            paths.extend(os.path.join(root, f) for f in sorted(files))
+        for path in paths:
+            digest.update(path.encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def render_is_current(self, fingerprint):
+        """Check whether the last successful render used the same inputs
+        and its files, including the optional ones in full_restart_map such
+        as the retry scheduler's unit, are still in place.  A render is
+        never current while an OpenStack upgrade waits for a rolling restart
+        slot.
+
+        :param fingerprint: as returned by render_fingerprint()
+        :returns: boolean
+        """
+        if unitdata.kv().get(RENDER_FINGERPRINT_KEY) != fingerprint:
+            return False
+        pending = unitdata.kv().get(restarts.PENDING_RESTART_KEY)
+        if pending and pending['upgrade']:
+            # the upgrade is retried from render_stuff
+            return False
+        return all(os.path.exists(f) for f in self.full_restart_map.keys())
+
+    def record_render(self, fingerprint):
+        """Remember the fingerprint of a successful render.
+
+        :param fingerprint: as returned by render_fingerprint()
+        """
+        unitdata.kv().set(RENDER_FINGERPRINT_KEY, fingerprint)
+
+    @contextlib.contextmanager
+    def restart_on_change(self):
+        """Apply the minimal restart actions for the files that changed
+        while the wrapped block ran.
+
+        Rather than restarting every service in restart_map whenever one of
+        its files changes, the changes are planned with plan_restarts() and
+        then carried out by run_restart_plan().
+        """
+        before = {path: restarts.read_config(path)
+                  for path in self.full_restart_map.keys()}
+        yield
+        changed = {}
+        for path in before:
+            after = restarts.read_config(path)
+            if after != before[path]:
+                changed[path] = (before[path], after)
+        if changed:
+            actions, services = self.plan_restarts(changed)
+            if not actions and not services:
+                return
+            if restarts.rolling_restarts_enabled():
+                restarts.defer(actions, services, sorted(changed))
+            else:
+                self.run_restart_plan(actions, services, sorted(changed))
+
+    def plan_restarts(self, changed):
+        """Work out the minimal restart actions for a set of changed files.
+
+        :param changed: {path: (old_contents, new_contents)}
+        :returns: (actions, services): the restarts.RESTART_ACTIONS to
+                  take, in order, and the services to restart for files that
+                  have no plan
+        """
+        planned = set()
+        services = []
+        for path, (old, new) in changed.items():
+            if path == BARBICAN_CONF:
+                old_sections = restarts.config_sections(old)
+                new_sections = restarts.config_sections(new)
+                for section in set(old_sections) | set(new_sections):
+                    if old_sections.get(section) != new_sections.get(section):
+                        planned.update(BARBICAN_CONF_SECTION_ACTIONS.get(
+                            section, RESTART_PLAN[BARBICAN_CONF]))
+            elif path in RESTART_PLAN:
+                planned.update(RESTART_PLAN[path])
+            else:
+                services.extend(s for s in self.full_restart_map[path]
+                                if s not in services)
+        if restarts.RESTART_API in planned or 'apache2' in services:
+            planned.discard(restarts.RELOAD_API)
+        if 'apache2' in services:
+            planned.discard(restarts.RESTART_API)
+        if self.default_service in services:
+            planned.discard(restarts.RESTART_WORKER)
+        return [a for a in restarts.RESTART_ACTIONS if a in planned], services
+
+    def run_restart_plan(self, actions, services, files=None):
+        """Carry out a restart plan and record what was done.
+
+        :param actions: list of restarts.RESTART_ACTIONS
+        :param services: list of services to restart
+        :param files: the changed files that led to the plan
+        """
+        api = (restarts.RELOAD_API in actions or
+               restarts.RESTART_API in actions or
+               'apache2' in services)
+        previous = ({proc.pid for proc in self.wsgi_daemon_processes()}
+                    if api else ())
+        # a changed unit file has to be loaded before its service restarts
+        if files and BARBICAN_RETRY_UNIT in files:
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        for action in actions:
+            if action == restarts.RELOAD_API:
+                ch_host.service_reload('apache2', restart_on_failure=True)
+            elif action == restarts.RESTART_API:
+                ch_host.service_restart('apache2')
+            elif action == restarts.RESTART_WORKER:
+                ch_host.service_restart('barbican-worker')
+                if (BARBICAN_RETRY_SERVICE in self.full_service_list and
+                        BARBICAN_RETRY_SERVICE not in services):
+                    ch_host.service_restart(BARBICAN_RETRY_SERVICE)
+        for service in services:
+            ch_host.service_restart(service)
+        if api:
+            self.wait_for_warmup(previous=previous)
+        hookenv.log("Restart plan for {}: actions {}, services {}"
+                    .format(files, actions, services), level=hookenv.INFO)
+        unitdata.kv().set(restarts.LAST_RESTART_KEY, {
+            'actions': actions,
+            'services': services,
+            'files': files or [],
+            'time': time.time(),
+        })
+
+    def grant_restart_slots(self):
+        """As the leader, hand out the restart slots.
+
+        :returns: the slots in use, {unit: nonce}
+        """
+        return restarts.grant_slots()
+
+    def run_pending_restart(self):
+        """Carry out a deferred restart once a slot has been granted, then
+        release the slot when the local API answers the health probe.
+
+        A pending OpenStack upgrade is left for upgrade_if_available().
+
+        :returns: True if a pending restart was completed
+        """
+        kv = unitdata.kv()
+        pending = kv.get(restarts.PENDING_RESTART_KEY)
+        if not pending or pending['upgrade']:
+            return False
+        if not restarts.slot_granted():
+            restarts.set_cluster_data(
+                {restarts.RESTART_REQUEST_KEY: pending['nonce']})
+            return False
+        if not pending.get('restarted'):
+            drain = (restarts.RELOAD_API in pending['actions'] or
+                     restarts.RESTART_API in pending['actions'] or
+                     'apache2' in pending['services'])
+            if drain:
+                restarts.drain_api()
+            try:
+                self.run_restart_plan(pending['actions'],
+                                      pending['services'], pending['files'])
+            finally:
+                if drain:
+                    restarts.undrain_api()
+            pending['restarted'] = True
+            kv.set(restarts.PENDING_RESTART_KEY, pending)
+        return self.release_restart_slot()
+
+    def release_restart_slot(self):
+        """Give the restart slot back once the local API is healthy.
+
+        :returns: True if the slot was released
+        """
+        kv = unitdata.kv()
+        pending = kv.get(restarts.PENDING_RESTART_KEY)
+        if not self.wait_for_api():
+            hookenv.log("API not healthy after restart, keeping the restart "
+                        "slot", level=hookenv.WARNING)
+            return False
+        restarts.set_cluster_data(
+            {restarts.RESTART_DONE_KEY: pending['nonce']})
+        kv.unset(restarts.PENDING_RESTART_KEY)
+        return True
+
+    def upgrade_if_available(self, interfaces):
+        """Only run an OpenStack upgrade once the leader has granted this
+        unit a restart slot when rolling restarts are enabled.
+
+        Nothing is deferred when there is no upgrade to run or
+        action-managed-upgrade leaves it to the openstack-upgrade action, and
+        an upgrade deferred before that is dropped again.
+
+        :param interfaces: the interfaces to render with after the upgrade
+        """
+        if (not restarts.rolling_restarts_enabled() or
+                hookenv.config('action-managed-upgrade') or
+                not self.openstack_upgrade_available(self.release_pkg)):
+            self._drop_deferred_upgrade()
+            return super(BarbicanCharm, self).upgrade_if_available(interfaces)
+        if not restarts.slot_granted():
+            restarts.defer(upgrade=True)
+            return
+        super(BarbicanCharm, self).upgrade_if_available(interfaces)
+        kv = unitdata.kv()
+        pending = kv.get(restarts.PENDING_RESTART_KEY)
+        pending['upgrade'] = False
+        kv.set(restarts.PENDING_RESTART_KEY, pending)
+        self.run_pending_restart()
+
+    def _drop_deferred_upgrade(self):
+        """Stop waiting for a restart slot for an upgrade that is no longer
+        run automatically, carrying on with any other pending restart."""
+        kv = unitdata.kv()
+        pending = kv.get(restarts.PENDING_RESTART_KEY)
+        if not pending or not pending['upgrade']:
+            return
+        pending['upgrade'] = False
+        kv.set(restarts.PENDING_RESTART_KEY, pending)
+        self.run_pending_restart()
+
+    def api_url(self):
+        """The URL of the local API, behind haproxy."""
+        port = ch_cluster.determine_apache_port(
+            self.api_port('barbican-worker', os_ip.PUBLIC),
+            singlenode_mode=True)
+        scheme = 'https' if reactive.is_flag_set(SSL_ENABLED_FLAG) else 'http'
+        return '{}://127.0.0.1:{}/'.format(scheme, port)
+
+    def api_probe_url(self):
+        """The URL used to check that the local API is serving requests."""
+        return self.api_url() + restarts.HEALTHCHECK_PATH
+
+    @staticmethod
+    def api_ssl_context():
+        """The SSL context for requests to the local API.
+
+        The certificate is issued for the unit's public names, not the
+        loopback address the requests are sent to, so it isn't verified.
+
+        :returns: ssl.SSLContext, or None if TLS isn't enabled
+        """
+        if not reactive.is_flag_set(SSL_ENABLED_FLAG):
+            return None
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def wait_for_api(self, timeout=None):
+        """Wait for the local API to answer its health probe with a 200, so
+        a drained API (503) doesn't count as up.
+
+        :param timeout: seconds to wait, defaults to
+                        'rolling-restart-probe-timeout'
+        :returns: True if the API answered in time
+        """
+        if timeout is None:
+            timeout = hookenv.config('rolling-restart-probe-timeout') or 60
+        url = self.api_probe_url()
+        context = self.api_ssl_context()
+        deadline = time.time() + timeout
+        while True:
+            try:
+                with urllib.request.urlopen(url, timeout=5,
+                                            context=context) as response:
+                    if response.status == 200:
+                        return True
+            except (urllib.error.URLError, OSError):
+                pass
+            if time.time() >= deadline:
+                return False
+            time.sleep(2)
+
+    @staticmethod
+    def service_token():
+        """Get a keystone token for the barbican service user from the
+        credentials on the identity-service relation.
+
+        :returns: token string
+        :raises: ValueError if there are no credentials yet
+        """
+        creds = {}
+        for rid in hookenv.relation_ids(IDENTITY_RELATION):
+            for unit in hookenv.related_units(rid):
+                data = hookenv.relation_get(rid=rid, unit=unit) or {}
+                if data.get('service_password'):
+                    creds = data
+        if not creds:
+            raise ValueError("No credentials on the identity-service "
+                             "relation")
+        host = creds['auth_host']
+        if ':' in host:
+            host = '[{}]'.format(host)
+        url = '{}://{}:{}/v3/auth/tokens'.format(
+            creds.get('auth_protocol') or 'http', host, creds['auth_port'])
+        domain = {'name': creds.get('service_domain') or 'service_domain'}
+        body = {'auth': {
+            'identity': {
+                'methods': ['password'],
+                'password': {'user': {
+                    'name': creds['service_username'],
+                    'domain': domain,
+                    'password': creds['service_password'],
+                }},
+            },
+            'scope': {'project': {
+                'name': creds['service_tenant'],
+                'domain': domain,
+            }},
+        }}
+        request = urllib.request.Request(
+            url, data=json.dumps(body).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.headers['X-Subject-Token']
+
+    def run_benchmark(self, workload, count, concurrency):
+        """Benchmark the local API, bypassing haproxy.
+
+        :param workload: one of benchmark.WORKLOADS
+        :param count: number of create/get/delete iterations
+        :param concurrency: number of concurrent clients
+        :returns: dict of results as returned by benchmark.Benchmark.run()
+        """
+        bench = benchmark.Benchmark(self.api_url(), self.service_token(),
+                                    workload,
+                                    ssl_context=self.api_ssl_context())
+        results = bench.run(count, concurrency)
+        hookenv.log("Benchmark results: {}".format(results),
+                    level=hookenv.INFO)
+        return results
+
+    def wsgi_process_model(self, worker_context=None):
+        """Work out the mod_wsgi daemon process settings for the API vhosts.
+
+        With 'wsgi-auto-size' set the processes and threads are derived from
+        the unit's CPU count and memory, otherwise the processes come from the
+        worker-multiplier based wsgi worker context and the threads from the
+        'wsgi-threads' option.  The result is remembered so that it can be
+        reported in the workload status.
+
+        :param worker_context: the wsgi_worker_context of the configuration
+                               adapter
+        :returns: dict of the WSGIDaemonProcess settings
+        """
+        admin_mode = hookenv.config('wsgi-admin-mode') or 'separate'
+        dedicated_processes = hookenv.config('wsgi-admin-processes') or 1
+        if hookenv.config('wsgi-auto-size'):
+            processes, threads = self._auto_size_wsgi(admin_mode,
+                                                      dedicated_processes)
+        else:
+            processes = (worker_context or {}).get('processes') or 1
+            threads = hookenv.config('wsgi-threads') or 1
+        if admin_mode == 'shared':
+            admin_processes = 0
+        elif admin_mode == 'dedicated':
+            admin_processes = dedicated_processes
+        else:
+            admin_processes = processes
+        model = {
+            'processes': int(processes),
+            'threads': int(threads),
+            'admin_mode': admin_mode,
+            'admin_processes': int(admin_processes),
+            'listen_backlog': hookenv.config('wsgi-listen-backlog'),
+            'queue_timeout': hookenv.config('wsgi-queue-timeout'),
+            'request_timeout': hookenv.config('wsgi-request-timeout'),
+            'maximum_requests': hookenv.config('wsgi-maximum-requests'),
+        }
+        unitdata.kv().set(WSGI_PROCESS_MODEL_KEY, model)
+        return model
+
+    @staticmethod
+    def wsgi_daemon_processes():
+        """The API's mod_wsgi daemon processes.
+
+        :returns: list of psutil.Process, with the cmdline and memory_info
+                  in their info
+        """
+        return [proc for proc in psutil.process_iter(['cmdline',
+                                                      'memory_info'])
+                if (proc.info['cmdline'] or [''])[0].startswith(
+                    WSGI_DISPLAY_NAME_PREFIX)]
+
+    def wsgi_processes_loaded(self, previous=()):
+        """Count the API daemon processes that have loaded the application.
+
+        The daemons of the previous generation linger until they have
+        finished their requests, loaded, after a graceful reload, so the
+        ones that were running before the restart are left out.
+
+        :param previous: the pids of the daemons running before the restart
+        :returns: number of loaded daemon processes
+        """
+        loaded = 0
+        for proc in self.wsgi_daemon_processes():
+            memory = proc.info['memory_info']
+            if (proc.pid not in previous and memory and
+                    memory.rss >= WSGI_LOADED_RSS_MB * 1024 * 1024):
+                loaded += 1
+        return loaded
+
+    @staticmethod
+    def wsgi_processes_expected():
+        """The number of API daemon processes in the rendered model."""
+        model = unitdata.kv().get(WSGI_PROCESS_MODEL_KEY)
+        if not model:
+            return 0
+        return model['processes'] + model['admin_processes']
+
+    def wait_for_warmup(self, timeout=None, previous=()):
+        """Wait for every API daemon process to load the application and
+        for the API to answer its health probe.
+
+        :param timeout: seconds to wait, defaults to 'wsgi-warmup-timeout';
+                        with no timeout there is no wait
+        :param previous: the pids of the daemons running before the restart
+        :returns: True if the API warmed up in time
+        """
+        if timeout is None:
+            timeout = hookenv.config('wsgi-warmup-timeout')
+        if not timeout:
+            return True
+        expected = self.wsgi_processes_expected()
+        deadline = time.time() + timeout
+        while self.wsgi_processes_loaded(previous) < expected:
+            if time.time() >= deadline:
+                hookenv.log("API daemon processes still loading after {}s"
+                            .format(timeout), level=hookenv.WARNING)
+                return False
+            time.sleep(1)
+        return self.wait_for_api(timeout=max(1, deadline - time.time()))
+
+    @staticmethod
+    def _auto_size_wsgi(admin_mode, admin_processes):
+        """Pick a (processes, threads) pair from the unit's resources.
+
+        The process count is bounded by both the number of CPUs and the
+        memory available to the API daemons, which is shared with the admin
+        vhost's processes; threads then make up the concurrency wanted for
+        an I/O bound service.
+
+        :param admin_mode: one of WSGI_ADMIN_MODES
+        :param admin_processes: the admin processes in 'dedicated' mode
+        :returns: (processes, threads)
+        """
+        cpus = os.cpu_count() or 1
+        memory_mb = psutil.virtual_memory().total // (1024 * 1024)
+        by_memory = (int(memory_mb * WSGI_MEMORY_FRACTION) //
+                     WSGI_PROCESS_RSS_MB)
+        if admin_mode == 'separate':
+            # as many admin processes as public ones
+            by_memory //= 2
+        elif admin_mode == 'dedicated':
+            by_memory -= admin_processes
+        processes = max(1, min(cpus, by_memory))
+        concurrency = cpus * WSGI_REQUESTS_PER_CPU
+        threads = max(1, min(WSGI_MAX_THREADS, -(-concurrency // processes)))
+        return processes, threads
+
+    def memcache_servers(self):
+        """List the memcached servers for the token cache.
+
+        The servers come from the memcache relation, falling back to the
+        'memcached-servers' option.
+
+        :returns: list of server strings as used by memcached_servers
+        """
+        servers = []
+        for rid in hookenv.relation_ids(MEMCACHE_RELATION):
+            for unit in hookenv.related_units(rid):
+                data = hookenv.relation_get(rid=rid, unit=unit) or {}
+                host = data.get('host') or data.get('private-address')
+                if not host:
+                    continue
+                port = data.get('port') or MEMCACHE_DEFAULT_PORT
+                if ':' in host:
+                    servers.append('inet6:[{}]:{}'.format(host, port))
+                else:
+                    servers.append('{}:{}'.format(host, port))
+        if not servers and hookenv.config('memcached-servers'):
+            servers = [s.strip() for s
+                       in hookenv.config('memcached-servers').split(',')
+                       if s.strip()]
+        return sorted(servers)
+
+    def start_profiling(self, duration):
+        """Serve the /v1 API through the profiling pipeline for 'duration'
+        seconds.  Once the window has passed the next hook renders the normal
+        pipeline again.
+
+        :param duration: length of the profiling window in seconds
+        :returns: the time at which the window closes
+        :raises: ValueError if the window can't be opened
+        """
+        expires = api_profiling.open_window(duration, SYSTEM_PYTHON)
+        self.render_configs([BARBICAN_API_PASTE_CONF])
+        return expires
+
+    def stop_profiling(self, top=20):
+        """Close the profiling window and collect its output.
+
+        :param top: the number of functions to summarise
+        :returns: (archive, summary) as returned by api_profiling.collect()
+        :raises: ValueError if there is no profiling output
+        """
+        api_profiling.close_window()
+        self.render_configs([BARBICAN_API_PASTE_CONF])
+        return api_profiling.collect(top)
+
+    def messaging_settings(self):
+        """Work out the oslo.messaging settings from 'messaging-profile' and
+        the individual options that override it.
+
+        :returns: {section: {key: value}} for the DEFAULT and
+                  oslo_messaging_rabbit sections
+        """
+        profile = MESSAGING_PROFILES.get(
+            hookenv.config('messaging-profile') or 'default', {})
+        settings = {section: dict(profile.get(section, {}))
+                    for section in ('DEFAULT', 'oslo_messaging_rabbit')}
+        for option, (section, key) in MESSAGING_OVERRIDES.items():
+            value = hookenv.config(option)
+            if value is not None and value is not False:
+                settings[section][key] = value
+        return settings
+
+    @staticmethod
+    def amqp_ha_queues():
+        """Whether the amqp relation advertises mirrored (HA) queues.
+
+        :returns: boolean
+        """
+        for rid in hookenv.relation_ids(AMQP_RELATION):
+            for unit in hookenv.related_units(rid):
+                ha_queues = hookenv.relation_get('ha_queues', rid=rid,
+                                                 unit=unit)
+                if ha_queues and str(ha_queues).lower() == 'true':
+                    return True
+        return False
+
+    def memcache_settings(self):
+        """Work out the [keystone_authtoken] token cache settings.
+
+        :returns: dict of settings, empty if there are no memcached servers
+        """
+        servers = self.memcache_servers()
+        if not servers:
+            return {}
+        return {
+            'memcached_servers': ','.join(servers),
+            'token_cache_time': hookenv.config('token-cache-time'),
+            'memcache_use_advanced_pool': True,
+            'memcache_pool_maxsize': hookenv.config('memcache-pool-maxsize'),
+            'memcache_pool_socket_timeout': hookenv.config(
+                'memcache-pool-socket-timeout'),
+            'memcache_pool_unused_timeout': hookenv.config(
+                'memcache-pool-unused-timeout'),
+            'memcache_pool_conn_get_timeout': hookenv.config(
+                'memcache-pool-conn-get-timeout'),
+        }
+
+    def active_project_count(self):
+        """Count the projects with an active KEK in the barbican database.
+
+        :returns: int or None if the database couldn't be queried
+        """
+        parser = configparser.ConfigParser(strict=False, interpolation=None)
+        try:
+            parser.read(BARBICAN_CONF)
+            connection = parser.get('database', 'connection')
+        except (configparser.Error, OSError):
+            return None
         try:
-            subprocess.check_call(cmd)
-            hookenv.log("barbican-mangage hsm gen_hmac succeeded")
-        except subprocess.CalledProcessError:
-            str_err = "barbican-manage hsm gen_hmac failed."
-            hookenv.log(str_err)
-            raise Exception(str_err)
+            return int(subprocess.check_output(
+                [SYSTEM_PYTHON, '-c', PKEK_PROJECT_COUNT_SCRIPT],
+                input=connection, universal_newlines=True, timeout=60))
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired,
+                OSError, ValueError) as e:
+            hookenv.log("Couldn't count the active projects: {}".format(e),
+                        level=hookenv.WARNING)
+            return None
+
+    @staticmethod
+    def pkek_cache_auto():
+        """Whether the project KEK cache is sized from the project count."""
+        return bool(hookenv.config('pkek-cache-limit-auto') and
+                    hookenv.relation_ids(hsm_slots.HSM_RELATION))
+
+    def refresh_project_count(self):
+        """Count the projects with an active KEK again, for the project KEK
+        cache sizing.  A new count changes the render fingerprint, so that
+        the configuration is rendered with it.
+        """
+        if not self.pkek_cache_auto():
+            return
+        projects = self.active_project_count()
+        if projects is not None:
+            unitdata.kv().set(PKEK_PROJECTS_KEY, projects)
+
+    def pkek_cache_settings(self):
+        """Work out the [p11_crypto_plugin] project KEK settings.
+
+        With 'pkek-cache-limit-auto' set, and an HSM related, the cache
+        limit is raised to hold every project with an active KEK, with some
+        headroom.  The projects are counted on the first render and then
+        in update-status, see refresh_project_count().  The result is
+        remembered for the workload status.
+
+        :returns: dict of the settings
+        """
+        limit = hookenv.config('pkek-cache-limit')
+        projects = None
+        if self.pkek_cache_auto():
+            if unitdata.kv().get(PKEK_PROJECTS_KEY) is None:
+                self.refresh_project_count()
+            projects = unitdata.kv().get(PKEK_PROJECTS_KEY)
+            if projects is not None:
+                limit = max(limit, int(projects * PKEK_CACHE_HEADROOM + 0.5))
+        settings = {
+            'rw_session': hookenv.config('hsm-rw-session'),
+            'length': hookenv.config('pkek-length'),
+            'ttl': hookenv.config('pkek-cache-ttl'),
+            'limit': limit,
+            'projects': projects,
+        }
+        unitdata.kv().set(PKEK_CACHE_KEY, settings)
+        return settings
+
+    def worker_process_count(self):
+        """The number of barbican-worker and barbican-retry processes on the
+        unit that hold database connections."""
+        count = hookenv.config('worker-processes') or 1
+        if hookenv.config('enable-retry-scheduler'):
+            count += 1
+        return count
+
+    def configure_retry_scheduler(self):
+        """Enable the barbican-retry scheduler at boot, or stop it and remove
+        its systemd unit once 'enable-retry-scheduler' is switched off.
+        """
+        if hookenv.config('enable-retry-scheduler'):
+            ch_host.service('enable', BARBICAN_RETRY_SERVICE)
+        elif os.path.exists(BARBICAN_RETRY_UNIT):
+            ch_host.service_stop(BARBICAN_RETRY_SERVICE)
+            ch_host.service('disable', BARBICAN_RETRY_SERVICE)
+            os.remove(BARBICAN_RETRY_UNIT)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+
+    @staticmethod
+    def worker_processes_running():
+        """Count the barbican-worker processes serving the queue.
+
+        With more than one worker barbican-worker forks them from a parent
+        process that does no work itself, so the parent isn't counted.
+
+        :returns: number of running worker processes
+        """
+        pids = set()
+        parents = set()
+        for proc in psutil.process_iter(['pid', 'ppid', 'cmdline']):
+            cmdline = proc.info['cmdline'] or []
+            if any(arg.endswith('barbican-worker') for arg in cmdline[:2]):
+                pids.add(proc.info['pid'])
+                parents.add(proc.info['ppid'])
+        if pids & parents:
+            return len(pids - parents)
+        return len(pids)
+
+    def database_pool_settings(self, wsgi_model):
+        """Work out the oslo.db connection pool settings.
+
+        With 'database-pool-auto' set each process gets a pool as large as
+        its number of WSGI threads, plus half as much again as overflow, and
+        the resulting connection budget for the unit is logged.  The
+        individual 'database-*' options override the automatic values.
+
+        :param wsgi_model: dict as returned by wsgi_process_model()
+        :returns: dict of the [database] settings to render
+        """
+        settings = {}
+        if hookenv.config('database-pool-auto'):
+            threads = wsgi_model['threads']
+            settings = {
+                'max_pool_size': threads,
+                'max_overflow': max(1, threads // 2),
+                'pool_timeout': DB_POOL_TIMEOUT,
+                'connection_recycle_time': DB_CONNECTION_RECYCLE_TIME,
+            }
+        for key in ('max_pool_size', 'max_overflow', 'pool_timeout',
+                    'connection_recycle_time'):
+            value = hookenv.config('database-{}'.format(key.replace('_', '-')))
+            if value:
+                settings[key] = value
+        if 'max_pool_size' in settings:
+            processes = (wsgi_model['processes'] +
+                         wsgi_model['admin_processes'] +
+                         self.worker_process_count())
+            per_process = (settings['max_pool_size'] +
+                           settings.get('max_overflow', 0))
+            hookenv.log("Database connection budget for the unit: {} "
+                        "({} processes x {} connections)"
+                        .format(processes * per_process, processes,
+                                per_process),
+                        level=hookenv.INFO)
+        return settings
+
+    @staticmethod
+    def haproxy_backend_settings(wsgi_model):
+        """Work out the haproxy backend balance algorithm and the maxconn of
+        each server.
+
+        A unit can serve no more concurrent requests than its mod_wsgi
+        processes x threads, so that is the default maxconn and any larger
+        'haproxy-maxconn' is clamped to it.  The excess waits in the haproxy
+        queue, where another backend can pick it up, rather than in the
+        mod_wsgi listen backlog.  The admin backend is sized the same way
+        from the admin daemons, or, with the admin vhost sharing the public
+        daemons, gets HAPROXY_SHARED_ADMIN_SHARE of their capacity.
+
+        :param wsgi_model: dict as returned by wsgi_process_model()
+        :returns: dict with 'balance', 'maxconn' and 'admin_maxconn'
+        """
+        capacity = wsgi_model['processes'] * wsgi_model['threads']
+        if wsgi_model.get('admin_mode') == 'shared':
+            admin_capacity = max(1, math.ceil(
+                capacity * HAPROXY_SHARED_ADMIN_SHARE))
+            capacity = max(1, capacity - admin_capacity)
+        else:
+            admin_capacity = max(1, wsgi_model.get('admin_processes', 0) *
+                                 wsgi_model['threads'])
+        maxconn = hookenv.config('haproxy-maxconn') or capacity
+        if maxconn > capacity:
+            hookenv.log("haproxy-maxconn {} is more than the {} concurrent "
+                        "requests the API can serve, using {}"
+                        .format(maxconn, capacity, capacity),
+                        level=hookenv.WARNING)
+            maxconn = capacity
+        admin_maxconn = min(hookenv.config('haproxy-maxconn') or
+                            admin_capacity, admin_capacity)
+        balance = hookenv.config('haproxy-balance')
+        if balance not in HAPROXY_BALANCE_ALGORITHMS:
+            balance = HAPROXY_BALANCE_ALGORITHMS[0]
+        return {'balance': balance, 'maxconn': maxconn,
+                'admin_maxconn': admin_maxconn}
+
+    def haproxy_tls_ports(self):
+        """The backend ports haproxy forwards to that speak TLS.
+
+        While TLS is enabled apache's https frontend, rather than the
+        barbican-api vhosts, listens on the apache port of each API port.
+
+        :returns: sorted list of ports, empty if TLS isn't enabled
+        """
+        if not reactive.is_flag_set(SSL_ENABLED_FLAG):
+            return []
+        return sorted({
+            ch_cluster.determine_apache_port(port, singlenode_mode=True)
+            for ports in self.api_ports.values() for port in ports.values()})
+
+    @staticmethod
+    def rate_limit_settings(wsgi_model):
+        """Work out the settings of the rate limiting paste filter.
+
+        The 'rate-limit-*' options are limits for the unit's API, and each
+        API process enforces its share of them.  Both vhosts load the same
+        paste pipeline, so the admin vhost's processes take a share too.
+
+        :param wsgi_model: dict as returned by wsgi_process_model()
+        :returns: dict with the 'python_path' of the filter module and the
+                  'filter' settings, empty if rate limiting is disabled
+        """
+        if not hookenv.config('rate-limit'):
+            return {}
+        processes = wsgi_model['processes'] + wsgi_model['admin_processes']
+
+        def share(option, minimum=0):
+            value = hookenv.config(option) or 0
+            if not value:
+                return 0
+            return max(minimum, int(math.ceil(value / processes)))
+
+        return {
+            'python_path': RATELIMIT_PYTHON_PATH,
+            'filter': {
+                'project_rate': round(
+                    (hookenv.config('rate-limit-project-rate') or 0) /
+                    processes, 3),
+                'project_burst': share('rate-limit-project-burst', 1),
+                'global_rate': round(
+                    (hookenv.config('rate-limit-global-rate') or 0) /
+                    processes, 3),
+                'global_burst': share('rate-limit-global-burst', 1),
+                'project_concurrency': share(
+                    'rate-limit-project-concurrency', 1),
+                'global_concurrency': share(
+                    'rate-limit-global-concurrency', 1),
+                'stats_dir': reports.RATELIMIT_STATS_DIR,
+            },
+        }
+
+    @staticmethod
+    def _valid_kek(kek):
+        """Check that a KEK is a base64 encoded 32 byte key.
+
+        :param kek: the KEK to check
+        :returns: boolean
+        """
+        try:
+            return len(base64.b64decode(kek, validate=True)) == (
+                SOFTWARE_STORE_KEK_BYTES)
+        except (TypeError, ValueError, binascii.Error):
+            return False
+
+    def software_store_kek(self):
+        """The KEK of the software secret store: the simple-crypto-kek option
+        if it is set, otherwise the one generated by the leader.
+
+        :returns: base64 encoded KEK or None if there isn't a valid one yet
+        """
+        kek = (hookenv.config('simple-crypto-kek') or
+               hookenv.leader_get(SOFTWARE_STORE_KEK_KEY))
+        return kek if self._valid_kek(kek) else None
+
+    @staticmethod
+    def generate_software_store_kek():
+        """As the leader, generate the KEK of the software secret store
+        once and share it with the other units in leader settings."""
+        if (not hookenv.is_leader() or
+                hookenv.leader_get(SOFTWARE_STORE_KEK_KEY)):
+            return
+        kek = base64.b64encode(os.urandom(SOFTWARE_STORE_KEK_BYTES))
+        hookenv.leader_set({SOFTWARE_STORE_KEK_KEY: kek.decode('ascii')})
+
+    def _secret_store_check(self):
+        """Check that the secret stores can be rendered when multiple
+        stores are enabled.
+
+        :returns: (status, message) or (None, None)
+        """
+        if not hookenv.config('enable-multiple-secret-stores'):
+            return None, None
+        configured_kek = hookenv.config('simple-crypto-kek')
+        if configured_kek and not self._valid_kek(configured_kek):
+            return ('blocked',
+                    "simple-crypto-kek must be a base64 encoded {} byte key"
+                    .format(SOFTWARE_STORE_KEK_BYTES))
+        if not self.software_store_kek():
+            return ('blocked',
+                    "Multiple secret stores need a software store KEK, "
+                    "waiting for the leader to generate one")
+        default_store = hookenv.config('default-secret-store')
+        if not default_store or default_store == 'software':
+            return None, None
+        if default_store == 'hsm':
+            if not hookenv.relation_ids(hsm_slots.HSM_RELATION):
+                return ('blocked',
+                        "default-secret-store 'hsm' requires an hsm "
+                        "relation")
+            return None, None
+        if not hookenv.relation_ids(SECRETS_RELATION):
+            return ('blocked',
+                    "default-secret-store '{}' requires a secrets "
+                    "relation".format(default_store))
+        secrets = reactive.endpoint_from_flag('secrets.available')
+        names = [plugin.get('name') for plugin in
+                 (getattr(secrets, 'plugins', None) or [])]
+        if default_store not in names:
+            return ('blocked',
+                    "default-secret-store '{}' is not a plugin on the "
+                    "secrets relation".format(default_store))
+        return None, None
+
+    def custom_assess_status_check(self):
+        """Block on configuration that can't be rendered.
+
+        :returns: (status, message) or (None, None)
+        """
+        admin_mode = hookenv.config('wsgi-admin-mode')
+        if admin_mode and admin_mode not in WSGI_ADMIN_MODES:
+            return ('blocked',
+                    "Invalid wsgi-admin-mode '{}', must be one of {}"
+                    .format(admin_mode, ', '.join(WSGI_ADMIN_MODES)))
+        status, message = self._secret_store_check()
+        if status:
+            return status, message
+        balance = hookenv.config('haproxy-balance')
+        if balance and balance not in HAPROXY_BALANCE_ALGORITHMS:
+            return ('blocked',
+                    "Invalid haproxy-balance '{}', must be one of {}"
+                    .format(balance, ', '.join(HAPROXY_BALANCE_ALGORITHMS)))
+        timeouts = {
+            name: (hookenv.config('haproxy-{}-timeout'.format(name)) or
+                   default)
+            for name, default in HAPROXY_DEFAULT_TIMEOUTS.items()}
+        request_timeout = hookenv.config('wsgi-request-timeout')
+        if request_timeout and timeouts['server'] <= request_timeout * 1000:
+            return ('blocked',
+                    "haproxy-server-timeout ({}ms) must be longer than "
+                    "wsgi-request-timeout ({}s)"
+                    .format(timeouts['server'], request_timeout))
+        if timeouts['queue'] >= timeouts['client']:
+            return ('blocked',
+                    "haproxy-queue-timeout ({}ms) must be shorter than "
+                    "haproxy-client-timeout ({}ms)"
+                    .format(timeouts['queue'], timeouts['client']))
+        profile = hookenv.config('messaging-profile')
+        if profile and profile not in MESSAGING_PROFILES:
+            return ('blocked',
+                    "Invalid messaging-profile '{}', must be one of {}"
+                    .format(profile, ', '.join(sorted(MESSAGING_PROFILES))))
+        if hookenv.config('rabbit-quorum-queues') and self.amqp_ha_queues():
+            return ('blocked',
+                    "rabbit-quorum-queues can't be used with the mirrored "
+                    "queues of the amqp relation")
+        if (hookenv.config('rabbit-stream-fanout') and
+                not hookenv.config('rabbit-quorum-queues')):
+            return ('blocked',
+                    "rabbit-stream-fanout requires rabbit-quorum-queues")
+        if hookenv.config(policyd.POLICYD_CONFIG_NAME):
+            state = unitdata.kv().get(POLICYD_STATE_KEY)
+            if state and state['error']:
+                return ('blocked',
+                        "Invalid policyd-override resource: {}"
+                        .format(state['error']))
+        if hookenv.config('wsgi-warmup-timeout'):
+            expected = self.wsgi_processes_expected()
+            loaded = self.wsgi_processes_loaded()
+            if loaded < expected:
+                return ('waiting', 'API processes loading ({}/{})'
+                        .format(loaded, expected))
+        pending = unitdata.kv().get(restarts.PENDING_RESTART_KEY)
+        if pending and not pending.get('restarted'):
+            return 'waiting', 'Waiting for a rolling restart slot'
+        return None, None
+
+    def custom_assess_status_last_check(self):
+        """Report the rendered mod_wsgi process model in the workload status
+        once all the other checks have passed.
+
+        :returns: (status, message) or (None, None)
+        """
+        model = unitdata.kv().get(WSGI_PROCESS_MODEL_KEY)
+        if not model:
+            return None, None
+        message = 'wsgi: {processes} processes x {threads} threads'.format(
+            **model)
+        if model.get('admin_mode') == 'shared':
+            message += ', admin shared'
+        elif model.get('admin_mode') == 'dedicated':
+            message += ', admin {admin_processes} processes'.format(**model)
+        expected = hookenv.config('worker-processes') or 1
+        if expected > 1:
+            message += '; workers: {}/{} running'.format(
+                self.worker_processes_running(), expected)
+        pkek = unitdata.kv().get(PKEK_CACHE_KEY)
+        if pkek and hookenv.relation_ids(hsm_slots.HSM_RELATION):
+            message += '; pkek cache: {limit}'.format(**pkek)
+            if pkek.get('projects') is not None:
+                message += ' for {projects} projects'.format(**pkek)
+        return 'active', 'Unit is ready ({})'.format(message)
 
     def states_to_check(self, required_relations=None):
         """Override the default states_to_check() for the assess_status
@@ -251,7 +1824,8 @@ class BarbicanCharm(ch_plugins.PolicydOverridePlugin,
         if required_relations is None:
             required_relations = self.required_relations
         if hookenv.config('require-hsm-plugin'):
-            required_relations.append('hsm')
+            # a copy, so the class's required_relations is left alone
+            required_relations = list(required_relations) + ['hsm']
         return super(BarbicanCharm, self).states_to_check(
             required_relations=required_relations)
 
@@ -0,0 +1,159 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A small create/get/delete load generator for the Barbican API.
+
+Each iteration of a workload creates a resource, reads it back and deletes
+it, and the latency of each of those operations is recorded so that the
+throughput and latency percentiles can be compared before and after a
+tuning change.
+"""
+
+import concurrent.futures
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+WORKLOADS = ('secret', 'container')
+OPERATIONS = ('create', 'get', 'delete')
+PERCENTILES = (50, 95, 99)
+REQUEST_TIMEOUT = 30
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples.
+
+    :param samples: list of numbers
+    :param pct: percentile, 0 < pct <= 100
+    :returns: the sample at that percentile, or None if there are none
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, -(-pct * len(ordered) // 100))
+    return ordered[rank - 1]
+
+
+class Benchmark(object):
+    """Drive one workload against a Barbican API endpoint.
+
+    :param endpoint: base URL of the API, e.g. http://127.0.0.1:9311
+    :param token: keystone token to send as X-Auth-Token
+    :param workload: one of WORKLOADS
+    :param ssl_context: ssl.SSLContext for an https endpoint
+    """
+
+    def __init__(self, endpoint, token, workload='secret', ssl_context=None):
+        if workload not in WORKLOADS:
+            raise ValueError("Unknown workload '{}', must be one of {}"
+                             .format(workload, ', '.join(WORKLOADS)))
+        self.endpoint = endpoint.rstrip('/')
+        self.token = token
+        self.workload = workload
+        self.ssl_context = ssl_context
+        self._lock = threading.Lock()
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.errors = []
+
+    def _request(self, method, url, body=None):
+        data = None
+        headers = {'X-Auth-Token': self.token, 'Accept': 'application/json'}
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(url, data=data, headers=headers,
+                                         method=method)
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT,
+                                    context=self.ssl_context) as resp:
+            content = resp.read()
+        return json.loads(content.decode('utf-8')) if content else {}
+
+    def _timed(self, operation, method, url, body=None):
+        start = time.monotonic()
+        result = self._request(method, url, body)
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.latencies[operation].append(elapsed)
+        return result
+
+    def _create(self):
+        name = 'charm-benchmark-{}'.format(uuid.uuid4().hex[:12])
+        if self.workload == 'secret':
+            result = self._timed(
+                'create', 'POST', self.endpoint + '/v1/secrets',
+                {'name': name,
+                 'payload': uuid.uuid4().hex,
+                 'payload_content_type': 'text/plain'})
+            return result['secret_ref']
+        result = self._timed(
+            'create', 'POST', self.endpoint + '/v1/containers',
+            {'name': name, 'type': 'generic', 'secret_refs': []})
+        return result['container_ref']
+
+    def _local(self, ref):
+        """The API hands back refs using its public host_href, so point them
+        back at the endpoint being benchmarked."""
+        return self.endpoint + urllib.parse.urlparse(ref).path
+
+    def iteration(self):
+        """Create, get and delete one resource, recording any failure."""
+        try:
+            ref = self._local(self._create())
+            self._timed('get', 'GET', ref)
+            self._timed('delete', 'DELETE', ref)
+        except (urllib.error.URLError, OSError, KeyError, ValueError) as e:
+            with self._lock:
+                self.errors.append(str(e))
+
+    def run(self, count, concurrency=1):
+        """Run 'count' iterations spread over 'concurrency' threads.
+
+        :returns: dict of results, see results()
+        """
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, concurrency)) as executor:
+            for _ in range(count):
+                executor.submit(self.iteration)
+        return self.results(time.monotonic() - start, concurrency)
+
+    def results(self, duration, concurrency):
+        """Summarise the run.
+
+        :param duration: wall clock time of the run in seconds
+        :param concurrency: number of threads used
+        :returns: dict with the request throughput and, for each operation,
+                  the latency percentiles in milliseconds
+        """
+        requests = sum(len(samples) for samples in self.latencies.values())
+        results = {
+            'workload': self.workload,
+            'concurrency': concurrency,
+            'duration': round(duration, 3),
+            'requests': requests,
+            'errors': len(self.errors),
+            'throughput': round(requests / duration, 2) if duration else 0,
+        }
+        for operation, samples in self.latencies.items():
+            for pct in PERCENTILES:
+                value = percentile(samples, pct)
+                results['{}.p{}'.format(operation, pct)] = (
+                    None if value is None else round(value * 1000, 2))
+        if self.errors:
+            results['first-error'] = self.errors[0]
+        return results
@@ -0,0 +1,218 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The HSM slots published on the hsm relation, and the MKEK and HMAC kept
+on them.
+
+Every unit uses the same primary slot, the first in slot order: the project
+KEKs are wrapped with the MKEK and HMAC of the slot they were created on, so
+all of the units have to use the same key material.  The other slots are
+only failed over to, through their token labels, and have to be replicas of
+the primary.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import subprocess
+import time
+
+import charmhelpers.core.hookenv as hookenv
+
+HSM_RELATION = 'hsm'
+# The relation key the barbican-hsm interface publishes the plugin data under
+HSM_PLUGIN_DATA_KEY = '_plugin_data'
+# barbican-manage is given the HSM login as an oslo.config environment
+# override of [p11_crypto_plugin] login, so that it isn't on the command line.
+HSM_LOGIN_ENV = 'OS_P11_CRYPTO_PLUGIN__LOGIN'
+# the keys provision-hsm-keys creates: (key, length option, label option)
+HSM_KEYS = (
+    ('mkek', 'mkek-key-length', 'label-mkek'),
+    ('hmac', 'hmac-key-length', 'label-hmac'),
+)
+HSM_PROVISION_TIMEOUT = 300
+
+
+def plugin_data(relation=None):
+    """Collect the plugin data published by every unit on the hsm relation.
+
+    Each HSM unit (or partition) publishes its own library_path, login and
+    slot_id.  If none can be read from the relation then the plugin_data of
+    the relation instance is used, as for a single HSM.
+
+    :param relation: the hsm relation instance, if available
+    :returns: list of plugin data dicts, one per distinct slot, in slot order
+    """
+    slots = collections.OrderedDict()
+    for rid in hookenv.relation_ids(HSM_RELATION):
+        for unit in hookenv.related_units(rid):
+            raw = hookenv.relation_get(HSM_PLUGIN_DATA_KEY, rid=rid,
+                                       unit=unit)
+            try:
+                data = json.loads(raw) if raw else None
+            except ValueError:
+                data = None
+            if data:
+                key = (data.get('library_path'), str(data.get('slot_id')))
+                slots.setdefault(key, data)
+    if not slots:
+        try:
+            data = relation.plugin_data
+        except Exception:
+            data = None
+        return [data] if data else []
+    return [slots[k] for k in sorted(slots, key=lambda k: (k[1], k[0]))]
+
+
+def primary(relation=None):
+    """Pick the primary HSM slot, the first in slot order.
+
+    :param relation: the hsm relation instance, if available
+    :returns: plugin data dict, empty if there is no HSM
+    """
+    slots = plugin_data(relation)
+    return slots[0] if slots else {}
+
+
+def manage(slot, command, timeout=None, **options):
+    """Run a barbican-manage hsm command against one slot.
+
+    The login only goes to barbican-manage through the environment, never on
+    its command line where every user on the unit can see it.
+
+    :param slot: the plugin data of the slot
+    :param command: the barbican-manage hsm sub-command
+    :param timeout: seconds the command may take
+    :param options: further options, e.g. label='primarymkek'
+    :returns: subprocess.CompletedProcess
+    :raises: subprocess.TimeoutExpired
+    :raises: ValueError if barbican-manage insists on --passphrase
+    """
+    cmd = [
+        'barbican-manage', 'hsm', command,
+        '--library-path', slot['library_path'],
+        '--slot-id', str(slot['slot_id']),
+    ]
+    for option, value in sorted(options.items()):
+        cmd.extend(['--{}'.format(option), str(value)])
+    env = dict(os.environ)
+    env[HSM_LOGIN_ENV] = slot['login']
+    result = subprocess.run(cmd, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True, timeout=timeout)
+    if result.returncode == 2 and '--passphrase' in result.stderr:
+        raise ValueError(
+            "barbican-manage on this release only takes the HSM login as "
+            "--passphrase on its command line, which would expose it; "
+            "manage the keys with the HSM's own tools instead")
+    return result
+
+
+def generate_key(relation, command, length, label):
+    """Run a barbican-manage hsm key generation command on the primary slot.
+
+    :param relation: the hsm relation instance
+    :param command: the barbican-manage hsm sub-command
+    :param length: key length
+    :param label: key label
+    :raises: Exception if there is no HSM slot or the command fails
+    """
+    slot = primary(relation)
+    if not slot:
+        raise Exception("No HSM slot is available.")
+    result = manage(slot, command, length=length, label=label)
+    if result.returncode:
+        str_err = ("barbican-manage hsm {} failed on slot {}."
+                   .format(command, slot['slot_id']))
+        hookenv.log(str_err)
+        raise Exception(str_err)
+    hookenv.log("barbican-mangage hsm {} succeeded".format(command))
+
+
+def provision_keys(relation, verify_only=False,
+                   timeout=HSM_PROVISION_TIMEOUT):
+    """Check for, and unless verify_only create, the MKEK and HMAC.
+
+    The keys are only generated on the primary slot; the other slots are
+    only checked, so that a key that hasn't been replicated shows up as
+    'missing'.  The slots are worked on in parallel, and a generated key is
+    trusted from the exit code of barbican-manage rather than checked again,
+    so each key costs at most two HSM logins.  Anything still running when
+    the timeout is reached is reported as 'timeout'.
+
+    :param relation: the hsm relation instance
+    :param verify_only: only check for the keys
+    :param timeout: seconds the whole run may take
+    :returns: list of dicts, one per slot and key, with the slot, whether it
+              is the primary, the key, label, length, result ('present',
+              'created', 'missing', 'failed' or 'timeout') and seconds taken,
+              and the error for a failure
+    """
+    deadline = time.monotonic() + timeout
+    slots = plugin_data(relation)
+    primary_slot = primary(relation)
+
+    def run(slot, command, **options):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise subprocess.TimeoutExpired(command, timeout)
+        return manage(slot, command, left, **options)
+
+    def provision(slot):
+        is_primary = slot == primary_slot
+        results = []
+        for key, length_option, label_option in HSM_KEYS:
+            length = hookenv.config(length_option)
+            label = hookenv.config(label_option)
+            result = {
+                'slot': str(slot['slot_id']),
+                'primary': is_primary,
+                'key': key,
+                'label': label,
+                'length': length,
+            }
+            start = time.monotonic()
+            try:
+                check = run(slot, 'check_{}'.format(key), label=label)
+                if not check.returncode:
+                    result['result'] = 'present'
+                elif verify_only or not is_primary:
+                    result['result'] = 'missing'
+                else:
+                    gen = run(slot, 'gen_{}'.format(key),
+                              length=length, label=label)
+                    if gen.returncode:
+                        result['result'] = 'failed'
+                        result['error'] = (
+                            gen.stderr.strip().splitlines() or
+                            ['exit code {}'.format(gen.returncode)])[-1]
+                    else:
+                        result['result'] = 'created'
+            except subprocess.TimeoutExpired:
+                result['result'] = 'timeout'
+            except ValueError as e:
+                result['result'] = 'failed'
+                result['error'] = str(e)
+            result['seconds'] = round(time.monotonic() - start, 3)
+            results.append(result)
+        return results
+
+    if not slots:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(slots)) as executor:
+        return [result
+                for results in executor.map(provision, slots)
+                for result in results]
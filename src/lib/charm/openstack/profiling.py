@@ -0,0 +1,98 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The API profiling window.
+
+While the window stored under PROFILING_KEY (its expiry time) is open the
+/v1 API is served through the authenticated repoze.profile pipeline, which
+writes its pstats and cachegrind output to PROFILE_DIR.  The charm renders
+the pipeline in and out as the window opens and closes.
+"""
+
+import io
+import os
+import pstats
+import subprocess
+import tarfile
+import time
+
+import charmhelpers.core.host as ch_host
+import charmhelpers.core.unitdata as unitdata
+
+PROFILING_KEY = 'barbican-charm.profiling-expires'
+PROFILING_MAX_DURATION = 3600
+PROFILE_DIR = '/var/lib/barbican/profile'
+PROFILE_LOG = os.path.join(PROFILE_DIR, 'barbican-api.profile')
+PROFILE_CACHEGRIND = os.path.join(PROFILE_DIR, 'cachegrind.out.barbican-api')
+
+
+def is_active():
+    """Whether the API profiling window is open.
+
+    :returns: boolean
+    """
+    expires = unitdata.kv().get(PROFILING_KEY)
+    return bool(expires and expires > time.time())
+
+
+def open_window(duration, python):
+    """Open the profiling window for 'duration' seconds, clearing the output
+    of the last one.
+
+    :param duration: length of the profiling window in seconds
+    :param python: the python barbican runs with, which the profiling
+                   pipeline needs repoze.profile installed for
+    :returns: the time at which the window closes
+    :raises: ValueError if the window can't be opened
+    """
+    if not 0 < duration <= PROFILING_MAX_DURATION:
+        raise ValueError("duration must be between 1 and {} seconds"
+                         .format(PROFILING_MAX_DURATION))
+    if subprocess.call([python, '-c', 'import repoze.profile']):
+        raise ValueError("repoze.profile is not installed on the unit")
+    ch_host.mkdir(PROFILE_DIR, owner='barbican', group='barbican',
+                  perms=0o750)
+    for path in (PROFILE_LOG, PROFILE_CACHEGRIND):
+        if os.path.exists(path):
+            os.remove(path)
+    expires = time.time() + duration
+    unitdata.kv().set(PROFILING_KEY, expires)
+    return expires
+
+
+def close_window():
+    """Close the profiling window."""
+    unitdata.kv().unset(PROFILING_KEY)
+
+
+def collect(top=20):
+    """Archive the profiling output and summarise it.
+
+    :param top: the number of functions to summarise
+    :returns: (archive, summary): the path of a tar.gz of the pstats and
+              cachegrind output and the top functions by cumulative time
+    :raises: ValueError if there is no profiling output
+    """
+    if not os.path.exists(PROFILE_LOG):
+        raise ValueError("No profiling output in {}".format(PROFILE_DIR))
+    archive = os.path.join(PROFILE_DIR, 'barbican-api-profile-{}.tar.gz'
+                           .format(time.strftime('%Y%m%d%H%M%S')))
+    with tarfile.open(archive, 'w:gz') as tar:
+        for path in (PROFILE_LOG, PROFILE_CACHEGRIND):
+            if os.path.exists(path):
+                tar.add(path, arcname=os.path.basename(path))
+    output = io.StringIO()
+    stats = pstats.Stats(PROFILE_LOG, stream=output)
+    stats.sort_stats('cumulative').print_stats(top)
+    return archive, output.getvalue()
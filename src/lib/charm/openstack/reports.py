@@ -0,0 +1,95 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read-only reports on the state kept on the unit.
+
+The actions that return these don't need the charm class, so this module
+stays clear of charms.openstack and charms.reactive to keep them quick to
+start.
+"""
+
+import collections
+import glob
+import json
+import os
+
+import psutil
+
+import charmhelpers.core.unitdata as unitdata
+
+import charm.openstack.benchmark as benchmark
+
+# the hook timings recorded with 'hook-timing', oldest first
+HOOK_TIMINGS_KEY = 'barbican-charm.hook-timings'
+# where each API process writes the counters of the rate limiting filter
+RATELIMIT_STATS_DIR = '/var/lib/barbican/ratelimit'
+
+
+def hook_stats(top=5):
+    """Summarise the recorded hook timings.
+
+    :param top: the number of slowest hooks to list
+    :returns: dict with the number of hooks recorded, the count, p50, p95
+              and maximum seconds of each hook and phase, and the slowest
+              hooks
+    """
+    records = unitdata.kv().get(HOOK_TIMINGS_KEY) or []
+    samples = collections.defaultdict(list)
+    for record in records:
+        samples['hook:{}'.format(record['hook'])].append(record['total'])
+        for name, seconds in record['phases'].items():
+            samples[name].append(seconds)
+    summary = {
+        name: {
+            'count': len(values),
+            'p50': benchmark.percentile(values, 50),
+            'p95': benchmark.percentile(values, 95),
+            'max': max(values),
+        } for name, values in samples.items()}
+    slowest = sorted(records, key=lambda r: r['total'], reverse=True)
+    return {
+        'hooks': len(records),
+        'summary': summary,
+        'slowest': slowest[:top],
+    }
+
+
+def rate_limit_stats():
+    """Add up the counters written by each API process, dropping the files
+    of processes that have gone.
+
+    :returns: dict of the totals, the requests in progress and the counters
+              of each project
+    """
+    totals = collections.Counter()
+    projects = collections.defaultdict(collections.Counter)
+    in_flight = 0
+    for path in glob.glob(os.path.join(RATELIMIT_STATS_DIR, '*.json')):
+        try:
+            with open(path) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not psutil.pid_exists(stats.get('pid', 0)):
+            os.remove(path)
+            continue
+        totals.update(stats.get('totals', {}))
+        in_flight += stats.get('in-flight', 0)
+        for project, counters in stats.get('projects', {}).items():
+            projects[project].update(counters)
+    return {
+        'totals': dict(totals),
+        'in-flight': in_flight,
+        'projects': {p: dict(c) for p, c in projects.items()},
+    }
@@ -0,0 +1,200 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Restart planning and rolling restarts.
+
+A change to the rendered files is turned into the least disruptive restart
+actions that apply it.  With 'rolling-restart-max-units' set the actions
+are deferred until the leader grants the unit one of a limited number of
+restart slots, coordinated over the cluster relation: each unit sets
+RESTART_REQUEST_KEY to a nonce when it needs a slot, the leader hands out
+slots in the RESTART_SLOTS_KEY leader setting ({unit: nonce}) and the unit
+sets RESTART_DONE_KEY to the nonce once its API is back up.
+"""
+
+import collections
+import json
+import os
+import time
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+
+# The restart actions, from least to most disruptive.  'reload-api' is a
+# graceful apache2 reload that lets in-flight requests complete.
+RELOAD_API = 'reload-api'
+RESTART_API = 'restart-api'
+RESTART_WORKER = 'restart-worker'
+RESTART_ACTIONS = (RELOAD_API, RESTART_API, RESTART_WORKER)
+
+LAST_RESTART_KEY = 'barbican-charm.last-restart'
+PENDING_RESTART_KEY = 'barbican-charm.pending-restart'
+
+CLUSTER_RELATION = 'cluster'
+RESTART_REQUEST_KEY = 'restart-request'
+RESTART_DONE_KEY = 'restart-done'
+RESTART_SLOTS_KEY = 'restart-slots'
+# the keys only used to coordinate the restarts, not rendered anywhere
+RESTART_COORDINATION_KEYS = (
+    RESTART_REQUEST_KEY, RESTART_DONE_KEY, RESTART_SLOTS_KEY)
+
+# The /healthcheck route answers 503 while HEALTHCHECK_DISABLE_FILE exists
+# (see barbican-api-paste.ini), which takes the unit out of every haproxy
+# backend so that it can be drained before its API is restarted.
+HEALTHCHECK_PATH = 'healthcheck'
+HEALTHCHECK_DISABLE_FILE = '/var/lib/barbican/healthcheck-disable'
+
+
+def read_config(path):
+    """Read a rendered file, or None if it doesn't exist."""
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def config_sections(text):
+    """Split the text of an ini style file into its sections.
+
+    :returns: {section: [lines]}
+    """
+    sections = collections.defaultdict(list)
+    section = ''
+    for line in (text or '').splitlines():
+        stripped = line.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            section = stripped[1:-1]
+        elif stripped and not stripped.startswith('#'):
+            sections[section].append(stripped)
+    return sections
+
+
+def rolling_restarts_enabled():
+    """Restarts are coordinated by the leader when
+    'rolling-restart-max-units' is set and the unit has peers.
+
+    :returns: boolean
+    """
+    if not hookenv.config('rolling-restart-max-units'):
+        return False
+    return any(hookenv.related_units(rid)
+               for rid in hookenv.relation_ids(CLUSTER_RELATION))
+
+
+def defer(actions=None, services=None, files=None, upgrade=False):
+    """Queue restart actions (or an OpenStack upgrade) until the leader
+    grants this unit a restart slot.
+
+    Anything already pending is merged with the new work.
+
+    :param actions: list of RESTART_ACTIONS
+    :param services: list of services to restart
+    :param files: the changed files that led to the restart
+    :param upgrade: whether an OpenStack upgrade is waiting for the slot
+    """
+    kv = unitdata.kv()
+    pending = kv.get(PENDING_RESTART_KEY) or {
+        'nonce': '{:.6f}'.format(time.time()),
+        'actions': [],
+        'services': [],
+        'files': [],
+        'upgrade': False,
+    }
+    planned = set(pending['actions']) | set(actions or [])
+    pending['actions'] = [a for a in RESTART_ACTIONS if a in planned]
+    pending['services'].extend(
+        s for s in services or [] if s not in pending['services'])
+    pending['files'] = sorted(set(pending['files']) | set(files or []))
+    pending['upgrade'] = pending['upgrade'] or upgrade
+    pending['restarted'] = False
+    kv.set(PENDING_RESTART_KEY, pending)
+    hookenv.log("Deferring restart until a slot is granted: {}"
+                .format(pending), level=hookenv.INFO)
+    set_cluster_data({RESTART_REQUEST_KEY: pending['nonce']})
+
+
+def set_cluster_data(settings):
+    for rid in hookenv.relation_ids(CLUSTER_RELATION):
+        hookenv.relation_set(relation_id=rid, relation_settings=settings)
+
+
+def restart_slots():
+    return json.loads(hookenv.leader_get(RESTART_SLOTS_KEY) or '{}')
+
+
+def grant_slots():
+    """As the leader, hand out restart slots to the units asking for one,
+    keeping at most 'rolling-restart-max-units' in use.
+
+    Slots are released once their unit reports that it is done, or when its
+    request goes away.
+
+    :returns: the slots in use, {unit: nonce}
+    """
+    max_units = hookenv.config('rolling-restart-max-units') or 1
+    requests = {}
+    done = {}
+    for rid in hookenv.relation_ids(CLUSTER_RELATION):
+        units = hookenv.related_units(rid) + [hookenv.local_unit()]
+        for unit in units:
+            data = hookenv.relation_get(rid=rid, unit=unit) or {}
+            if data.get(RESTART_REQUEST_KEY):
+                requests[unit] = data[RESTART_REQUEST_KEY]
+            if data.get(RESTART_DONE_KEY):
+                done[unit] = data[RESTART_DONE_KEY]
+    current = restart_slots()
+    slots = {unit: nonce for unit, nonce in current.items()
+             if requests.get(unit) == nonce and done.get(unit) != nonce}
+    for unit in sorted(requests):
+        if len(slots) >= max_units:
+            break
+        if unit not in slots and done.get(unit) != requests[unit]:
+            slots[unit] = requests[unit]
+    if slots != current:
+        hookenv.log("Restart slots now {}".format(slots),
+                    level=hookenv.INFO)
+        hookenv.leader_set({RESTART_SLOTS_KEY: json.dumps(slots)})
+    return slots
+
+
+def slot_granted():
+    """Check whether the leader has granted this unit's pending restart a
+    slot.
+
+    :returns: boolean
+    """
+    pending = unitdata.kv().get(PENDING_RESTART_KEY)
+    if not pending:
+        return False
+    return restart_slots().get(hookenv.local_unit()) == pending['nonce']
+
+
+def drain_api():
+    """Fail the health check so that haproxy stops sending requests to this
+    unit, and give it 'haproxy-drain-time' seconds to notice and for
+    in-flight requests to finish.
+    """
+    with open(HEALTHCHECK_DISABLE_FILE, 'w'):
+        pass
+    drain_time = hookenv.config('haproxy-drain-time') or 0
+    hookenv.log("Draining the API for {}s".format(drain_time),
+                level=hookenv.INFO)
+    time.sleep(drain_time)
+
+
+def undrain_api():
+    """Let the health check pass again."""
+    if os.path.exists(HEALTHCHECK_DISABLE_FILE):
+        os.remove(HEALTHCHECK_DISABLE_FILE)
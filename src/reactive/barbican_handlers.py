@@ -51,16 +51,34 @@ def render_stuff(*args):
 
     Note that the HSM interface is optional and thus is only used if it is
     available.
+
+    If nothing that goes into the render has changed since the last
+    successful one then the render, SSL configuration, upgrade check and
+    status assessment are all skipped.
     """
-    hookenv.log("about to call the render_configs with {}".format(args))
-    with charm.provide_charm_instance() as barbican_charm:
-        barbican_charm.render_with_interfaces(
-            charm.optional_interfaces(args,
-                                      'hsm.available',
-                                      'secrets.available'))
-        barbican_charm.configure_ssl()
-        barbican_charm.upgrade_if_available(args)
-        barbican_charm.assess_status()
+    with charm.provide_charm_instance() as barbican_charm, \
+            barbican_charm.timed('render_stuff'):
+        interfaces = charm.optional_interfaces(args,
+                                               'hsm.available',
+                                               'secrets.available',
+                                               'shared-db-replica.available')
+        with barbican_charm.timed('render_fingerprint'):
+            fingerprint = barbican_charm.render_fingerprint(interfaces)
+        if barbican_charm.render_is_current(fingerprint):
+            hookenv.log("render inputs unchanged, skipping render",
+                        level=hookenv.DEBUG)
+        else:
+            hookenv.log("about to call the render_configs with {}"
+                        .format(args))
+            with barbican_charm.timed('render_with_interfaces'):
+                barbican_charm.render_with_interfaces(interfaces)
+            barbican_charm.configure_retry_scheduler()
+            with barbican_charm.timed('configure_ssl'):
+                barbican_charm.configure_ssl()
+            with barbican_charm.timed('upgrade_if_available'):
+                barbican_charm.upgrade_if_available(args)
+            barbican_charm.assess_status()
+            barbican_charm.record_render(fingerprint)
     reactive.set_flag('first-render')
 
 
@@ -70,13 +88,43 @@ def render_stuff(*args):
 @reactive.when('first-render')
 @reactive.when_not('db.synced')
 def run_db_migration():
-    with charm.provide_charm_instance() as barbican_charm:
-        barbican_charm.db_sync()
-        barbican_charm.restart_all()
+    with charm.provide_charm_instance() as barbican_charm, \
+            barbican_charm.timed('run_db_migration'):
+        with barbican_charm.timed('db_sync'):
+            synced = barbican_charm.db_sync()
+        if synced:
+            with barbican_charm.timed('restart_all'):
+                barbican_charm.restart_all()
         reactive.set_state('db.synced')
         barbican_charm.assess_status()
 
 
+@reactive.when('leadership.is_leader')
+@reactive.when_not('leadership.set.simple-crypto-kek')
+def generate_software_store_kek():
+    """Generate the KEK of the software secret store as the leader."""
+    with charm.provide_charm_instance() as barbican_charm:
+        barbican_charm.generate_software_store_kek()
+
+
+@reactive.hook('update-status')
+def refresh_project_count():
+    """Recount the projects for the project KEK cache sizing; render_stuff
+    then picks up a changed count."""
+    with charm.provide_charm_instance() as barbican_charm, \
+            barbican_charm.timed('refresh_project_count'):
+        barbican_charm.refresh_project_count()
+
+
+@reactive.when('shared-db-replica.connected')
+def setup_replica_database(database):
+    """Ask for the same database and user on the read-replica relation as
+    on shared-db."""
+    with charm.provide_charm_instance() as barbican_charm:
+        for db in barbican_charm.get_database_setup():
+            database.configure(**db)
+
+
 @reactive.when('secrets.new-plugin')
 def secrets_plugin_configure():
     hookenv.log('Received information about secrets plugin',
@@ -86,6 +134,23 @@ def secrets_plugin_configure():
     reactive.set_flag('config.changed')
 
 
+@reactive.when('cluster.available')
+def coordinate_restarts(*args):
+    """Hand out rolling restart slots as the leader, and carry out this
+    unit's deferred restart once it has been granted one.
+    """
+    with charm.provide_charm_instance() as barbican_charm, \
+            barbican_charm.timed('coordinate_restarts'):
+        is_leader = reactive.is_flag_set('leadership.is_leader')
+        if is_leader:
+            barbican_charm.grant_restart_slots()
+        if barbican_charm.run_pending_restart():
+            if is_leader:
+                # pass the leader's own slot on straight away
+                barbican_charm.grant_restart_slots()
+            barbican_charm.assess_status()
+
+
 @reactive.when('ha.connected')
 @reactive.when_not('ha.available')
 def cluster_connected(hacluster):
@@ -0,0 +1,243 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-project admission control for the Barbican API.
+
+This module is installed by the barbican charm (it is rendered like the
+other configuration files, so a change to it restarts the API) and is used
+as the 'ratelimit' filter in barbican-api-paste.ini, after authtoken so that
+the project of each request is known:
+
+    [filter:ratelimit]
+    paste.filter_factory = barbican_charm_ratelimit:filter_factory
+    project_rate = 5.0
+    project_burst = 10
+    global_rate = 0
+    global_burst = 0
+    project_concurrency = 0
+    global_concurrency = 0
+    stats_dir = /var/lib/barbican/ratelimit
+
+Rates are in requests per second and are enforced with token buckets that
+hold up to 'burst' requests; concurrency limits cap the requests in
+progress.  0 disables a limit.  All of the limits apply to each API process
+on its own.  A request over a limit gets a 429 with a Retry-After header.
+
+Each process periodically writes its counters to <stats_dir>/<pid>.json.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+
+STATS_INTERVAL = 10
+# the buckets of projects idle for this long are forgotten
+IDLE_BUCKET_SECONDS = 300
+
+
+class TokenBucket(object):
+    """Allow 'rate' requests per second with bursts of up to 'burst'."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.stamp = now
+        self.last_used = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self):
+        """Seconds until a token is available, 0 if there is one now."""
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def full(self):
+        return self.tokens >= self.capacity
+
+
+class _Release(object):
+    """Wrap a response iterable so the concurrency slot is given back once
+    the server has finished with the response."""
+
+    def __init__(self, iterable, release):
+        self.iterable = iterable
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.release()
+
+
+class RateLimitMiddleware(object):
+
+    def __init__(self, app, conf):
+        self.app = app
+        self.project_rate = float(conf.get('project_rate', 0))
+        self.project_burst = int(conf.get('project_burst', 0))
+        self.global_rate = float(conf.get('global_rate', 0))
+        self.global_burst = int(conf.get('global_burst', 0))
+        self.project_concurrency = int(conf.get('project_concurrency', 0))
+        self.global_concurrency = int(conf.get('global_concurrency', 0))
+        self.stats_dir = conf.get('stats_dir')
+        self.lock = threading.Lock()
+        now = time.monotonic()
+        self.global_bucket = None
+        if self.global_rate:
+            self.global_bucket = TokenBucket(self.global_rate,
+                                             self.global_burst, now)
+        self.buckets = {}
+        self.in_flight = {}
+        self.global_in_flight = 0
+        self.stats = {'allowed': 0, 'rejected-rate': 0,
+                      'rejected-concurrency': 0}
+        self.project_stats = {}
+        self.last_stats = now
+
+    def _project_bucket(self, project, now):
+        bucket = self.buckets.get(project)
+        if bucket is None:
+            bucket = TokenBucket(self.project_rate, self.project_burst, now)
+            self.buckets[project] = bucket
+        return bucket
+
+    def _count(self, project, outcome):
+        self.stats[outcome] += 1
+        if project:
+            counters = self.project_stats.setdefault(
+                project, {'allowed': 0, 'rejected-rate': 0,
+                          'rejected-concurrency': 0})
+            counters[outcome] += 1
+
+    def admit(self, project, now):
+        """Decide whether a request is admitted.
+
+        :returns: (outcome, retry_after) where outcome is 'allowed',
+                  'rejected-rate' or 'rejected-concurrency'
+        """
+        with self.lock:
+            if (self.global_concurrency and
+                    self.global_in_flight >= self.global_concurrency):
+                outcome, retry_after = 'rejected-concurrency', 1
+            elif (project and self.project_concurrency and
+                    self.in_flight.get(project, 0) >=
+                    self.project_concurrency):
+                outcome, retry_after = 'rejected-concurrency', 1
+            else:
+                buckets = []
+                if self.global_bucket:
+                    buckets.append(self.global_bucket)
+                if project and self.project_rate:
+                    buckets.append(self._project_bucket(project, now))
+                for bucket in buckets:
+                    bucket.refill(now)
+                    bucket.last_used = now
+                wait = max([b.wait() for b in buckets] or [0])
+                if wait:
+                    outcome, retry_after = 'rejected-rate', wait
+                else:
+                    for bucket in buckets:
+                        bucket.tokens -= 1
+                    self.global_in_flight += 1
+                    if project:
+                        self.in_flight[project] = (
+                            self.in_flight.get(project, 0) + 1)
+                    outcome, retry_after = 'allowed', 0
+            self._count(project, outcome)
+        self.maybe_write_stats(now)
+        return outcome, int(math.ceil(retry_after))
+
+    def release(self, project):
+        with self.lock:
+            self.global_in_flight -= 1
+            if project:
+                self.in_flight[project] -= 1
+                if not self.in_flight[project]:
+                    del self.in_flight[project]
+
+    def maybe_write_stats(self, now):
+        """Write the counters every STATS_INTERVAL seconds, and forget the
+        buckets of projects that have gone quiet."""
+        with self.lock:
+            if now - self.last_stats < STATS_INTERVAL:
+                return
+            self.last_stats = now
+            for project, bucket in list(self.buckets.items()):
+                bucket.refill(now)
+                if (bucket.full() and
+                        now - bucket.last_used >= IDLE_BUCKET_SECONDS and
+                        project not in self.in_flight):
+                    del self.buckets[project]
+            snapshot = {
+                'pid': os.getpid(),
+                'time': time.time(),
+                'totals': dict(self.stats),
+                'projects': {p: dict(c)
+                             for p, c in self.project_stats.items()},
+                'in-flight': self.global_in_flight,
+            }
+        if not self.stats_dir:
+            return
+        try:
+            os.makedirs(self.stats_dir, exist_ok=True)
+            path = os.path.join(self.stats_dir, '{}.json'.format(os.getpid()))
+            with open(path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(path + '.tmp', path)
+        except OSError:
+            pass
+
+    def __call__(self, environ, start_response):
+        project = environ.get('HTTP_X_PROJECT_ID')
+        outcome, retry_after = self.admit(project, time.monotonic())
+        if outcome != 'allowed':
+            body = json.dumps({
+                'code': 429,
+                'title': 'Too Many Requests',
+                'description': 'Request limit exceeded, retry after {}s'
+                               .format(retry_after),
+            }).encode('utf-8')
+            start_response('429 Too Many Requests', [
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(body))),
+                ('Retry-After', str(retry_after)),
+            ])
+            return [body]
+        try:
+            response = self.app(environ, start_response)
+        except Exception:
+            self.release(project)
+            raise
+        return _Release(response, lambda: self.release(project))
+
+
+def filter_factory(global_conf, **local_conf):
+    conf = dict(global_conf)
+    conf.update(local_conf)
+
+    def _filter(app):
+        return RateLimitMiddleware(app, conf)
+    return _filter
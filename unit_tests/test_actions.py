@@ -0,0 +1,74 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import textwrap
+import unittest
+from unittest import mock
+
+sys.path.append('src/actions')
+
+import actions  # noqa
+
+
+class TestActions(unittest.TestCase):
+
+    def setUp(self):
+        self.basic = mock.MagicMock()
+        layer = mock.MagicMock(basic=self.basic)
+        patcher = mock.patch.dict(sys.modules, {
+            'charms.layer': layer, 'charms.layer.basic': self.basic})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_import_is_lazy(self):
+        # importing the actions, as every action does before dispatching,
+        # doesn't even try to import any of the charm's dependencies.  The
+        # attempts are recorded by a finder ahead of the real ones, so this
+        # holds whether or not the dependencies are installed.
+        code = textwrap.dedent("""
+            import sys
+
+            class Recorder(object):
+                def find_spec(self, name, path=None, target=None):
+                    print(name)
+
+            sys.meta_path.insert(0, Recorder())
+            sys.path[:0] = ['src/actions', 'src/lib']
+            import actions
+            """)
+        attempted = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            universal_newlines=True).split()
+        self.assertIn('actions', attempted)
+        for module in ('charms', 'charmhelpers', 'charms_openstack', 'charm',
+                       'psutil', 'yaml'):
+            self.assertNotIn(module, attempted)
+
+    def test_start(self):
+        actions.start('provision-hsm-keys')
+        self.basic.bootstrap_charm_deps.assert_called_once_with()
+        self.basic.init_config_states.assert_called_once_with()
+
+    def test_start_stateless(self):
+        actions.start('hook-stats')
+        self.basic.bootstrap_charm_deps.assert_called_once_with()
+        self.basic.init_config_states.assert_not_called()
+
+    def test_main_unknown(self):
+        self.assertEqual(actions.main(['foo']), 'Action foo undefined')
+        self.basic.bootstrap_charm_deps.assert_not_called()
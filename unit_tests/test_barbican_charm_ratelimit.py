@@ -0,0 +1,126 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# The filter is shipped as a template and rendered onto the API's python-path
+_spec = importlib.util.spec_from_file_location(
+    'barbican_charm_ratelimit',
+    'src/templates/rocky/barbican_charm_ratelimit.py')
+ratelimit = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ratelimit)
+
+
+class FakeApp(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.closed = 0
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        start_response('200 OK', [])
+        app = self
+
+        class Body(list):
+            def close(self):
+                app.closed += 1
+        return Body([b'ok'])
+
+
+class TestRateLimitMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeApp()
+        self.stats_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.stats_dir)
+
+    def _middleware(self, **conf):
+        conf.setdefault('stats_dir', self.stats_dir)
+        return ratelimit.filter_factory({}, **conf)(self.app)
+
+    def _request(self, middleware, project='p1'):
+        status = []
+        environ = {'HTTP_X_PROJECT_ID': project} if project else {}
+        body = middleware(environ, lambda s, h: status.append((s, dict(h))))
+        return status[0], body
+
+    def test_project_rate(self):
+        middleware = self._middleware(project_rate='1', project_burst='2')
+        (status, _), body = self._request(middleware)
+        self.assertEqual(status, '200 OK')
+        body.close()
+        self.assertEqual(self._request(middleware)[0][0], '200 OK')
+        (status, headers), body = self._request(middleware)
+        self.assertEqual(status, '429 Too Many Requests')
+        self.assertEqual(headers['Retry-After'], '1')
+        self.assertEqual(json.loads(body[0].decode('utf-8'))['code'], 429)
+        # another project has its own bucket
+        self.assertEqual(self._request(middleware, 'p2')[0][0], '200 OK')
+        self.assertEqual(self.app.calls, 3)
+        self.assertEqual(middleware.stats, {
+            'allowed': 3, 'rejected-rate': 1, 'rejected-concurrency': 0})
+        self.assertEqual(middleware.project_stats['p1']['rejected-rate'], 1)
+
+    def test_global_rate(self):
+        middleware = self._middleware(global_rate='1', global_burst='1')
+        self.assertEqual(self._request(middleware, 'p1')[0][0], '200 OK')
+        self.assertEqual(self._request(middleware, 'p2')[0][0],
+                         '429 Too Many Requests')
+
+    def test_refill(self):
+        middleware = self._middleware(project_rate='2', project_burst='1')
+        self.assertEqual(middleware.admit('p1', 100.0), ('allowed', 0))
+        self.assertEqual(middleware.admit('p1', 100.1),
+                         ('rejected-rate', 1))
+        self.assertEqual(middleware.admit('p1', 100.6), ('allowed', 0))
+
+    def test_concurrency(self):
+        middleware = self._middleware(project_concurrency='1')
+        _, body = self._request(middleware)
+        self.assertEqual(self._request(middleware)[0][0],
+                         '429 Too Many Requests')
+        self.assertEqual(self._request(middleware, 'p2')[0][0], '200 OK')
+        # the slot is given back once the response is closed
+        body.close()
+        self.assertEqual(self.app.closed, 1)
+        self.assertEqual(self._request(middleware)[0][0], '200 OK')
+        self.assertEqual(middleware.stats['rejected-concurrency'], 1)
+
+    def test_unlimited(self):
+        middleware = self._middleware()
+        for _ in range(50):
+            self.assertEqual(self._request(middleware, None)[0][0],
+                             '200 OK')
+
+    def test_write_stats(self):
+        middleware = self._middleware(project_rate='1', project_burst='1')
+        middleware.last_stats = 0
+        middleware.admit('p1', 0)
+        middleware.maybe_write_stats(ratelimit.STATS_INTERVAL + 1)
+        path = os.path.join(self.stats_dir, '{}.json'.format(os.getpid()))
+        with open(path) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['totals']['allowed'], 1)
+        self.assertEqual(stats['projects']['p1']['allowed'], 1)
+        # idle projects' buckets are forgotten, their counters aren't
+        middleware.release('p1')
+        middleware.maybe_write_stats(ratelimit.IDLE_BUCKET_SECONDS + 20)
+        self.assertEqual(middleware.buckets, {})
+        self.assertIn('p1', middleware.project_stats)
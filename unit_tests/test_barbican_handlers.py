@@ -31,12 +31,18 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
             'update-status',
             'certificates.available']
         hook_set = {
+            'hook': {
+                'refresh_project_count': ('update-status',),
+            },
             'when': {
                 'render_stuff': ('shared-db.available',
                                  'identity-service.available',
                                  'amqp.available',),
                 'secrets_plugin_configure': ('secrets.new-plugin',),
+                'setup_replica_database': ('shared-db-replica.connected',),
                 'cluster_connected': ('ha.connected',),
+                'coordinate_restarts': ('cluster.available',),
+                'generate_software_store_kek': ('leadership.is_leader',),
                 'run_db_migration': ('leadership.is_leader',
                                      'charm.installed',
                                      'shared-db.available',
@@ -44,6 +50,8 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
             },
             'when_not': {
                 'cluster_connected': ('ha.available',),
+                'generate_software_store_kek': (
+                    'leadership.set.simple-crypto-kek',),
                 'run_db_migration': ('db.synced',),
             },
         }
@@ -64,18 +72,58 @@ class TestBarbicanHandlers(test_utils.PatchHelper):
 
         def _optional_interfaces(args, *interfaces):
             self.assertEqual(interfaces, ('hsm.available',
-                                          'secrets.available', ))
+                                          'secrets.available',
+                                          'shared-db-replica.available', ))
             return args + ('hsm', )
 
         self.optional_interfaces.side_effect = _optional_interfaces
+        barbican_charm.render_fingerprint.return_value = 'fp'
+        barbican_charm.render_is_current.return_value = False
 
         handlers.render_stuff('arg1', 'arg2')
+        barbican_charm.render_fingerprint.assert_called_once_with(
+            ('arg1', 'arg2', 'hsm'))
+        barbican_charm.render_is_current.assert_called_once_with('fp')
         barbican_charm.render_with_interfaces.assert_called_once_with(
             ('arg1', 'arg2', 'hsm'))
+        barbican_charm.configure_retry_scheduler.assert_called_once_with()
         barbican_charm.configure_ssl.assert_called_once_with()
         barbican_charm.upgrade_if_available.assert_called_once_with(
             ('arg1', 'arg2'))
         barbican_charm.assess_status.assert_called_once_with()
+        barbican_charm.record_render.assert_called_once_with('fp')
+
+    def test_render_stuff_unchanged(self):
+        barbican_charm = mock.MagicMock()
+        self.patch_object(handlers.charm, 'provide_charm_instance',
+                          new=mock.MagicMock())
+        self.provide_charm_instance().__enter__.return_value = barbican_charm
+        self.provide_charm_instance().__exit__.return_value = None
+        self.patch_object(handlers.charm, 'optional_interfaces')
+        self.patch_object(handlers.reactive, 'set_flag')
+        barbican_charm.render_is_current.return_value = True
+
+        handlers.render_stuff('arg1', 'arg2')
+        barbican_charm.render_with_interfaces.assert_not_called()
+        barbican_charm.configure_retry_scheduler.assert_not_called()
+        barbican_charm.configure_ssl.assert_not_called()
+        barbican_charm.upgrade_if_available.assert_not_called()
+        barbican_charm.assess_status.assert_not_called()
+        barbican_charm.record_render.assert_not_called()
+        self.set_flag.assert_called_once_with('first-render')
+
+    def test_setup_replica_database(self):
+        database = mock.MagicMock()
+        barbican_charm = mock.MagicMock()
+        barbican_charm.get_database_setup.return_value = [
+            {'database': 'barbican', 'username': 'barbican'}]
+        self.patch_object(handlers.charm, 'provide_charm_instance',
+                          new=mock.MagicMock())
+        self.provide_charm_instance().__enter__.return_value = barbican_charm
+        self.provide_charm_instance().__exit__.return_value = None
+        handlers.setup_replica_database(database)
+        database.configure.assert_called_once_with(
+            database='barbican', username='barbican')
 
     def test_secrets_plugin_configure(self):
         self.patch_object(handlers.reactive, 'clear_flag')
@@ -87,6 +135,15 @@ class TestBarbicanHandlers(test_utils.PatchHelper):
             mock.call('config.changed'),
         ])
 
+    def test_refresh_project_count(self):
+        barbican_charm = mock.MagicMock()
+        self.patch_object(handlers.charm, 'provide_charm_instance',
+                          new=mock.MagicMock())
+        self.provide_charm_instance().__enter__.return_value = barbican_charm
+        self.provide_charm_instance().__exit__.return_value = None
+        handlers.refresh_project_count()
+        barbican_charm.refresh_project_count.assert_called_once_with()
+
     def test_cluster_connected(self):
         hacluster = mock.MagicMock()
         barbican_charm = mock.MagicMock()
@@ -98,3 +155,37 @@ class TestBarbicanHandlers(test_utils.PatchHelper):
         barbican_charm.configure_ha_resources.assert_called_once_with(
             hacluster)
         barbican_charm.assess_status.assert_called_once_with()
+
+    def test_coordinate_restarts(self):
+        barbican_charm = mock.MagicMock()
+        self.patch_object(handlers.charm, 'provide_charm_instance',
+                          new=mock.MagicMock())
+        self.provide_charm_instance().__enter__.return_value = barbican_charm
+        self.provide_charm_instance().__exit__.return_value = None
+        self.patch_object(handlers.reactive, 'is_flag_set',
+                          return_value=False)
+        barbican_charm.run_pending_restart.return_value = False
+        handlers.coordinate_restarts('cluster')
+        barbican_charm.grant_restart_slots.assert_not_called()
+        barbican_charm.assess_status.assert_not_called()
+        # the leader grants slots before and after its own restart
+        self.is_flag_set.return_value = True
+        barbican_charm.run_pending_restart.return_value = True
+        handlers.coordinate_restarts('cluster')
+        self.assertEqual(barbican_charm.grant_restart_slots.call_count, 2)
+        barbican_charm.assess_status.assert_called_once_with()
+
+    def test_run_db_migration(self):
+        barbican_charm = mock.MagicMock()
+        self.patch_object(handlers.charm, 'provide_charm_instance',
+                          new=mock.MagicMock())
+        self.provide_charm_instance().__enter__.return_value = barbican_charm
+        self.provide_charm_instance().__exit__.return_value = None
+        self.patch_object(handlers.reactive, 'set_state')
+        barbican_charm.db_sync.return_value = False
+        handlers.run_db_migration()
+        barbican_charm.restart_all.assert_not_called()
+        self.set_state.assert_called_once_with('db.synced')
+        barbican_charm.db_sync.return_value = True
+        handlers.run_db_migration()
+        barbican_charm.restart_all.assert_called_once_with()
@@ -12,11 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
 from unittest import mock
 
 import charms_openstack.test_utils as test_utils
 
 import charm.openstack.barbican as barbican
+import charm.openstack.restarts as restarts
 
 
 class Helper(test_utils.PatchHelper):
@@ -36,6 +40,7 @@ class TestHSMProperties(Helper):
             'login': 'a-login',
             'slot_id': 'a-slot_id',
         }
+        self.patch_object(barbican.hookenv, 'relation_ids', return_value=[])
 
     def test_library_path(self):
         hsm = mock.MagicMock()
@@ -58,6 +63,31 @@ class TestHSMProperties(Helper):
         hsm.relation.plugin_data = self.data_set
         self.assertEqual(barbican.slot_id(hsm), 'a-slot_id')
 
+    def _relate_hsms(self, *slots):
+        self.relation_ids.return_value = ['hsm:4']
+        self.patch_object(barbican.hookenv, 'related_units',
+                          return_value=['hsm/{}'.format(i)
+                                        for i in range(len(slots))])
+        self.patch_object(barbican.hookenv, 'relation_get')
+        self.relation_get.side_effect = (
+            lambda key, rid, unit: barbican.json.dumps(
+                slots[int(unit.split('/')[1])]))
+
+    def test_multiple_slots(self):
+        hsm = mock.MagicMock()
+        slot1 = {'library_path': 'p', 'login': 'l1', 'slot_id': '1',
+                 'token_label': 'part1'}
+        slot2 = {'library_path': 'p', 'login': 'l2', 'slot_id': '2',
+                 'token_label': 'part2'}
+        self._relate_hsms(slot1, slot2)
+        self.assertEqual(barbican.slot_id(hsm), '1')
+        self.assertEqual(barbican.login(hsm), 'l1')
+        self.assertEqual(barbican.token_labels(hsm), 'part1, part2')
+        # no labels, nothing to fail over between
+        del slot1['token_label']
+        del slot2['token_label']
+        self.assertEqual(barbican.token_labels(hsm), '')
+
 
 class TestSecretsProperties(Helper):
 
@@ -95,7 +125,8 @@ class TestBarbicanCharm(Helper):
             return config
 
         self.config.side_effect = cf
-        self.patch_object(barbican.subprocess, 'check_call')
+        self.patch_object(barbican.subprocess, 'run', return_value=(
+            barbican.subprocess.CompletedProcess([], 0, '', '')))
         self.patch_object(barbican.hookenv, 'log')
         # try generating a an mkek with no failure
         c = barbican.BarbicanCharm()
@@ -103,20 +134,23 @@ class TestBarbicanCharm(Helper):
         cmd = [
             'barbican-manage', 'hsm', 'gen_mkek',
             '--library-path', 'path1',
-            '--passphrase', '1234',
             '--slot-id', 'slot1',
-            '--length', '5',
             '--label', 'the-label',
+            '--length', '5',
         ]
-        self.check_call.assert_called_once_with(cmd)
+        self.run.assert_called_once_with(
+            cmd, env=mock.ANY, stdout=barbican.subprocess.PIPE,
+            stderr=barbican.subprocess.PIPE, universal_newlines=True,
+            timeout=None)
+        # the login is passed in the environment, not on the command line
+        self.assertEqual(
+            self.run.call_args[1]['env'][barbican.hsm_slots.HSM_LOGIN_ENV],
+            '1234')
         self.log.assert_called_once_with(
             "barbican-mangage hsm gen_mkek succeeded")
         # and check that a problem is logged if it goes wrong
-
-        def side_effect():
-            raise barbican.subprocess.CalledProcessError
-
-        self.check_call.side_effect = side_effect
+        self.run.return_value = barbican.subprocess.CompletedProcess(
+            [], 1, '', 'failed')
         self.log.reset_mock()
         with self.assertRaises(Exception):
             c.action_generate_mkek(hsm)
@@ -142,7 +176,8 @@ class TestBarbicanCharm(Helper):
             return config
 
         self.config.side_effect = cf
-        self.patch_object(barbican.subprocess, 'check_call')
+        self.patch_object(barbican.subprocess, 'run', return_value=(
+            barbican.subprocess.CompletedProcess([], 0, '', '')))
         self.patch_object(barbican.hookenv, 'log')
         # try generating a an hmac with no failure
         c = barbican.BarbicanCharm()
@@ -150,22 +185,1482 @@ class TestBarbicanCharm(Helper):
         cmd = [
             'barbican-manage', 'hsm', 'gen_hmac',
             '--library-path', 'path1',
-            '--passphrase', '1234',
             '--slot-id', 'slot1',
-            '--length', '5',
             '--label', 'the-label',
+            '--length', '5',
         ]
-        self.check_call.assert_called_once_with(cmd)
+        self.run.assert_called_once_with(
+            cmd, env=mock.ANY, stdout=barbican.subprocess.PIPE,
+            stderr=barbican.subprocess.PIPE, universal_newlines=True,
+            timeout=None)
+        # the login is passed in the environment, not on the command line
+        self.assertEqual(
+            self.run.call_args[1]['env'][barbican.hsm_slots.HSM_LOGIN_ENV],
+            '1234')
         self.log.assert_called_once_with(
             "barbican-mangage hsm gen_hmac succeeded")
+        # the keys are only generated on the primary slot
+        self.run.reset_mock()
+        self.patch_object(barbican.hsm_slots, 'plugin_data', return_value=[
+            hsm.plugin_data, dict(hsm.plugin_data, slot_id='slot2')])
+        c.action_generate_hmac(hsm)
+        self.assertEqual(self.run.call_count, 1)
+        self.assertEqual(self.run.call_args[0][0][6], 'slot1')
         # and check that a problem is logged if it goes wrong
-
-        def side_effect():
-            raise barbican.subprocess.CalledProcessError
-
-        self.check_call.side_effect = side_effect
+        self.run.return_value = barbican.subprocess.CompletedProcess(
+            [], 1, '', 'failed')
         self.log.reset_mock()
         with self.assertRaises(Exception):
             c.action_generate_hmac(hsm)
             self.log.assert_called_once_with(
                 "barbican-manage hsm gen_hmac failed.")
+
+    def _patch_config(self, config):
+        self.patch_object(barbican.hookenv, 'config')
+
+        def cf(key=None):
+            if key is not None:
+                return config.get(key)
+            return config
+
+        self.config.side_effect = cf
+
+    def test_wsgi_process_model(self):
+        self._patch_config({
+            'wsgi-threads': 8,
+            'wsgi-listen-backlog': 200,
+            'wsgi-queue-timeout': 30,
+        })
+        kv = mock.MagicMock()
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        c = barbican.BarbicanCharm()
+        model = c.wsgi_process_model({'processes': 3})
+        self.assertEqual(model, {
+            'processes': 3,
+            'threads': 8,
+            'admin_mode': 'separate',
+            'admin_processes': 3,
+            'listen_backlog': 200,
+            'queue_timeout': 30,
+            'request_timeout': None,
+            'maximum_requests': None,
+        })
+        kv.set.assert_called_once_with(
+            barbican.WSGI_PROCESS_MODEL_KEY, model)
+
+    def test_wsgi_process_model_auto_size(self):
+        self._patch_config({'wsgi-auto-size': True, 'wsgi-threads': 1})
+        self.patch_object(barbican.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        self.patch_object(barbican.os, 'cpu_count', return_value=8)
+        self.patch_object(barbican.psutil, 'virtual_memory',
+                          return_value=mock.MagicMock())
+        # plenty of memory: one process per CPU, 4 requests per CPU
+        self.virtual_memory.return_value.total = 64 * 1024 ** 3
+        model = barbican.BarbicanCharm().wsgi_process_model()
+        self.assertEqual((model['processes'], model['threads']), (8, 4))
+        # 2GiB allows 8 processes, half of them for the separate admin
+        # vhost, and threads make up the concurrency
+        self.virtual_memory.return_value.total = 2 * 1024 ** 3
+        model = barbican.BarbicanCharm().wsgi_process_model()
+        self.assertEqual((model['processes'], model['threads']), (4, 8))
+        self.assertEqual(model['admin_processes'], 4)
+        # a shared admin vhost leaves all 8 to the public one
+        self._patch_config({'wsgi-auto-size': True, 'wsgi-threads': 1,
+                            'wsgi-admin-mode': 'shared'})
+        model = barbican.BarbicanCharm().wsgi_process_model()
+        self.assertEqual((model['processes'], model['threads']), (8, 4))
+        # and dedicated admin processes take theirs out of the budget
+        self._patch_config({'wsgi-auto-size': True, 'wsgi-threads': 1,
+                            'wsgi-admin-mode': 'dedicated',
+                            'wsgi-admin-processes': 2})
+        model = barbican.BarbicanCharm().wsgi_process_model()
+        self.assertEqual((model['processes'], model['threads']), (6, 6))
+        self.assertEqual(model['admin_processes'], 2)
+        # threads are capped
+        self.virtual_memory.return_value.total = 128 * 1024 ** 2
+        model = barbican.BarbicanCharm().wsgi_process_model()
+        self.assertEqual((model['processes'], model['threads']), (1, 16))
+
+    def test_wsgi_admin_modes_memory_footprint(self):
+        config = {'wsgi-threads': 4, 'wsgi-admin-processes': 1}
+        self._patch_config(config)
+        self.patch_object(barbican.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        c = barbican.BarbicanCharm()
+        rss = barbican.WSGI_PROCESS_RSS_MB
+        footprint = {}
+        for mode in barbican.WSGI_ADMIN_MODES:
+            config['wsgi-admin-mode'] = mode
+            model = c.wsgi_process_model({'processes': 8})
+            # every daemon process holds a loaded copy of the API
+            footprint[mode] = (
+                model['processes'] + model['admin_processes']) * rss
+        # 8 public + 8 admin processes
+        self.assertEqual(footprint['separate'], 16 * rss)
+        # the admin vhost is served by the 8 public processes
+        self.assertEqual(footprint['shared'], 8 * rss)
+        # 8 public + 1 admin process
+        self.assertEqual(footprint['dedicated'], 9 * rss)
+
+    def test_custom_assess_status_check(self):
+        self._patch_config({'wsgi-admin-mode': 'shared'})
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self._patch_config({'wsgi-admin-mode': 'bogus'})
+        self.assertEqual(c.custom_assess_status_check()[0], 'blocked')
+
+    def test_custom_assess_status_check_secret_store(self):
+        kek = 'MDEyMzQ1Njc4OWFiY2RlZjAxMjM0NTY3ODlhYmNkZWY='
+        self.patch_object(barbican.hookenv, 'relation_ids', return_value=[])
+        self.patch_object(barbican.hookenv, 'leader_get', return_value=None)
+        self.patch_object(barbican.reactive, 'endpoint_from_flag',
+                          return_value=mock.MagicMock())
+        self.endpoint_from_flag.return_value.plugins = [
+            {'name': 'vault', 'data': {}}]
+        c = barbican.BarbicanCharm()
+        # the software store waits for the leader's KEK
+        self._patch_config({'enable-multiple-secret-stores': True,
+                            'default-secret-store': 'software'})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "Multiple secret stores need a software store KEK, "
+                        "waiting for the leader to generate one"))
+        self.leader_get.return_value = kek
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self._patch_config({'enable-multiple-secret-stores': True,
+                            'simple-crypto-kek': 'c2hvcnQ='})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked',
+             "simple-crypto-kek must be a base64 encoded 32 byte key"))
+        self._patch_config({'enable-multiple-secret-stores': True,
+                            'default-secret-store': 'hsm'})
+        self.assertEqual(c.custom_assess_status_check()[0], 'blocked')
+        self.relation_ids.assert_called_with('hsm')
+        self._patch_config({'enable-multiple-secret-stores': True,
+                            'default-secret-store': 'vault'})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked',
+             "default-secret-store 'vault' requires a secrets relation"))
+        self.relation_ids.return_value = ['secrets:7']
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self.endpoint_from_flag.assert_called_with('secrets.available')
+        # the store must be one of the plugins on the relation
+        self._patch_config({'enable-multiple-secret-stores': True,
+                            'default-secret-store': 'kmip'})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "default-secret-store 'kmip' is not a plugin on the "
+                        "secrets relation"))
+        # the default is ignored unless multiple stores are enabled
+        self.relation_ids.return_value = []
+        self._patch_config({'default-secret-store': 'hsm'})
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_software_store_kek(self):
+        kek = 'MDEyMzQ1Njc4OWFiY2RlZjAxMjM0NTY3ODlhYmNkZWY='
+        self.patch_object(barbican.hookenv, 'leader_get', return_value=None)
+        c = barbican.BarbicanCharm()
+        self._patch_config({})
+        self.assertIsNone(c.software_store_kek())
+        self.leader_get.return_value = kek
+        self.assertEqual(c.software_store_kek(), kek)
+        self.leader_get.assert_called_with('simple-crypto-kek')
+        # the option takes precedence over the generated KEK
+        configured = 'ZmVkY2JhOTg3NjU0MzIxMGZlZGNiYTk4NzY1NDMyMTA='
+        self._patch_config({'simple-crypto-kek': configured})
+        self.assertEqual(c.software_store_kek(), configured)
+        self._patch_config({'simple-crypto-kek': 'not a key'})
+        self.assertIsNone(c.software_store_kek())
+
+    def test_generate_software_store_kek(self):
+        self.patch_object(barbican.hookenv, 'is_leader', return_value=False)
+        self.patch_object(barbican.hookenv, 'leader_get', return_value=None)
+        self.patch_object(barbican.hookenv, 'leader_set')
+        barbican.BarbicanCharm.generate_software_store_kek()
+        self.leader_set.assert_not_called()
+        self.is_leader.return_value = True
+        barbican.BarbicanCharm.generate_software_store_kek()
+        kek = self.leader_set.call_args[0][0]['simple-crypto-kek']
+        self.assertTrue(barbican.BarbicanCharm._valid_kek(kek))
+        # an existing KEK is never replaced
+        self.leader_set.reset_mock()
+        self.leader_get.return_value = kek
+        barbican.BarbicanCharm.generate_software_store_kek()
+        self.leader_set.assert_not_called()
+
+    def test_custom_assess_status_last_check(self):
+        store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = store.get
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        self.patch_object(barbican.hookenv, 'relation_ids', return_value=[])
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.custom_assess_status_last_check(), (None, None))
+        store[barbican.WSGI_PROCESS_MODEL_KEY] = {
+            'processes': 2, 'threads': 4, 'admin_mode': 'separate'}
+        self.assertEqual(
+            c.custom_assess_status_last_check(),
+            ('active', 'Unit is ready (wsgi: 2 processes x 4 threads)'))
+        store[barbican.WSGI_PROCESS_MODEL_KEY] = {
+            'processes': 2, 'threads': 4, 'admin_mode': 'dedicated',
+            'admin_processes': 1}
+        self.assertEqual(
+            c.custom_assess_status_last_check(),
+            ('active', 'Unit is ready (wsgi: 2 processes x 4 threads, '
+                       'admin 1 processes)'))
+        # the pkek cache is only reported with an HSM related
+        store[barbican.PKEK_CACHE_KEY] = {'limit': 125, 'projects': 100}
+        self.assertNotIn('pkek', c.custom_assess_status_last_check()[1])
+        self.relation_ids.return_value = ['hsm:4']
+        self.assertEqual(
+            c.custom_assess_status_last_check(),
+            ('active', 'Unit is ready (wsgi: 2 processes x 4 threads, '
+                       'admin 1 processes; pkek cache: 125 for 100 '
+                       'projects)'))
+
+    def test_render_fingerprint(self):
+        config = {'debug': False}
+        self._patch_config(config)
+        relation_data = {'shared-db:1:mysql/0': {'password': 'a'},
+                         'cluster:2:barbican/1': {'private-address': 'x'}}
+        self.patch_object(barbican.hookenv, 'relation_types',
+                          return_value=['shared-db', 'cluster'])
+        self.patch_object(barbican.hookenv, 'relation_ids')
+        self.relation_ids.side_effect = lambda name: {
+            'shared-db': ['shared-db:1'], 'cluster': ['cluster:2']}[name]
+        self.patch_object(barbican.hookenv, 'related_units')
+        self.related_units.side_effect = lambda rid: {
+            'shared-db:1': ['mysql/0'], 'cluster:2': ['barbican/1']}[rid]
+        self.patch_object(barbican.hookenv, 'relation_get')
+        self.relation_get.side_effect = (
+            lambda rid, unit: relation_data['{}:{}'.format(rid, unit)])
+        flags = ['ssl.enabled', 'config.changed']
+        self.patch_object(barbican.reactive, 'get_flags')
+        self.get_flags.side_effect = lambda: list(flags)
+        self.patch_object(barbican.hookenv, 'unit_get',
+                          return_value='10.0.0.1')
+        self.patch_object(barbican.BarbicanCharm, '_charm_digest',
+                          return_value='digest')
+        self.patch_object(barbican.api_profiling, 'is_active',
+                          return_value=False)
+        c = barbican.BarbicanCharm()
+        fingerprint = c.render_fingerprint(['amqp'])
+        self.assertEqual(c.render_fingerprint(['amqp']), fingerprint)
+        # an extra interface, relation data or option all change it
+        self.assertNotEqual(c.render_fingerprint(['amqp', 'hsm']),
+                            fingerprint)
+        relation_data['shared-db:1:mysql/0']['password'] = 'b'
+        changed = c.render_fingerprint(['amqp'])
+        self.assertNotEqual(changed, fingerprint)
+        config['debug'] = True
+        self.assertNotEqual(c.render_fingerprint(['amqp']), changed)
+        changed = c.render_fingerprint(['amqp'])
+        # a peer asking for or finishing a rolling restart doesn't
+        relation_data['cluster:2:barbican/1'].update({
+            restarts.RESTART_REQUEST_KEY: 'nonce',
+            restarts.RESTART_DONE_KEY: 'nonce'})
+        self.assertEqual(c.render_fingerprint(['amqp']), changed)
+        relation_data['cluster:2:barbican/1']['private-address'] = 'y'
+        self.assertNotEqual(c.render_fingerprint(['amqp']), changed)
+        changed = c.render_fingerprint(['amqp'])
+        # a flag does, unless it only marks a change in this hook
+        flags.remove('config.changed')
+        self.assertEqual(c.render_fingerprint(['amqp']), changed)
+        flags.remove('ssl.enabled')
+        self.assertNotEqual(c.render_fingerprint(['amqp']), changed)
+        changed = c.render_fingerprint(['amqp'])
+        # as does the profiling window opening or closing
+        self.is_active.return_value = True
+        self.assertNotEqual(c.render_fingerprint(['amqp']), changed)
+        changed = c.render_fingerprint(['amqp'])
+        # and a new project count
+        kv = mock.MagicMock()
+        kv.get.return_value = 12
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        self.assertNotEqual(c.render_fingerprint(['amqp']), changed)
+        kv.get.assert_called_with(barbican.PKEK_PROJECTS_KEY)
+
+    def test_charm_digest(self):
+        charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, charm_dir)
+        os.makedirs(os.path.join(charm_dir, 'templates', 'rocky'))
+        template = os.path.join(charm_dir, 'templates', 'rocky',
+                                'barbican.conf')
+        with open(template, 'w') as f:
+            f.write('[DEFAULT]\n')
+        self.patch_object(barbican.hookenv, 'charm_dir',
+                          return_value=charm_dir)
+        package = os.path.dirname(os.path.abspath(barbican.__file__))
+        opened = []
+        real_open = open
+
+        def _open(path, *args):
+            opened.append(path)
+            return real_open(path, *args)
+
+        with mock.patch('builtins.open', side_effect=_open):
+            digest = barbican.BarbicanCharm._charm_digest()
+        # every module of the package is covered, not just barbican.py
+        for module in ('barbican.py', 'hsm_slots.py', 'profiling.py',
+                       'restarts.py'):
+            self.assertIn(os.path.join(package, module), opened)
+        self.assertIn(template, opened)
+        with open(template, 'a') as f:
+            f.write('debug = True\n')
+        self.assertNotEqual(barbican.BarbicanCharm._charm_digest(), digest)
+
+    def test_render_is_current(self):
+        kv = mock.MagicMock()
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        self.patch_object(barbican.os.path, 'exists', return_value=True)
+        store = {barbican.RENDER_FINGERPRINT_KEY: 'fp1'}
+        kv.get.side_effect = store.get
+        c = barbican.BarbicanCharm()
+        self.assertTrue(c.render_is_current('fp1'))
+        self.assertFalse(c.render_is_current('fp2'))
+        # an upgrade waiting for a restart slot forces a render
+        store[restarts.PENDING_RESTART_KEY] = {'upgrade': True}
+        self.assertFalse(c.render_is_current('fp1'))
+        store[restarts.PENDING_RESTART_KEY] = {'upgrade': False}
+        self.assertTrue(c.render_is_current('fp1'))
+        # a missing config file forces a render
+        self.exists.return_value = False
+        self.assertFalse(c.render_is_current('fp1'))
+        # including the files only in the full restart map
+        self._patch_config({'enable-retry-scheduler': True})
+        self.exists.side_effect = (
+            lambda f: f != barbican.BARBICAN_RETRY_UNIT)
+        self.assertFalse(c.render_is_current('fp1'))
+        c.record_render('fp2')
+        kv.set.assert_called_once_with(barbican.RENDER_FINGERPRINT_KEY, 'fp2')
+
+    def test_plan_restarts(self):
+        c = barbican.BarbicanCharm()
+        # an apache vhost change only needs a graceful reload
+        self.assertEqual(
+            c.plan_restarts({barbican.BARBICAN_WSGI_CONF: ('a', 'b')}),
+            ([restarts.RELOAD_API], []))
+        # a paste pipeline change leaves the worker alone
+        self.assertEqual(
+            c.plan_restarts({barbican.BARBICAN_API_PASTE_CONF: ('a', 'b'),
+                             barbican.BARBICAN_WSGI_CONF: ('a', 'b')}),
+            ([restarts.RESTART_API], []))
+        # barbican.conf is planned per section
+        old = "[DEFAULT]\ndebug = False\n[keystone_authtoken]\nauth_url = a\n"
+        new = "[DEFAULT]\ndebug = False\n[keystone_authtoken]\nauth_url = b\n"
+        self.assertEqual(
+            c.plan_restarts({barbican.BARBICAN_CONF: (old, new)}),
+            ([restarts.RESTART_API], []))
+        new = "[DEFAULT]\ndebug = True\n[keystone_authtoken]\nauth_url = a\n"
+        self.assertEqual(
+            c.plan_restarts({barbican.BARBICAN_CONF: (old, new)}),
+            ([restarts.RESTART_API, restarts.RESTART_WORKER], []))
+        # comments don't count as changes
+        self.assertEqual(
+            c.plan_restarts({barbican.BARBICAN_CONF: (old, '# x\n' + old)}),
+            ([], []))
+        # files without a plan restart their services
+        c.restart_map = dict(barbican.BarbicanCharm.restart_map)
+        c.restart_map['/etc/haproxy/haproxy.cfg'] = ['haproxy']
+        self.assertEqual(
+            c.plan_restarts({'/etc/haproxy/haproxy.cfg': ('a', 'b'),
+                             barbican.BARBICAN_WSGI_CONF: ('a', 'b')}),
+            ([restarts.RELOAD_API], ['haproxy']))
+
+    def test_run_restart_plan(self):
+        self.patch_object(barbican.ch_host, 'service_reload')
+        self.patch_object(barbican.ch_host, 'service_restart')
+        self.patch_object(barbican.time, 'time', return_value=10)
+        kv = mock.MagicMock()
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        c = barbican.BarbicanCharm()
+        c.run_restart_plan([restarts.RELOAD_API, restarts.RESTART_WORKER],
+                           ['haproxy'], ['a-file'])
+        self.service_reload.assert_called_once_with(
+            'apache2', restart_on_failure=True)
+        self.service_restart.assert_has_calls([
+            mock.call('barbican-worker'),
+            mock.call('haproxy'),
+        ])
+        kv.set.assert_called_once_with(restarts.LAST_RESTART_KEY, {
+            'actions': [restarts.RELOAD_API, restarts.RESTART_WORKER],
+            'services': ['haproxy'],
+            'files': ['a-file'],
+            'time': 10,
+        })
+
+    def test_run_restart_plan_warmup(self):
+        self.patch_object(barbican.ch_host, 'service_reload')
+        self.patch_object(barbican.ch_host, 'service_restart')
+        self.patch_object(barbican.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        self.patch_object(barbican.BarbicanCharm, 'wait_for_warmup')
+        self.patch_object(barbican.BarbicanCharm, 'wsgi_daemon_processes',
+                          return_value=[mock.MagicMock(pid=10),
+                                        mock.MagicMock(pid=11)])
+        c = barbican.BarbicanCharm()
+        c.run_restart_plan([restarts.RESTART_WORKER], [])
+        self.wait_for_warmup.assert_not_called()
+        self.wsgi_daemon_processes.assert_not_called()
+        c.run_restart_plan([restarts.RELOAD_API], [])
+        self.wait_for_warmup.assert_called_once_with(previous={10, 11})
+
+    def test_wsgi_processes_loaded(self):
+        def proc(pid, cmdline, rss_mb):
+            p = mock.MagicMock(pid=pid)
+            p.info = {'cmdline': cmdline,
+                      'memory_info': mock.MagicMock(rss=rss_mb << 20)}
+            return p
+
+        self.patch_object(barbican.psutil, 'process_iter', return_value=[
+            proc(1, ['(wsgi:barbican-api)'], 120),
+            proc(2, ['(wsgi:barbican-api)'], 12),
+            proc(3, ['(wsgi:barbican-api-admin)'], 100),
+            proc(4, ['/usr/sbin/apache2', '-k', 'start'], 200),
+            proc(5, None, 0),
+        ])
+        c = barbican.BarbicanCharm()
+        self.assertEqual([p.pid for p in c.wsgi_daemon_processes()],
+                         [1, 2, 3])
+        self.assertEqual(c.wsgi_processes_loaded(), 2)
+        # the previous generation, still draining after a graceful reload
+        self.assertEqual(c.wsgi_processes_loaded(previous={1}), 1)
+
+    def test_wait_for_warmup(self):
+        self._patch_config({'wsgi-warmup-timeout': 0})
+        self.patch_object(barbican.BarbicanCharm, 'wsgi_processes_expected',
+                          return_value=3)
+        self.patch_object(barbican.BarbicanCharm, 'wsgi_processes_loaded')
+        self.patch_object(barbican.BarbicanCharm, 'wait_for_api',
+                          return_value=True)
+        self.patch_object(barbican.time, 'sleep')
+        self.patch_object(barbican.time, 'time')
+        c = barbican.BarbicanCharm()
+        self.assertTrue(c.wait_for_warmup())
+        self.wsgi_processes_loaded.assert_not_called()
+        self._patch_config({'wsgi-warmup-timeout': 10})
+        self.time.side_effect = [0, 1, 2, 3]
+        self.wsgi_processes_loaded.side_effect = [1, 2, 3]
+        self.assertTrue(c.wait_for_warmup(previous={7}))
+        self.assertEqual(self.sleep.call_count, 2)
+        self.wsgi_processes_loaded.assert_called_with({7})
+        self.wait_for_api.assert_called_once_with(timeout=7)
+        # never loaded
+        self.time.side_effect = [0, 5, 11]
+        self.wsgi_processes_loaded.side_effect = None
+        self.wsgi_processes_loaded.return_value = 2
+        self.assertFalse(c.wait_for_warmup())
+
+    def _patch_policyd(self, enabled=True, state=None):
+        self._patch_config({'use-policyd-override': enabled})
+        self.patch_object(barbican, 'policyd')
+        self.policyd.POLICYD_CONFIG_NAME = 'use-policyd-override'
+        self.policyd.is_policyd_override_valid_on_this_release.return_value = (
+            True)
+        self.policyd.get_policy_resource_filename.return_value = '/r.zip'
+        self.policyd.is_policy_success_file_set.return_value = True
+        self.policyd.process_policy_resource_file.return_value = True
+        self.patch_object(barbican.ch_host, 'file_hash', return_value='h1')
+        self.patch_object(barbican.BarbicanCharm, 'policyd_resource_error')
+        self.policyd_store = {}
+        if state:
+            self.policyd_store[barbican.POLICYD_STATE_KEY] = state
+        kv = mock.MagicMock()
+        kv.get.side_effect = self.policyd_store.get
+        kv.set.side_effect = self.policyd_store.__setitem__
+        kv.unset.side_effect = self.policyd_store.pop
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+
+    def test_policyd_overrides_new_resource(self):
+        self._patch_policyd(state={'hash': 'h0', 'error': None})
+        self.patch_object(barbican.BarbicanCharm, 'restart_all')
+        c = barbican.BarbicanCharm()
+        c.policyd_overrides()
+        self.policyd_resource_error.assert_called_once_with('/r.zip')
+        self.policyd.process_policy_resource_file.assert_called_once_with(
+            '/r.zip', 'barbican')
+        self.assertEqual(self.policyd_store[barbican.POLICYD_STATE_KEY],
+                         {'hash': 'h1', 'error': None})
+        self.restart_all.assert_not_called()
+
+    def test_policyd_overrides_unchanged(self):
+        self._patch_policyd(state={'hash': 'h1', 'error': None})
+        c = barbican.BarbicanCharm()
+        c.policyd_overrides()
+        self.policyd_resource_error.assert_not_called()
+        self.policyd.process_policy_resource_file.assert_not_called()
+        # the same resource is processed again if the overrides went away
+        self.policyd.is_policy_success_file_set.return_value = False
+        c.policyd_overrides()
+        self.policyd.process_policy_resource_file.assert_called_once_with(
+            '/r.zip', 'barbican')
+
+    def test_policyd_overrides_invalid(self):
+        self._patch_policyd(state={'hash': 'h0', 'error': None})
+        self.policyd_resource_error.return_value = 'no yaml files'
+        c = barbican.BarbicanCharm()
+        c.policyd_overrides()
+        # the current overrides are left alone
+        self.policyd.process_policy_resource_file.assert_not_called()
+        self.policyd.clean_policyd_dir_for.assert_not_called()
+        self.assertEqual(self.policyd_store[barbican.POLICYD_STATE_KEY],
+                         {'hash': 'h1', 'error': 'no yaml files'})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', 'Invalid policyd-override resource: no yaml files'))
+        # and the same bad resource isn't validated again
+        self.policyd_resource_error.reset_mock()
+        c.policyd_overrides()
+        self.policyd_resource_error.assert_not_called()
+
+    def test_policyd_overrides_disabled(self):
+        self._patch_policyd(enabled=False,
+                            state={'hash': 'h1', 'error': None})
+        c = barbican.BarbicanCharm()
+        c.policyd_overrides()
+        self.policyd.clean_policyd_dir_for.assert_called_once_with(
+            'barbican')
+        self.policyd.remove_policy_success_file.assert_called_once_with()
+        self.assertEqual(self.policyd_store, {})
+        self.policyd.get_policy_resource_filename.assert_not_called()
+
+    def test_policyd_resource_error(self):
+        self.patch_object(barbican, 'policyd')
+        self.assertEqual(barbican.BarbicanCharm.policyd_resource_error(None),
+                         'resource not attached')
+        self.policyd.POLICYD_TEMPLATE_EXTS = ['.j2']
+        zfp = mock.MagicMock()
+        self.policyd.open_and_filter_yaml_files.return_value.__enter__\
+            .return_value = (zfp, [('a', '.yaml', 'a.yaml', 'info')])
+        self.assertIsNone(
+            barbican.BarbicanCharm.policyd_resource_error('/r.zip'))
+        self.policyd.read_and_validate_yaml.side_effect = ValueError('bad')
+        self.assertEqual(
+            barbican.BarbicanCharm.policyd_resource_error('/r.zip'), 'bad')
+
+    def test_states_to_check_leaves_required_relations(self):
+        self._patch_config({'require-hsm-plugin': True})
+        self.patch_object(barbican.charms_openstack.charm.HAOpenStackCharm,
+                          'states_to_check')
+        required = list(barbican.BarbicanCharm.required_relations)
+        c = barbican.BarbicanCharm()
+        c.states_to_check()
+        c.states_to_check()
+        self.states_to_check.assert_called_with(
+            required_relations=required + ['hsm'])
+        self.assertEqual(barbican.BarbicanCharm.required_relations, required)
+
+    def _patch_status(self, hook, cached=None):
+        self._patch_config({})
+        self.patch_object(barbican.hookenv, 'hook_name', return_value=hook)
+        self.patch_object(barbican.hookenv, 'status_set')
+        self.patch_object(barbican.hookenv, 'status_get',
+                          return_value=('active', 'Unit is ready'))
+        self.patch_object(barbican.reactive, 'get_flags',
+                          return_value=['amqp.available'])
+        self.patch_object(barbican.charms_openstack.charm.HAOpenStackCharm,
+                          '_assess_status')
+        self.patch_object(barbican.BarbicanCharm,
+                          'custom_assess_status_last_check',
+                          return_value=('active', 'Unit is ready (x)'))
+        self.patch_object(barbican.subprocess, 'check_call')
+        self.patch_object(barbican.time, 'time', return_value=1000.0)
+        self.status_store = {}
+        if cached:
+            self.status_store[barbican.STATUS_CACHE_KEY] = cached
+        kv = mock.MagicMock()
+        kv.get.side_effect = self.status_store.get
+        kv.set.side_effect = self.status_store.__setitem__
+        kv.unset.side_effect = self.status_store.pop
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+
+    def test_assess_status_full(self):
+        self._patch_status('config-changed')
+        c = barbican.BarbicanCharm()
+        c._assess_status()
+        self._assess_status.assert_called_once_with()
+        self.check_call.assert_not_called()
+        self.assertEqual(self.status_store[barbican.STATUS_CACHE_KEY], {
+            'fingerprint': c.status_fingerprint(), 'time': 1000.0})
+        # an assessment that doesn't leave the unit active isn't cached
+        self.status_get.return_value = ('blocked', 'Missing relations')
+        c._assess_status()
+        self.assertEqual(self.status_store, {})
+
+    def test_assess_status_timed(self):
+        self._patch_status('config-changed')
+        self.patch_object(barbican.BarbicanCharm, 'timed',
+                          return_value=mock.MagicMock())
+        c = barbican.BarbicanCharm()
+        c._assess_status()
+        self.timed.assert_called_once_with('assess_status')
+        self.timed.return_value.__enter__.assert_called_once_with()
+        self._assess_status.assert_called_once_with()
+
+    def test_assess_status_update_status_cached(self):
+        self._patch_status('update-status')
+        cached = {'fingerprint': barbican.BarbicanCharm.status_fingerprint(),
+                  'time': 900.0}
+        self.status_store[barbican.STATUS_CACHE_KEY] = cached
+        c = barbican.BarbicanCharm()
+        c._assess_status()
+        self._assess_status.assert_not_called()
+        self.check_call.assert_called_once_with(
+            ['systemctl', 'is-active', '--quiet'] + c.full_service_list,
+            timeout=barbican.STATUS_PROBE_TIMEOUT)
+        self.status_set.assert_called_once_with('active', 'Unit is ready (x)')
+
+    def test_assess_status_update_status_stale(self):
+        self._patch_status('update-status')
+        fingerprint = barbican.BarbicanCharm.status_fingerprint()
+        c = barbican.BarbicanCharm()
+        # changed flags, an old cache or a service down: full assessment
+        for cached, probe in (({'fingerprint': 'old', 'time': 900.0}, None),
+                              ({'fingerprint': fingerprint, 'time': -3000.0},
+                               None),
+                              ({'fingerprint': fingerprint, 'time': 900.0},
+                               barbican.subprocess.TimeoutExpired('x', 1))):
+            self._assess_status.reset_mock()
+            self.status_store[barbican.STATUS_CACHE_KEY] = cached
+            self.check_call.side_effect = probe
+            c._assess_status()
+            self._assess_status.assert_called_once_with()
+            self.status_set.assert_not_called()
+
+    def test_custom_assess_status_check_warmup(self):
+        self._patch_config({'wsgi-warmup-timeout': 60})
+        self.patch_object(barbican.BarbicanCharm, 'wsgi_processes_expected',
+                          return_value=4)
+        self.patch_object(barbican.BarbicanCharm, 'wsgi_processes_loaded',
+                          return_value=3)
+        self.patch_object(barbican.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        self.kv.return_value.get.return_value = None
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.custom_assess_status_check(),
+                         ('waiting', 'API processes loading (3/4)'))
+        self.wsgi_processes_loaded.return_value = 4
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_run_restart_plan_retry_scheduler(self):
+        self._patch_config({'enable-retry-scheduler': True})
+        calls = mock.MagicMock()
+        self.patch_object(barbican.ch_host, 'service_restart',
+                          new=calls.service_restart)
+        self.patch_object(barbican.subprocess, 'check_call',
+                          new=calls.check_call)
+        self.patch_object(barbican.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        c = barbican.BarbicanCharm()
+        c.run_restart_plan([restarts.RESTART_WORKER],
+                           [barbican.BARBICAN_RETRY_SERVICE],
+                           [barbican.BARBICAN_RETRY_UNIT])
+        # the unit file is reloaded first, and the service restarted once
+        self.assertEqual(calls.mock_calls, [
+            mock.call.check_call(['systemctl', 'daemon-reload']),
+            mock.call.service_restart('barbican-worker'),
+            mock.call.service_restart('barbican-retry'),
+        ])
+        # without a plan of its own, it restarts with the worker
+        calls.reset_mock()
+        c.run_restart_plan([restarts.RESTART_WORKER], [], ['a-file'])
+        self.assertEqual(calls.mock_calls, [
+            mock.call.service_restart('barbican-worker'),
+            mock.call.service_restart('barbican-retry'),
+        ])
+
+    def test_restart_on_change(self):
+        contents = {barbican.BARBICAN_WSGI_CONF: 'a'}
+        self.patch_object(restarts, 'read_config')
+        self.read_config.side_effect = lambda path: contents.get(path)
+        self.patch_object(barbican.BarbicanCharm, 'run_restart_plan')
+        c = barbican.BarbicanCharm()
+        with c.restart_on_change():
+            pass
+        self.run_restart_plan.assert_not_called()
+        with c.restart_on_change():
+            contents[barbican.BARBICAN_WSGI_CONF] = 'b'
+        self.run_restart_plan.assert_called_once_with(
+            [restarts.RELOAD_API], [], [barbican.BARBICAN_WSGI_CONF])
+
+    def test_db_revisions(self):
+        self.patch_object(barbican.subprocess, 'check_output')
+        outputs = {
+            'current': '0f8c192a061f (head)\n',
+            'history': ('39cf2e645cba -> 0f8c192a061f (head), Add Secret '
+                        'Consumers table\n'
+                        '1bece815014f -> 39cf2e645cba, fix secret data\n'),
+        }
+        self.check_output.side_effect = (
+            lambda cmd, **kwargs: outputs[cmd[-1]])
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.db_revisions(),
+                         ('0f8c192a061f', '0f8c192a061f'))
+        outputs['current'] = '39cf2e645cba\n'
+        self.assertEqual(c.db_revisions(),
+                         ('39cf2e645cba', '0f8c192a061f'))
+        outputs['current'] = ''
+        self.assertEqual(c.db_revisions(), (None, '0f8c192a061f'))
+
+    def test_db_sync(self):
+        self.patch_object(barbican.hookenv, 'is_leader', return_value=True)
+        self.patch_object(barbican.hookenv, 'leader_set')
+        self.patch_object(barbican.hookenv, 'log')
+        self.patch_object(barbican.subprocess, 'check_call')
+        self.patch_object(barbican.BarbicanCharm, 'db_revisions')
+        self.patch_object(barbican.time, 'time')
+        c = barbican.BarbicanCharm()
+        # already at head: no upgrade
+        self.db_revisions.return_value = ('abc', 'abc')
+        self.assertFalse(c.db_sync())
+        self.check_call.assert_not_called()
+        self.leader_set.assert_called_once_with(
+            {'db-sync-done': True, barbican.DB_REVISION_KEY: 'abc'})
+        # behind head: upgrade and record the migration
+        self.leader_set.reset_mock()
+        self.db_revisions.side_effect = [('abc', 'def'), ('def', 'def')]
+        self.time.side_effect = [100, 112.5]
+        self.assertTrue(c.db_sync())
+        self.check_call.assert_called_once_with(c.sync_cmd)
+        self.leader_set.assert_called_once_with({
+            'db-sync-done': True,
+            barbican.DB_REVISION_KEY: 'def',
+            barbican.DB_MIGRATION_KEY: (
+                '{"from": "abc", "to": "def", "duration": 12.5, '
+                '"time": 100}'),
+        })
+        # only the leader migrates
+        self.is_leader.return_value = False
+        self.assertFalse(c.db_sync())
+
+    def test_database_pool_settings(self):
+        config = {}
+        self._patch_config(config)
+        self.patch_object(barbican.hookenv, 'log')
+        model = {'processes': 4, 'threads': 8, 'admin_processes': 1}
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.database_pool_settings(model), {})
+        config['database-max-pool-size'] = 5
+        self.assertEqual(c.database_pool_settings(model),
+                         {'max_pool_size': 5})
+        config['database-pool-auto'] = True
+        self.log.reset_mock()
+        self.assertEqual(c.database_pool_settings(model), {
+            'max_pool_size': 5,
+            'max_overflow': 4,
+            'pool_timeout': barbican.DB_POOL_TIMEOUT,
+            'connection_recycle_time': barbican.DB_CONNECTION_RECYCLE_TIME,
+        })
+        # 4 public, 1 admin and 1 worker process with 5 + 4 connections
+        self.log.assert_called_once_with(
+            "Database connection budget for the unit: 54 (6 processes x 9 "
+            "connections)", level=barbican.hookenv.INFO)
+        del config['database-max-pool-size']
+        self.assertEqual(c.database_pool_settings(model)['max_pool_size'], 8)
+
+    def test_memcache_servers(self):
+        config = {'memcached-servers': 'm1:11211, m2:11211'}
+        self._patch_config(config)
+        self.patch_object(barbican.hookenv, 'relation_ids', return_value=[])
+        self.patch_object(barbican.hookenv, 'related_units',
+                          return_value=['memcached/0', 'memcached/1'])
+        self.patch_object(barbican.hookenv, 'relation_get')
+        relation_data = {
+            'memcached/0': {'host': '10.0.0.2', 'port': '11211'},
+            'memcached/1': {'host': 'fd00::1'},
+        }
+        self.relation_get.side_effect = (
+            lambda rid, unit: relation_data[unit])
+        c = barbican.BarbicanCharm()
+        # no relation, so use the config fallback
+        self.assertEqual(c.memcache_servers(), ['m1:11211', 'm2:11211'])
+        self.relation_ids.return_value = ['memcache:3']
+        self.assertEqual(c.memcache_servers(),
+                         ['10.0.0.2:11211', 'inet6:[fd00::1]:11211'])
+
+    def test_memcache_settings(self):
+        self._patch_config({
+            'token-cache-time': 300,
+            'memcache-pool-maxsize': 10,
+            'memcache-pool-socket-timeout': 3,
+            'memcache-pool-unused-timeout': 60,
+            'memcache-pool-conn-get-timeout': 10,
+        })
+        self.patch_object(barbican.BarbicanCharm, 'memcache_servers',
+                          return_value=[])
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.memcache_settings(), {})
+        self.memcache_servers.return_value = ['a:1', 'b:1']
+        self.assertEqual(c.memcache_settings(), {
+            'memcached_servers': 'a:1,b:1',
+            'token_cache_time': 300,
+            'memcache_use_advanced_pool': True,
+            'memcache_pool_maxsize': 10,
+            'memcache_pool_socket_timeout': 3,
+            'memcache_pool_unused_timeout': 60,
+            'memcache_pool_conn_get_timeout': 10,
+        })
+
+    def test_active_project_count(self):
+        self.patch_object(barbican.configparser.ConfigParser, 'read')
+        self.patch_object(barbican.configparser.ConfigParser, 'get',
+                          return_value='mysql+pymysql://db')
+        self.patch_object(barbican.subprocess, 'check_output',
+                          return_value='42\n')
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.active_project_count(), 42)
+        self.check_output.assert_called_once_with(
+            ['/usr/bin/python3', '-c', barbican.PKEK_PROJECT_COUNT_SCRIPT],
+            input='mysql+pymysql://db', universal_newlines=True, timeout=60)
+        self.check_output.side_effect = (
+            barbican.subprocess.CalledProcessError(1, 'python3'))
+        self.assertIsNone(c.active_project_count())
+
+    def test_pkek_cache_settings(self):
+        config = {
+            'hsm-rw-session': True,
+            'pkek-length': 32,
+            'pkek-cache-ttl': 900,
+            'pkek-cache-limit': 100,
+        }
+        self._patch_config(config)
+        store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = store.get
+        kv.set.side_effect = store.__setitem__
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        self.patch_object(barbican.hookenv, 'relation_ids',
+                          return_value=['hsm:4'])
+        self.patch_object(barbican.BarbicanCharm, 'active_project_count',
+                          return_value=1000)
+        c = barbican.BarbicanCharm()
+        expected = {
+            'rw_session': True,
+            'length': 32,
+            'ttl': 900,
+            'limit': 100,
+            'projects': None,
+        }
+        self.assertEqual(c.pkek_cache_settings(), expected)
+        self.active_project_count.assert_not_called()
+        config['pkek-cache-limit-auto'] = True
+        expected.update({'limit': 1250, 'projects': 1000})
+        self.assertEqual(c.pkek_cache_settings(), expected)
+        self.assertEqual(store[barbican.PKEK_CACHE_KEY], expected)
+        # the count is kept for later renders
+        self.assertEqual(c.pkek_cache_settings(), expected)
+        self.active_project_count.assert_called_once_with()
+        # the configured limit is the lower bound
+        self.active_project_count.return_value = 10
+        c.refresh_project_count()
+        self.assertEqual(c.pkek_cache_settings()['limit'], 100)
+
+    def test_refresh_project_count(self):
+        config = {'pkek-cache-limit-auto': False}
+        self._patch_config(config)
+        store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = store.get
+        kv.set.side_effect = store.__setitem__
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        self.patch_object(barbican.hookenv, 'relation_ids',
+                          return_value=['hsm:4'])
+        self.patch_object(barbican.BarbicanCharm, 'active_project_count',
+                          return_value=7)
+        c = barbican.BarbicanCharm()
+        c.refresh_project_count()
+        self.active_project_count.assert_not_called()
+        config['pkek-cache-limit-auto'] = True
+        c.refresh_project_count()
+        self.assertEqual(store[barbican.PKEK_PROJECTS_KEY], 7)
+        # a failed count keeps the last one
+        self.active_project_count.return_value = None
+        c.refresh_project_count()
+        self.assertEqual(store[barbican.PKEK_PROJECTS_KEY], 7)
+
+    def test_retry_scheduler_services(self):
+        self._patch_config({'enable-retry-scheduler': False})
+        c = barbican.BarbicanCharm()
+        self.assertNotIn('barbican-retry', c.full_service_list)
+        self.assertNotIn(barbican.BARBICAN_RETRY_UNIT, c.full_restart_map)
+        self._patch_config({'enable-retry-scheduler': True})
+        self.assertEqual(c.full_service_list,
+                         ['apache2', 'barbican-worker', 'barbican-retry'])
+        self.assertEqual(c.full_restart_map[barbican.BARBICAN_RETRY_UNIT],
+                         ['barbican-retry'])
+        # the class attributes are left alone
+        self.assertEqual(barbican.BarbicanCharm.services,
+                         ['apache2', 'barbican-worker'])
+
+    def test_worker_process_count(self):
+        self._patch_config({'worker-processes': 4})
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.worker_process_count(), 4)
+        self._patch_config({'worker-processes': 4,
+                            'enable-retry-scheduler': True})
+        self.assertEqual(c.worker_process_count(), 5)
+        self._patch_config({})
+        self.assertEqual(c.worker_process_count(), 1)
+
+    def test_configure_retry_scheduler(self):
+        self.patch_object(barbican.ch_host, 'service')
+        self.patch_object(barbican.ch_host, 'service_stop')
+        self.patch_object(barbican.os.path, 'exists', return_value=True)
+        self.patch_object(barbican.os, 'remove')
+        self.patch_object(barbican.subprocess, 'check_call')
+        self._patch_config({'enable-retry-scheduler': True})
+        c = barbican.BarbicanCharm()
+        c.configure_retry_scheduler()
+        self.service.assert_called_once_with('enable', 'barbican-retry')
+        self.remove.assert_not_called()
+        self.service.reset_mock()
+        self._patch_config({'enable-retry-scheduler': False})
+        c.configure_retry_scheduler()
+        self.service_stop.assert_called_once_with('barbican-retry')
+        self.service.assert_called_once_with('disable', 'barbican-retry')
+        self.remove.assert_called_once_with(barbican.BARBICAN_RETRY_UNIT)
+        self.check_call.assert_called_once_with(
+            ['systemctl', 'daemon-reload'])
+        # nothing to clean up once the unit file has gone
+        self.exists.return_value = False
+        self.service_stop.reset_mock()
+        c.configure_retry_scheduler()
+        self.service_stop.assert_not_called()
+
+    def test_worker_processes_running(self):
+        def proc(pid, ppid, cmdline):
+            p = mock.MagicMock()
+            p.info = {'pid': pid, 'ppid': ppid, 'cmdline': cmdline}
+            return p
+
+        worker = ['/usr/bin/python3', '/usr/bin/barbican-worker']
+        procs = [proc(1, 0, ['/sbin/init']),
+                 proc(10, 1, worker),
+                 proc(20, 1, None)]
+        self.patch_object(barbican.psutil, 'process_iter',
+                          return_value=procs)
+        self.assertEqual(
+            barbican.BarbicanCharm.worker_processes_running(), 1)
+        # forked workers are counted without their parent
+        procs.extend([proc(11, 10, worker), proc(12, 10, worker)])
+        self.assertEqual(
+            barbican.BarbicanCharm.worker_processes_running(), 2)
+
+    def test_custom_assess_status_last_check_workers(self):
+        kv = mock.MagicMock()
+        kv.get.side_effect = {barbican.WSGI_PROCESS_MODEL_KEY: {
+            'processes': 2, 'threads': 4, 'admin_mode': 'separate'}}.get
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        self.patch_object(barbican.hookenv, 'relation_ids', return_value=[])
+        self.patch_object(barbican.BarbicanCharm, 'worker_processes_running',
+                          return_value=3)
+        self._patch_config({'worker-processes': 4})
+        c = barbican.BarbicanCharm()
+        self.assertEqual(
+            c.custom_assess_status_last_check(),
+            ('active', 'Unit is ready (wsgi: 2 processes x 4 threads; '
+                       'workers: 3/4 running)'))
+
+    def test_messaging_settings(self):
+        self._patch_config({'messaging-profile': 'default'})
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.messaging_settings(),
+                         {'DEFAULT': {}, 'oslo_messaging_rabbit': {}})
+        self._patch_config({'messaging-profile': 'high-throughput',
+                            'rabbit-qos-prefetch-count': 0,
+                            'rabbit-quorum-queues': False})
+        settings = c.messaging_settings()
+        self.assertEqual(settings['DEFAULT'], {
+            'rpc_conn_pool_size': 100,
+            'executor_thread_pool_size': 128,
+        })
+        # an override of 0 is kept, an unset boolean isn't rendered
+        self.assertEqual(settings['oslo_messaging_rabbit'], {
+            'rabbit_qos_prefetch_count': 0,
+            'heartbeat_timeout_threshold': 60,
+        })
+        # the profile itself is left alone
+        self.assertEqual(barbican.MESSAGING_PROFILES['high-throughput'][
+            'oslo_messaging_rabbit']['rabbit_qos_prefetch_count'], 64)
+        self._patch_config({'messaging-profile': 'low-latency',
+                            'rabbit-quorum-queues': True})
+        settings = c.messaging_settings()
+        self.assertEqual(
+            settings['oslo_messaging_rabbit']['rabbit_qos_prefetch_count'], 1)
+        self.assertTrue(
+            settings['oslo_messaging_rabbit']['rabbit_quorum_queue'])
+
+    def test_amqp_ha_queues(self):
+        relation_data = {}
+        self.patch_object(barbican.hookenv, 'relation_ids',
+                          return_value=['amqp:3'])
+        self.patch_object(barbican.hookenv, 'related_units',
+                          return_value=['rabbitmq-server/0'])
+        self.patch_object(barbican.hookenv, 'relation_get')
+        self.relation_get.side_effect = (
+            lambda key, rid, unit: relation_data.get(key))
+        self.assertFalse(barbican.BarbicanCharm.amqp_ha_queues())
+        relation_data['ha_queues'] = 'True'
+        self.assertTrue(barbican.BarbicanCharm.amqp_ha_queues())
+
+    def test_rate_limit_settings(self):
+        model = {'processes': 4, 'threads': 8, 'admin_processes': 4}
+        self._patch_config({'rate-limit': False})
+        self.assertEqual(barbican.BarbicanCharm.rate_limit_settings(model),
+                         {})
+        self._patch_config({
+            'rate-limit': True,
+            'rate-limit-project-rate': 10.0,
+            'rate-limit-project-burst': 20,
+            'rate-limit-global-rate': 0,
+            'rate-limit-global-burst': 0,
+            'rate-limit-project-concurrency': 2,
+            'rate-limit-global-concurrency': 0,
+        })
+        self.assertEqual(barbican.BarbicanCharm.rate_limit_settings(model), {
+            'python_path': barbican.RATELIMIT_PYTHON_PATH,
+            'filter': {
+                # shared between the 4 public and 4 admin processes
+                'project_rate': 1.25,
+                'project_burst': 3,
+                'global_rate': 0,
+                'global_burst': 0,
+                'project_concurrency': 1,
+                'global_concurrency': 0,
+                'stats_dir': barbican.reports.RATELIMIT_STATS_DIR,
+            },
+        })
+
+    def test_rate_limit_module_restart(self):
+        self._patch_config({'rate-limit': True})
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.full_restart_map[barbican.RATELIMIT_MODULE],
+                         ['apache2'])
+        self.assertEqual(
+            c.plan_restarts({barbican.RATELIMIT_MODULE: ('a', 'b')}),
+            ([restarts.RESTART_API], []))
+
+    def test_record_hook_timing_registered(self):
+        # on import, ahead of the callbacks the handlers register
+        barbican.hookenv.atexit.assert_any_call(barbican.record_hook_timing)
+
+    def test_timed_disabled(self):
+        self._patch_config({'hook-timing': False})
+        c = barbican.BarbicanCharm()
+        with c.timed('render_stuff'):
+            pass
+        self.assertEqual(barbican._hook_timing, {})
+
+    def test_timed(self):
+        self._patch_config({'hook-timing': True})
+        self.patch_object(barbican.hookenv, 'hook_name',
+                          return_value='config-changed')
+        process = mock.MagicMock()
+        process.create_time.return_value = 100.0
+        self.patch_object(barbican.psutil, 'Process', return_value=process)
+        self.patch_object(barbican.time, 'time', return_value=112.5)
+        store = {barbican.reports.HOOK_TIMINGS_KEY: [
+            {'hook': 'update-status', 'time': n, 'total': 1, 'phases': {}}
+            for n in range(barbican.HOOK_TIMINGS_MAX)]}
+        kv = mock.MagicMock()
+        kv.get.side_effect = store.get
+        kv.set.side_effect = store.__setitem__
+        self.patch_object(barbican.unitdata, 'kv', return_value=kv)
+        self.addCleanup(barbican._hook_timing.clear)
+        c = barbican.BarbicanCharm()
+        with c.timed('render_stuff'):
+            with c.timed('configure_ssl'):
+                pass
+            with c.timed('configure_ssl'):
+                pass
+        with c.timed('assess_status'):
+            pass
+        barbican.record_hook_timing()
+        self.assertEqual(barbican._hook_timing, {})
+        records = store[barbican.reports.HOOK_TIMINGS_KEY]
+        self.assertEqual(len(records), barbican.HOOK_TIMINGS_MAX)
+        self.assertEqual(records[0]['time'], 1)
+        record = records[-1]
+        self.assertEqual(record['hook'], 'config-changed')
+        self.assertEqual(record['time'], 100.0)
+        self.assertEqual(record['total'], 12.5)
+        self.assertEqual(sorted(record['phases']), [
+            'assess_status', 'render_stuff', 'render_stuff.configure_ssl'])
+
+    def test_haproxy_backend_settings(self):
+        model = {'processes': 2, 'threads': 4, 'admin_processes': 1}
+        self._patch_config({'haproxy-balance': 'roundrobin'})
+        self.assertEqual(
+            barbican.BarbicanCharm.haproxy_backend_settings(model),
+            {'balance': 'roundrobin', 'maxconn': 8, 'admin_maxconn': 4})
+        self._patch_config({'haproxy-balance': 'leastconn',
+                            'haproxy-maxconn': 3})
+        self.assertEqual(
+            barbican.BarbicanCharm.haproxy_backend_settings(model),
+            {'balance': 'leastconn', 'maxconn': 3, 'admin_maxconn': 3})
+        # never more than the API can serve
+        self._patch_config({'haproxy-balance': 'bogus',
+                            'haproxy-maxconn': 100})
+        self.assertEqual(
+            barbican.BarbicanCharm.haproxy_backend_settings(model),
+            {'balance': 'leastconn', 'maxconn': 8, 'admin_maxconn': 4})
+        # the admin vhost shares the public daemons
+        model['admin_mode'] = 'shared'
+        self.assertEqual(
+            barbican.BarbicanCharm.haproxy_backend_settings(model),
+            {'balance': 'leastconn', 'maxconn': 6, 'admin_maxconn': 2})
+        model.update({'processes': 1, 'threads': 1})
+        self.assertEqual(
+            barbican.BarbicanCharm.haproxy_backend_settings(model),
+            {'balance': 'leastconn', 'maxconn': 1, 'admin_maxconn': 1})
+
+    def test_haproxy_tls_ports(self):
+        self.patch_object(barbican.reactive, 'is_flag_set',
+                          return_value=False)
+        self.patch_object(barbican.ch_cluster, 'determine_apache_port')
+        self.determine_apache_port.side_effect = (
+            lambda port, singlenode_mode: port - 10)
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.haproxy_tls_ports(), [])
+        self.is_flag_set.return_value = True
+        self.assertEqual(c.haproxy_tls_ports(), [9301, 9302])
+        self.is_flag_set.assert_called_with(barbican.SSL_ENABLED_FLAG)
+
+    def test_custom_assess_status_check_haproxy(self):
+        self._patch_config({'haproxy-balance': 'random-ish'})
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.custom_assess_status_check()[0], 'blocked')
+        self._patch_config({'haproxy-balance': 'leastconn',
+                            'wsgi-request-timeout': 90,
+                            'haproxy-server-timeout': 90000})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', 'haproxy-server-timeout (90000ms) must be longer '
+                        'than wsgi-request-timeout (90s)'))
+        # an unset timeout is haproxy.cfg's default
+        self._patch_config({'wsgi-request-timeout': 120})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', 'haproxy-server-timeout (90000ms) must be longer '
+                        'than wsgi-request-timeout (120s)'))
+        self._patch_config({'haproxy-queue-timeout': 90000,
+                            'haproxy-client-timeout': 90000})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', 'haproxy-queue-timeout (90000ms) must be shorter '
+                        'than haproxy-client-timeout (90000ms)'))
+        self._patch_config({'haproxy-queue-timeout': 95000})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', 'haproxy-queue-timeout (95000ms) must be shorter '
+                        'than haproxy-client-timeout (90000ms)'))
+        self._patch_config({'wsgi-request-timeout': 60,
+                            'haproxy-server-timeout': 90000,
+                            'haproxy-queue-timeout': 9000,
+                            'haproxy-client-timeout': 90000})
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self._patch_config({'wsgi-request-timeout': 60})
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_custom_assess_status_check_messaging(self):
+        self.patch_object(barbican.BarbicanCharm, 'amqp_ha_queues',
+                          return_value=True)
+        self._patch_config({'messaging-profile': 'fast'})
+        c = barbican.BarbicanCharm()
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "Invalid messaging-profile 'fast', must be one of "
+                        "default, high-throughput, low-latency"))
+        self._patch_config({'messaging-profile': 'high-throughput',
+                            'rabbit-quorum-queues': True})
+        self.assertEqual(c.custom_assess_status_check()[0], 'blocked')
+        self.amqp_ha_queues.return_value = False
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self._patch_config({'rabbit-stream-fanout': True})
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', 'rabbit-stream-fanout requires rabbit-quorum-queues'))
+
+    def test_start_profiling(self):
+        self.patch_object(barbican.api_profiling, 'open_window',
+                          return_value=700)
+        self.patch_object(barbican.BarbicanCharm, 'render_configs')
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.start_profiling(600), 700)
+        # repoze.profile is looked for with barbican's python, not the venv's
+        self.open_window.assert_called_once_with(600, '/usr/bin/python3')
+        self.render_configs.assert_called_once_with(
+            [barbican.BARBICAN_API_PASTE_CONF])
+
+    def test_stop_profiling(self):
+        self.patch_object(barbican.api_profiling, 'close_window')
+        self.patch_object(barbican.api_profiling, 'collect',
+                          return_value=('archive', 'summary'))
+        self.patch_object(barbican.BarbicanCharm, 'render_configs')
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.stop_profiling(5), ('archive', 'summary'))
+        self.close_window.assert_called_once_with()
+        self.collect.assert_called_once_with(5)
+        self.render_configs.assert_called_once_with(
+            [barbican.BARBICAN_API_PASTE_CONF])
+
+    def test_service_token(self):
+        relation_data = {}
+        self.patch_object(barbican.hookenv, 'relation_ids',
+                          return_value=['identity-service:5'])
+        self.patch_object(barbican.hookenv, 'related_units',
+                          return_value=['keystone/0'])
+        self.patch_object(barbican.hookenv, 'relation_get',
+                          return_value=relation_data)
+        with self.assertRaises(ValueError):
+            barbican.BarbicanCharm.service_token()
+        relation_data.update({
+            'auth_host': '10.0.0.10',
+            'auth_port': '35357',
+            'auth_protocol': 'https',
+            'service_username': 'barbican',
+            'service_password': 'secret',
+            'service_tenant': 'services',
+            'service_domain': 'service_domain',
+        })
+        response = mock.MagicMock()
+        response.__enter__.return_value.headers = {'X-Subject-Token': 'tok'}
+        self.patch_object(barbican.urllib.request, 'urlopen',
+                          return_value=response)
+        self.assertEqual(barbican.BarbicanCharm.service_token(), 'tok')
+        request = self.urlopen.call_args[0][0]
+        self.assertEqual(request.full_url,
+                         'https://10.0.0.10:35357/v3/auth/tokens')
+        body = barbican.json.loads(request.data.decode('utf-8'))
+        self.assertEqual(
+            body['auth']['identity']['password']['user']['name'], 'barbican')
+        self.assertEqual(body['auth']['scope']['project']['name'], 'services')
+
+    def test_run_benchmark(self):
+        self.patch_object(barbican.BarbicanCharm, 'api_url',
+                          return_value='https://127.0.0.1:9301/')
+        self.patch_object(barbican.BarbicanCharm, 'api_ssl_context',
+                          return_value='ctx')
+        self.patch_object(barbican.BarbicanCharm, 'service_token',
+                          return_value='tok')
+        self.patch_object(barbican.benchmark, 'Benchmark',
+                          return_value=mock.MagicMock())
+        self.Benchmark.return_value.run.return_value = {'requests': 3}
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.run_benchmark('secret', 1, 2), {'requests': 3})
+        self.Benchmark.assert_called_once_with(
+            'https://127.0.0.1:9301/', 'tok', 'secret', ssl_context='ctx')
+        self.Benchmark.return_value.run.assert_called_once_with(1, 2)
+
+
+class TestRollingRestarts(Helper):
+
+    def setUp(self):
+        super().setUp()
+        self.store = {}
+        self.kv = mock.MagicMock()
+        self.kv.get.side_effect = self.store.get
+        self.kv.set.side_effect = self.store.__setitem__
+        self.kv.unset.side_effect = self.store.pop
+        self.patch_object(barbican.unitdata, 'kv', return_value=self.kv)
+        self.cfg = {'rolling-restart-max-units': 1}
+        self.patch_object(barbican.hookenv, 'config')
+        self.config.side_effect = lambda key=None: self.cfg.get(key)
+        self.patch_object(barbican.hookenv, 'relation_ids',
+                          return_value=['cluster:1'])
+        self.patch_object(barbican.hookenv, 'related_units',
+                          return_value=['barbican/1', 'barbican/2'])
+        self.patch_object(barbican.hookenv, 'local_unit',
+                          return_value='barbican/0')
+        self.patch_object(barbican.hookenv, 'relation_set')
+        self.relation_data = {}
+        self.patch_object(barbican.hookenv, 'relation_get')
+        self.relation_get.side_effect = (
+            lambda rid, unit: self.relation_data.get(unit, {}))
+        self.leader_settings = {}
+        self.patch_object(barbican.hookenv, 'leader_get')
+        self.leader_get.side_effect = self.leader_settings.get
+        self.patch_object(barbican.hookenv, 'leader_set')
+        self.leader_set.side_effect = self.leader_settings.update
+
+    def test_restart_on_change_deferred(self):
+        contents = {barbican.BARBICAN_WSGI_CONF: 'a'}
+        self.patch_object(restarts, 'read_config')
+        self.read_config.side_effect = lambda path: contents.get(path)
+        self.patch_object(barbican.BarbicanCharm, 'run_restart_plan')
+        self.patch_object(barbican.time, 'time', return_value=1)
+        c = barbican.BarbicanCharm()
+        with c.restart_on_change():
+            contents[barbican.BARBICAN_WSGI_CONF] = 'b'
+        self.run_restart_plan.assert_not_called()
+        self.assertEqual(self.store[restarts.PENDING_RESTART_KEY], {
+            'nonce': '1.000000',
+            'actions': [restarts.RELOAD_API],
+            'services': [],
+            'files': [barbican.BARBICAN_WSGI_CONF],
+            'upgrade': False,
+            'restarted': False,
+        })
+        self.relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={restarts.RESTART_REQUEST_KEY: '1.000000'})
+
+    def test_grant_restart_slots(self):
+        self.relation_data.update({
+            'barbican/0': {restarts.RESTART_REQUEST_KEY: 'n0'},
+            'barbican/1': {restarts.RESTART_REQUEST_KEY: 'n1'},
+        })
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.grant_restart_slots(), {'barbican/0': 'n0'})
+
+    def test_run_pending_restart(self):
+        self.patch_object(barbican.BarbicanCharm, 'run_restart_plan')
+        self.patch_object(barbican.BarbicanCharm, 'wait_for_api',
+                          return_value=True)
+        self.patch_object(restarts, 'drain_api')
+        self.patch_object(restarts, 'undrain_api')
+        c = barbican.BarbicanCharm()
+        self.assertFalse(c.run_pending_restart())
+        self.store[restarts.PENDING_RESTART_KEY] = {
+            'nonce': 'n0', 'actions': [restarts.RESTART_API],
+            'services': [], 'files': ['f'], 'upgrade': False,
+            'restarted': False}
+        # no slot yet
+        self.assertFalse(c.run_pending_restart())
+        self.run_restart_plan.assert_not_called()
+        # the API doesn't come back, so the slot is kept
+        self.leader_settings[restarts.RESTART_SLOTS_KEY] = (
+            '{"barbican/0": "n0"}')
+        self.wait_for_api.return_value = False
+        self.assertFalse(c.run_pending_restart())
+        self.run_restart_plan.assert_called_once_with(
+            [restarts.RESTART_API], [], ['f'])
+        self.drain_api.assert_called_once_with()
+        self.undrain_api.assert_called_once_with()
+        self.relation_set.reset_mock()
+        # the next attempt only probes again before releasing the slot
+        self.wait_for_api.return_value = True
+        self.assertTrue(c.run_pending_restart())
+        self.assertEqual(self.run_restart_plan.call_count, 1)
+        self.relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={restarts.RESTART_DONE_KEY: 'n0'})
+        self.assertNotIn(restarts.PENDING_RESTART_KEY, self.store)
+
+    def test_upgrade_if_available(self):
+        self.patch_object(barbican.BarbicanCharm,
+                          'openstack_upgrade_available', create=True,
+                          return_value=True)
+        self.patch_object(barbican.charms_openstack.charm.HAOpenStackCharm,
+                          'upgrade_if_available', name='super_upgrade')
+        self.patch_object(barbican.BarbicanCharm, 'run_restart_plan')
+        self.patch_object(barbican.BarbicanCharm, 'wait_for_api',
+                          return_value=True)
+        c = barbican.BarbicanCharm()
+        c.upgrade_if_available('interfaces')
+        self.super_upgrade.assert_not_called()
+        self.assertTrue(self.store[restarts.PENDING_RESTART_KEY]['upgrade'])
+        nonce = self.store[restarts.PENDING_RESTART_KEY]['nonce']
+        self.leader_settings[restarts.RESTART_SLOTS_KEY] = (
+            '{{"barbican/0": "{}"}}'.format(nonce))
+        c.upgrade_if_available('interfaces')
+        self.super_upgrade.assert_called_once_with('interfaces')
+        self.assertNotIn(restarts.PENDING_RESTART_KEY, self.store)
+
+    def test_upgrade_if_available_not_deferred(self):
+        self.patch_object(barbican.BarbicanCharm,
+                          'openstack_upgrade_available', create=True,
+                          return_value=False)
+        self.patch_object(barbican.charms_openstack.charm.HAOpenStackCharm,
+                          'upgrade_if_available', name='super_upgrade')
+        self.patch_object(barbican.BarbicanCharm, 'run_pending_restart')
+        c = barbican.BarbicanCharm()
+        # no upgrade available
+        c.upgrade_if_available('interfaces')
+        self.super_upgrade.assert_called_once_with('interfaces')
+        self.assertNotIn(restarts.PENDING_RESTART_KEY, self.store)
+        # the upgrade is left to the openstack-upgrade action
+        self.openstack_upgrade_available.return_value = True
+        self.cfg['action-managed-upgrade'] = True
+        self.store[restarts.PENDING_RESTART_KEY] = {
+            'nonce': 'n0', 'actions': [], 'services': [], 'files': [],
+            'upgrade': True}
+        c.upgrade_if_available('interfaces')
+        self.assertEqual(self.super_upgrade.call_count, 2)
+        # and an upgrade deferred before is dropped
+        self.assertFalse(self.store[restarts.PENDING_RESTART_KEY]['upgrade'])
+        self.run_pending_restart.assert_called_once_with()
+
+    def test_run_pending_restart_worker_only(self):
+        self.patch_object(barbican.BarbicanCharm, 'run_restart_plan')
+        self.patch_object(barbican.BarbicanCharm, 'wait_for_api',
+                          return_value=True)
+        self.patch_object(restarts, 'drain_api')
+        self.patch_object(restarts, 'undrain_api')
+        self.leader_settings[restarts.RESTART_SLOTS_KEY] = (
+            '{"barbican/0": "n0"}')
+        self.store[restarts.PENDING_RESTART_KEY] = {
+            'nonce': 'n0', 'actions': [restarts.RESTART_WORKER],
+            'services': [], 'files': ['f'], 'upgrade': False,
+            'restarted': False}
+        c = barbican.BarbicanCharm()
+        self.assertTrue(c.run_pending_restart())
+        self.run_restart_plan.assert_called_once_with(
+            [restarts.RESTART_WORKER], [], ['f'])
+        # the API isn't restarted so it isn't drained
+        self.drain_api.assert_not_called()
+
+    def test_api_probe_url(self):
+        self.patch_object(barbican.ch_cluster, 'determine_apache_port',
+                          return_value=9301)
+        self.patch_object(barbican.BarbicanCharm, 'api_port', create=True,
+                          return_value=9311)
+        self.patch_object(barbican.reactive, 'is_flag_set',
+                          return_value=False)
+        c = barbican.BarbicanCharm()
+        self.assertEqual(c.api_url(), 'http://127.0.0.1:9301/')
+        self.assertEqual(c.api_probe_url(),
+                         'http://127.0.0.1:9301/healthcheck')
+        self.assertIsNone(c.api_ssl_context())
+        # apache terminates TLS in front of the API
+        self.is_flag_set.return_value = True
+        self.assertEqual(c.api_url(), 'https://127.0.0.1:9301/')
+        self.assertEqual(c.api_probe_url(),
+                         'https://127.0.0.1:9301/healthcheck')
+        self.is_flag_set.assert_called_with(barbican.SSL_ENABLED_FLAG)
+        context = c.api_ssl_context()
+        self.assertFalse(context.check_hostname)
+        self.assertEqual(context.verify_mode, barbican.ssl.CERT_NONE)
+
+    def test_wait_for_api(self):
+        self.patch_object(barbican.BarbicanCharm, 'api_probe_url',
+                          return_value='https://127.0.0.1:9301/healthcheck')
+        self.patch_object(barbican.BarbicanCharm, 'api_ssl_context',
+                          return_value='ctx')
+        response = mock.MagicMock()
+        response.__enter__.return_value.status = 200
+        self.patch_object(barbican.urllib.request, 'urlopen',
+                          return_value=response)
+        self.patch_object(barbican.time, 'sleep')
+        c = barbican.BarbicanCharm()
+        self.assertTrue(c.wait_for_api(timeout=1))
+        self.urlopen.assert_called_once_with(
+            'https://127.0.0.1:9301/healthcheck', timeout=5, context='ctx')
+        self.patch_object(barbican.time, 'time')
+        # anything but a 200 isn't healthy, e.g. a redirect to a login page
+        response.__enter__.return_value.status = 204
+        self.time.side_effect = [0, 0.5, 1]
+        self.assertFalse(c.wait_for_api(timeout=1))
+        self.assertEqual(self.sleep.call_count, 1)
+        # drained
+        self.urlopen.side_effect = barbican.urllib.error.HTTPError(
+            'url', 503, 'Service Unavailable', {}, None)
+        self.time.side_effect = [0, 1]
+        self.assertFalse(c.wait_for_api(timeout=1))
+        self.urlopen.side_effect = barbican.urllib.error.URLError('refused')
+        self.time.side_effect = [0, 0.5, 1]
+        self.assertFalse(c.wait_for_api(timeout=1))
+        self.assertEqual(self.sleep.call_count, 2)
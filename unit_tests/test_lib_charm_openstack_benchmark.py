@@ -0,0 +1,114 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import http.server
+import json
+import threading
+import unittest
+import uuid
+
+import charm.openstack.benchmark as benchmark
+
+
+class StubBarbicanHandler(http.server.BaseHTTPRequestHandler):
+    """Just enough of the secrets and containers API to benchmark against.
+    Refs are handed back with a public host, as the real API does."""
+
+    resources = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=None):
+        content = json.dumps(body).encode('utf-8') if body else b''
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        if self.headers.get('X-Auth-Token') != 'token':
+            return self._reply(401)
+        self.rfile.read(int(self.headers['Content-Length']))
+        kind = self.path.rsplit('/', 1)[-1]
+        path = '{}/{}'.format(self.path, uuid.uuid4())
+        with self.lock:
+            self.resources[path] = kind
+        self._reply(201, {'{}_ref'.format(kind[:-1]):
+                          'https://barbican.example.com:9311' + path})
+
+    def do_GET(self):
+        with self.lock:
+            found = self.path in self.resources
+        if found:
+            self._reply(200, {'status': 'ACTIVE'})
+        else:
+            self._reply(404)
+
+    def do_DELETE(self):
+        with self.lock:
+            found = self.resources.pop(self.path, None)
+        if found:
+            self._reply(204)
+        else:
+            self._reply(404)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), StubBarbicanHandler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.endpoint = 'http://127.0.0.1:{}/'.format(
+            self.server.server_address[1])
+
+    def test_percentile(self):
+        self.assertIsNone(benchmark.percentile([], 50))
+        samples = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(samples, 50), 50)
+        self.assertEqual(benchmark.percentile(samples, 99), 99)
+        self.assertEqual(benchmark.percentile([3, 1, 2], 95), 3)
+
+    def test_unknown_workload(self):
+        with self.assertRaises(ValueError):
+            benchmark.Benchmark(self.endpoint, 'token', 'orders')
+
+    def test_run(self):
+        for workload in benchmark.WORKLOADS:
+            bench = benchmark.Benchmark(self.endpoint, 'token', workload)
+            results = bench.run(20, concurrency=4)
+            self.assertEqual(results['errors'], 0)
+            self.assertEqual(results['requests'], 60)
+            self.assertEqual(results['workload'], workload)
+            self.assertGreater(results['throughput'], 0)
+            for operation in benchmark.OPERATIONS:
+                self.assertLessEqual(results['{}.p50'.format(operation)],
+                                     results['{}.p99'.format(operation)])
+        # everything created was deleted again
+        self.assertEqual(StubBarbicanHandler.resources, {})
+
+    def test_run_errors(self):
+        bench = benchmark.Benchmark(self.endpoint, 'bad-token')
+        results = bench.run(3, concurrency=2)
+        self.assertEqual(results['errors'], 3)
+        self.assertEqual(results['requests'], 0)
+        self.assertIsNone(results['create.p50'])
+        self.assertIn('401', results['first-error'])
@@ -0,0 +1,161 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+from unittest import mock
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.hsm_slots as hsm_slots
+
+
+class TestHSMSlots(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(hsm_slots.hookenv, 'relation_ids',
+                          return_value=[])
+
+    def _patch_config(self, config):
+        self.patch_object(hsm_slots.hookenv, 'config')
+        self.config.side_effect = lambda key=None: config.get(key)
+
+    def test_plugin_data(self):
+        data = {'library_path': 'a-path', 'login': 'a-login',
+                'slot_id': 'a-slot_id'}
+        hsm = mock.MagicMock()
+        hsm.plugin_data = data
+        self.assertEqual(hsm_slots.plugin_data(hsm), [data])
+        hsm.plugin_data = None
+        self.assertEqual(hsm_slots.plugin_data(hsm), [])
+        self.assertEqual(hsm_slots.primary(hsm), {})
+        slot1 = {'library_path': 'p', 'login': 'l', 'slot_id': '1'}
+        slot2 = {'library_path': 'p', 'login': 'l', 'slot_id': '2'}
+        slots = [slot2, slot1, dict(slot1)]
+        self.relation_ids.return_value = ['hsm:4']
+        self.patch_object(hsm_slots.hookenv, 'related_units',
+                          return_value=['hsm/0', 'hsm/1', 'hsm/2'])
+        self.patch_object(hsm_slots.hookenv, 'relation_get')
+        self.relation_get.side_effect = (
+            lambda key, rid, unit: json.dumps(
+                slots[int(unit.split('/')[1])]))
+        # one entry per slot, in slot order
+        self.assertEqual(hsm_slots.plugin_data(hsm), [slot1, slot2])
+        self.assertEqual(hsm_slots.primary(hsm), slot1)
+
+    def test_manage(self):
+        self.patch_object(hsm_slots.subprocess, 'run', return_value=(
+            subprocess.CompletedProcess([], 0, '', '')))
+        slot = {'library_path': 'path1', 'login': '1234', 'slot_id': 3}
+        result = hsm_slots.manage(slot, 'check_mkek', 10, label='mkek')
+        self.assertEqual(result.returncode, 0)
+        self.run.assert_called_once_with(
+            ['barbican-manage', 'hsm', 'check_mkek',
+             '--library-path', 'path1', '--slot-id', '3', '--label', 'mkek'],
+            env=mock.ANY, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, timeout=10)
+        self.assertEqual(
+            self.run.call_args[1]['env'][hsm_slots.HSM_LOGIN_ENV], '1234')
+        # a barbican-manage that wants --passphrase isn't given the login
+        # on its command line
+        self.run.reset_mock()
+        self.run.return_value = subprocess.CompletedProcess(
+            [], 2, '', 'the following arguments are required: --passphrase')
+        with self.assertRaises(ValueError):
+            hsm_slots.manage(slot, 'check_mkek', 10, label='mkek')
+        self.run.assert_called_once_with(
+            mock.ANY, env=mock.ANY, stdout=mock.ANY, stderr=mock.ANY,
+            universal_newlines=True, timeout=10)
+        self.assertNotIn('1234', self.run.call_args[0][0])
+
+    def test_generate_key(self):
+        slots = [{'library_path': 'path1', 'login': '1234', 'slot_id': n}
+                 for n in ('slot1', 'slot2')]
+        self.patch_object(hsm_slots, 'plugin_data', return_value=slots)
+        self.patch_object(hsm_slots, 'manage', return_value=(
+            subprocess.CompletedProcess([], 0, '', '')))
+        self.patch_object(hsm_slots.hookenv, 'log')
+        # the keys are only generated on the primary slot
+        hsm_slots.generate_key(None, 'gen_hmac', 32, 'hmac')
+        self.manage.assert_called_once_with(
+            slots[0], 'gen_hmac', length=32, label='hmac')
+        self.manage.return_value = subprocess.CompletedProcess(
+            [], 1, '', 'failed')
+        with self.assertRaises(Exception):
+            hsm_slots.generate_key(None, 'gen_hmac', 32, 'hmac')
+        self.plugin_data.return_value = []
+        self.manage.reset_mock()
+        with self.assertRaises(Exception):
+            hsm_slots.generate_key(None, 'gen_hmac', 32, 'hmac')
+        self.manage.assert_not_called()
+
+    def test_provision_keys(self):
+        self._patch_config({
+            'mkek-key-length': 32, 'label-mkek': 'mkek',
+            'hmac-key-length': 32, 'label-hmac': 'hmac',
+        })
+        slots = [{'library_path': 'path1', 'login': '1234', 'slot_id': n}
+                 for n in (1, 2)]
+        self.patch_object(hsm_slots, 'plugin_data', return_value=slots)
+        # the primary slot 1 has neither key, and its hmac can't be
+        # generated; the mkek has been replicated to slot 2 before
+        present = {(2, 'mkek')}
+        calls = []
+
+        def manage(slot, command, timeout, **options):
+            key = command.split('_')[1]
+            calls.append((slot['slot_id'], command))
+            if command.startswith('gen_'):
+                if key == 'hmac':
+                    return subprocess.CompletedProcess(
+                        [], 1, '', 'trace\nCKR_DEVICE_ERROR\n')
+                return subprocess.CompletedProcess([], 0, '', '')
+            return subprocess.CompletedProcess(
+                [], 0 if (slot['slot_id'], key) in present else 1, '', '')
+
+        self.patch_object(hsm_slots, 'manage', side_effect=manage)
+        results = hsm_slots.provision_keys(None)
+        self.assertEqual(
+            [(r['slot'], r['primary'], r['key'], r['result'])
+             for r in results],
+            [('1', True, 'mkek', 'created'), ('1', True, 'hmac', 'failed'),
+             ('2', False, 'mkek', 'present'),
+             ('2', False, 'hmac', 'missing')])
+        self.assertEqual(results[1]['error'], 'CKR_DEVICE_ERROR')
+        self.assertEqual(results[0]['label'], 'mkek')
+        self.assertEqual(results[0]['length'], 32)
+        # keys are only generated on the primary, and not checked again
+        self.assertEqual(sorted(calls), [
+            (1, 'check_hmac'), (1, 'check_mkek'),
+            (1, 'gen_hmac'), (1, 'gen_mkek'),
+            (2, 'check_hmac'), (2, 'check_mkek')])
+        # verify-only doesn't generate anything
+        del calls[:]
+        results = hsm_slots.provision_keys(None, verify_only=True)
+        self.assertEqual([r['result'] for r in results],
+                         ['missing', 'missing', 'present', 'missing'])
+        self.assertFalse([c for c in calls if c[1].startswith('gen_')])
+        # a barbican-manage that needs --passphrase fails the keys
+        self.manage.side_effect = ValueError('needs --passphrase')
+        results = hsm_slots.provision_keys(None)
+        self.assertEqual({r['result'] for r in results}, {'failed'})
+        self.assertEqual(results[0]['error'], 'needs --passphrase')
+        # a slow HSM is reported as timing out
+        self.manage.side_effect = subprocess.TimeoutExpired('check_mkek', 1)
+        results = hsm_slots.provision_keys(None, timeout=1)
+        self.assertEqual({r['result'] for r in results}, {'timeout'})
+        # no HSM, nothing to do
+        self.plugin_data.return_value = []
+        self.assertEqual(hsm_slots.provision_keys(None), [])
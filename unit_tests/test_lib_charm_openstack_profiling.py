@@ -0,0 +1,87 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import mock
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.profiling as profiling
+
+
+class TestProfiling(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.unit_kv = mock.MagicMock()
+        self.patch_object(profiling.unitdata, 'kv', return_value=self.unit_kv)
+
+    def test_is_active(self):
+        self.unit_kv.get.return_value = None
+        self.patch_object(profiling.time, 'time', return_value=100)
+        self.assertFalse(profiling.is_active())
+        self.unit_kv.get.return_value = 90
+        self.assertFalse(profiling.is_active())
+        self.unit_kv.get.return_value = 110
+        self.assertTrue(profiling.is_active())
+
+    def test_open_window(self):
+        self.patch_object(profiling.time, 'time', return_value=100)
+        self.patch_object(profiling.subprocess, 'call', return_value=0)
+        self.patch_object(profiling.ch_host, 'mkdir')
+        self.patch_object(profiling.os.path, 'exists', return_value=True)
+        self.patch_object(profiling.os, 'remove')
+        with self.assertRaises(ValueError):
+            profiling.open_window(7200, '/usr/bin/python3')
+        self.assertEqual(profiling.open_window(600, '/usr/bin/python3'), 700)
+        self.mkdir.assert_called_once_with(
+            profiling.PROFILE_DIR, owner='barbican', group='barbican',
+            perms=0o750)
+        self.remove.assert_has_calls([
+            mock.call(profiling.PROFILE_LOG),
+            mock.call(profiling.PROFILE_CACHEGRIND)])
+        self.unit_kv.set.assert_called_once_with(profiling.PROFILING_KEY, 700)
+        # repoze.profile is looked for with the python barbican runs with
+        self.call.assert_called_with(
+            ['/usr/bin/python3', '-c', 'import repoze.profile'])
+        # the pipeline can't be used without repoze.profile
+        self.call.return_value = 1
+        with self.assertRaises(ValueError):
+            profiling.open_window(600, '/usr/bin/python3')
+
+    def test_collect(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        log = os.path.join(tmpdir, 'barbican-api.profile')
+        self.patch_object(profiling, 'PROFILE_DIR', new=tmpdir)
+        self.patch_object(profiling, 'PROFILE_LOG', new=log)
+        self.patch_object(profiling, 'PROFILE_CACHEGRIND',
+                          new=os.path.join(tmpdir, 'cachegrind.out'))
+        profiling.close_window()
+        self.unit_kv.unset.assert_called_once_with(profiling.PROFILING_KEY)
+        with self.assertRaises(ValueError):
+            profiling.collect()
+        profiler = cProfile.Profile()
+        profiler.runcall(sorted, range(10))
+        profiler.dump_stats(log)
+        archive, summary = profiling.collect(5)
+        self.assertTrue(archive.startswith(tmpdir))
+        with tarfile.open(archive) as tar:
+            self.assertEqual(tar.getnames(), ['barbican-api.profile'])
+        self.assertIn('cumulative', summary)
+        self.assertIn('sorted', summary)
@@ -0,0 +1,70 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.reports as reports
+
+
+class TestReports(test_utils.PatchHelper):
+
+    def test_rate_limit_stats(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch_object(reports, 'RATELIMIT_STATS_DIR', new=tmpdir)
+        self.patch_object(reports.psutil, 'pid_exists')
+        self.pid_exists.side_effect = lambda pid: pid != 3
+        for pid in (1, 2, 3):
+            with open(os.path.join(tmpdir, '{}.json'.format(pid)), 'w') as f:
+                json.dump({
+                    'pid': pid,
+                    'totals': {'allowed': 10, 'rejected-rate': pid},
+                    'projects': {'p{}'.format(pid % 2): {'allowed': 10}},
+                    'in-flight': 1,
+                }, f)
+        with open(os.path.join(tmpdir, 'broken.json'), 'w') as f:
+            f.write('{')
+        self.assertEqual(reports.rate_limit_stats(), {
+            'totals': {'allowed': 20, 'rejected-rate': 3},
+            'in-flight': 2,
+            'projects': {'p0': {'allowed': 10}, 'p1': {'allowed': 10}},
+        })
+        # the stats of processes that have gone are removed
+        self.assertFalse(os.path.exists(os.path.join(tmpdir, '3.json')))
+
+    def test_hook_stats(self):
+        records = [
+            {'hook': 'config-changed', 'time': 1, 'total': 10.0,
+             'phases': {'render_stuff': 8.0}},
+            {'hook': 'update-status', 'time': 2, 'total': 1.0,
+             'phases': {'assess_status': 0.5}},
+            {'hook': 'config-changed', 'time': 3, 'total': 20.0,
+             'phases': {'render_stuff': 16.0}},
+        ]
+        kv = mock.MagicMock()
+        kv.get.return_value = records
+        self.patch_object(reports.unitdata, 'kv', return_value=kv)
+        stats = reports.hook_stats(top=2)
+        self.assertEqual(stats['hooks'], 3)
+        self.assertEqual(stats['summary']['hook:config-changed'], {
+            'count': 2, 'p50': 10.0, 'p95': 20.0, 'max': 20.0})
+        self.assertEqual(stats['summary']['render_stuff']['max'], 16.0)
+        self.assertEqual(stats['summary']['assess_status']['count'], 1)
+        self.assertEqual([r['time'] for r in stats['slowest']], [3, 1])
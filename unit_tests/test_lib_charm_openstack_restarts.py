@@ -0,0 +1,122 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.restarts as restarts
+
+
+class TestRestarts(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.store = {}
+        self.unit_kv = mock.MagicMock()
+        self.unit_kv.get.side_effect = self.store.get
+        self.unit_kv.set.side_effect = self.store.__setitem__
+        self.patch_object(restarts.unitdata, 'kv', return_value=self.unit_kv)
+        self.cfg = {'rolling-restart-max-units': 1}
+        self.patch_object(restarts.hookenv, 'config')
+        self.config.side_effect = lambda key=None: self.cfg.get(key)
+        self.patch_object(restarts.hookenv, 'relation_ids',
+                          return_value=['cluster:1'])
+        self.patch_object(restarts.hookenv, 'related_units',
+                          return_value=['barbican/1', 'barbican/2'])
+        self.patch_object(restarts.hookenv, 'local_unit',
+                          return_value='barbican/0')
+        self.patch_object(restarts.hookenv, 'relation_set')
+        self.relation_data = {}
+        self.patch_object(restarts.hookenv, 'relation_get')
+        self.relation_get.side_effect = (
+            lambda rid, unit: self.relation_data.get(unit, {}))
+        self.leader_settings = {}
+        self.patch_object(restarts.hookenv, 'leader_get')
+        self.leader_get.side_effect = self.leader_settings.get
+        self.patch_object(restarts.hookenv, 'leader_set')
+        self.leader_set.side_effect = self.leader_settings.update
+
+    def test_config_sections(self):
+        self.assertEqual(
+            restarts.config_sections(
+                'a = 1\n[DEFAULT]\n# comment\nb = 2\n\n[cors]\nc = 3\n'),
+            {'': ['a = 1'], 'DEFAULT': ['b = 2'], 'cors': ['c = 3']})
+        self.assertEqual(restarts.config_sections(None), {})
+
+    def test_rolling_restarts_enabled(self):
+        self.assertTrue(restarts.rolling_restarts_enabled())
+        self.related_units.return_value = []
+        self.assertFalse(restarts.rolling_restarts_enabled())
+        self.related_units.return_value = ['barbican/1']
+        self.cfg['rolling-restart-max-units'] = 0
+        self.assertFalse(restarts.rolling_restarts_enabled())
+
+    def test_defer(self):
+        self.patch_object(restarts.time, 'time', return_value=1)
+        restarts.defer([restarts.RELOAD_API], [], ['a-file'])
+        self.assertEqual(self.store[restarts.PENDING_RESTART_KEY], {
+            'nonce': '1.000000',
+            'actions': [restarts.RELOAD_API],
+            'services': [],
+            'files': ['a-file'],
+            'upgrade': False,
+            'restarted': False,
+        })
+        self.relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={restarts.RESTART_REQUEST_KEY: '1.000000'})
+        # a further change is merged into the pending restart
+        restarts.defer([restarts.RESTART_WORKER], ['haproxy'], ['f'])
+        pending = self.store[restarts.PENDING_RESTART_KEY]
+        self.assertEqual(pending['nonce'], '1.000000')
+        self.assertEqual(pending['actions'],
+                         [restarts.RELOAD_API, restarts.RESTART_WORKER])
+        self.assertEqual(pending['services'], ['haproxy'])
+        self.assertEqual(pending['files'], ['a-file', 'f'])
+
+    def test_grant_slots(self):
+        self.relation_data.update({
+            'barbican/0': {restarts.RESTART_REQUEST_KEY: 'n0'},
+            'barbican/1': {restarts.RESTART_REQUEST_KEY: 'n1'},
+            'barbican/2': {restarts.RESTART_REQUEST_KEY: 'n2'},
+        })
+        self.assertEqual(restarts.grant_slots(), {'barbican/0': 'n0'})
+        self.assertFalse(restarts.slot_granted())
+        self.store[restarts.PENDING_RESTART_KEY] = {'nonce': 'n0'}
+        self.assertTrue(restarts.slot_granted())
+        # no more than max units at a time
+        self.assertEqual(restarts.grant_slots(), {'barbican/0': 'n0'})
+        self.assertEqual(self.leader_set.call_count, 1)
+        # once done the slot goes to the next unit
+        self.relation_data['barbican/0'][restarts.RESTART_DONE_KEY] = 'n0'
+        self.assertEqual(restarts.grant_slots(), {'barbican/1': 'n1'})
+        self.assertFalse(restarts.slot_granted())
+        self.cfg['rolling-restart-max-units'] = 2
+        self.assertEqual(restarts.grant_slots(),
+                         {'barbican/1': 'n1', 'barbican/2': 'n2'})
+
+    def test_drain_api(self):
+        self.patch_object(restarts.time, 'sleep')
+        self.patch_object(restarts.os.path, 'exists', return_value=True)
+        self.patch_object(restarts.os, 'remove')
+        self.cfg['haproxy-drain-time'] = 10
+        with mock.patch('builtins.open', mock.mock_open()) as mock_file:
+            restarts.drain_api()
+        mock_file.assert_called_once_with(
+            restarts.HEALTHCHECK_DISABLE_FILE, 'w')
+        self.sleep.assert_called_once_with(10)
+        restarts.undrain_api()
+        self.remove.assert_called_once_with(
+            restarts.HEALTHCHECK_DISABLE_FILE)
@@ -0,0 +1,243 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import configparser
+import os
+import types
+
+import jinja2
+
+import charms_openstack.test_utils as test_utils
+
+import charm.openstack.barbican as barbican
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src', 'templates', 'rocky')
+
+
+class TestApiTemplates(test_utils.PatchHelper):
+    """Render the API's paste and apache configuration as the charm does."""
+
+    def setUp(self):
+        super().setUp()
+        self.env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATES),
+            undefined=jinja2.StrictUndefined)
+        self.model = {
+            'processes': 2,
+            'threads': 4,
+            'admin_mode': 'separate',
+            'admin_processes': 1,
+            'listen_backlog': None,
+            'queue_timeout': None,
+            'request_timeout': None,
+            'maximum_requests': None,
+        }
+
+    def _options(self, config):
+        self.patch_object(barbican.hookenv, 'config')
+        self.config.side_effect = lambda key=None: config.get(key)
+        return types.SimpleNamespace(
+            wsgi_daemon=self.model,
+            rate_limit_filter=barbican.BarbicanCharm.rate_limit_settings(
+                self.model),
+            profiling={'enabled': False, 'log_filename': '/p/log',
+                       'cachegrind_filename': '/p/cachegrind'},
+            service_listen_info={
+                'barbican_worker': {'public_port': 9301, 'admin_port': 9302}},
+        )
+
+    def _render(self, template, options):
+        return self.env.get_template(template).render(options=options)
+
+    def test_rate_limit_enabled(self):
+        options = self._options({
+            'rate-limit': True,
+            'rate-limit-project-rate': 10,
+            'rate-limit-project-burst': 20,
+        })
+        paste = configparser.ConfigParser(interpolation=None)
+        paste.read_string(self._render('barbican-api-paste.ini', options))
+        self.assertIn(' ratelimit ', paste['pipeline:barbican-api-keystone'][
+            'pipeline'])
+        ratelimit = paste['filter:ratelimit']
+        self.assertEqual(ratelimit['paste.filter_factory'],
+                         'barbican_charm_ratelimit:filter_factory')
+        # shared between the 2 public and the admin process
+        self.assertEqual(ratelimit['project_rate'], '3.333')
+        self.assertEqual(ratelimit['project_burst'], '7')
+        wsgi = self._render('barbican-api.conf', options)
+        self.assertIn('python-path={}'.format(barbican.RATELIMIT_PYTHON_PATH),
+                      wsgi)
+
+    def test_rate_limit_disabled(self):
+        options = self._options({'rate-limit': False})
+        paste = configparser.ConfigParser(interpolation=None)
+        paste.read_string(self._render('barbican-api-paste.ini', options))
+        self.assertNotIn('ratelimit', paste['pipeline:barbican-api-keystone'][
+            'pipeline'])
+        self.assertFalse(paste.has_section('filter:ratelimit'))
+        self.assertNotIn('python-path',
+                         self._render('barbican-api.conf', options))
+
+
+class TestHaproxyTemplate(test_utils.PatchHelper):
+    """Render the haproxy.cfg override as the charm does."""
+
+    def setUp(self):
+        super().setUp()
+        self.env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATES),
+            undefined=jinja2.StrictUndefined)
+        self.model = {'processes': 2, 'threads': 4, 'admin_mode': 'dedicated',
+                      'admin_processes': 1}
+        self.patch_object(barbican.hookenv, 'config')
+        self.config.side_effect = lambda key=None: {
+            'haproxy-balance': 'leastconn'}.get(key)
+        self.cluster = types.SimpleNamespace(cluster_hosts={
+            '10.0.0.10': {
+                'network': '10.0.0.10/255.255.255.0',
+                'backends': {'barbican-0': '10.0.0.10',
+                             'barbican-1': '10.0.0.11'},
+            },
+        })
+
+    def _render(self, tls_ports=()):
+        backend = barbican.BarbicanCharm.haproxy_backend_settings(self.model)
+        backend['tls_ports'] = list(tls_ports)
+        options = types.SimpleNamespace(
+            haproxy_queue_timeout=None,
+            haproxy_connect_timeout=None,
+            haproxy_client_timeout=None,
+            haproxy_server_timeout=None,
+            haproxy_stat_port=8888,
+            haproxy_stat_password='secret',
+            ipv6_enabled=False,
+            local_address='10.0.0.10',
+            service_ports={
+                'barbican-worker_admin': [9312, 9302],
+                'barbican-worker_public': [9311, 9301],
+            },
+            haproxy_backend=backend,
+        )
+        return self.env.get_template('haproxy.cfg').render(
+            options=options, cluster=self.cluster)
+
+    def _section(self, cfg, name):
+        lines = cfg.split('\n{}\n'.format(name))[1].split('\n\n')[0]
+        return [line.strip() for line in lines.splitlines()]
+
+    def test_frontends_and_backends(self):
+        cfg = self._render()
+        # haproxy binds the API ports and forwards to apache's, so the
+        # two never listen on the same port
+        public = self._section(cfg, 'frontend tcp-in_barbican-worker_public')
+        self.assertIn('bind *:9311', public)
+        self.assertIn('default_backend barbican-worker_public_10.0.0.10',
+                      public)
+        admin = self._section(cfg, 'frontend tcp-in_barbican-worker_admin')
+        self.assertIn('bind *:9312', admin)
+        public = self._section(cfg, 'backend barbican-worker_public_10.0.0.10')
+        self.assertIn('server barbican-1 10.0.0.11:9301 check', public)
+        self.assertIn('default-server inter 2s fall 3 rise 2 maxconn 8',
+                      public)
+        admin = self._section(cfg, 'backend barbican-worker_admin_10.0.0.10')
+        self.assertIn('server barbican-1 10.0.0.11:9302 check', admin)
+        self.assertIn('default-server inter 2s fall 3 rise 2 maxconn 4',
+                      admin)
+        self.assertNotIn('check-ssl', cfg)
+
+    def test_tls_backends(self):
+        cfg = self._render(tls_ports=[9301, 9302])
+        for service in ('public', 'admin'):
+            backend = self._section(
+                cfg, 'backend barbican-worker_{}_10.0.0.10'.format(service))
+            self.assertIn('default-server inter 2s fall 3 rise 2 maxconn {} '
+                          'check-ssl verify none'.format(
+                              8 if service == 'public' else 4), backend)
+
+
+class TestBarbicanConfTemplate(test_utils.PatchHelper):
+    """Render the secret stores in barbican.conf as the charm does."""
+
+    KEK = 'MDEyMzQ1Njc4OWFiY2RlZjAxMjM0NTY3ODlhYmNkZWY='
+
+    def setUp(self):
+        super().setUp()
+        # the parts come from charms.openstack and don't matter here
+        parts = jinja2.DictLoader({
+            'parts/section-transport-url': '',
+            'parts/section-database': '',
+            'parts/section-keystone-authtoken': '',
+            'parts/section-oslo-messaging-rabbit': '',
+            'parts/section-oslo-middleware': '',
+        })
+        self.env = jinja2.Environment(
+            loader=jinja2.ChoiceLoader([
+                jinja2.FileSystemLoader(TEMPLATES), parts]),
+            undefined=jinja2.StrictUndefined)
+        self.hsm = types.SimpleNamespace(
+            library_path='/usr/lib/libCryptoki2.so', login='pw', slot_id=1,
+            token_labels='')
+
+    def _render(self, kek=None, hsm=None, default_store=None):
+        options = types.SimpleNamespace(
+            debug=False,
+            service_listen_info={
+                'barbican_worker': {'ip': '10.0.0.10', 'port': 9301}},
+            use_internal_endpoints=False,
+            os_public_hostname='barbican.example.com',
+            port_map={'barbican-worker': {'public': 9311}},
+            ssl=False,
+            max_allowed_secret_size=20000,
+            max_allowed_request_size=25000,
+            messaging={'DEFAULT': {}, 'oslo_messaging_rabbit': {}},
+            database_pool={},
+            database_replica_connection=None,
+            memcache={},
+            async_order_processing=False,
+            worker_processes=1,
+            enable_retry_scheduler=False,
+            enable_multiple_secret_stores=True,
+            default_secret_store=default_store,
+            software_store_kek=kek,
+            label_mkek='primarymkek',
+            mkek_key_length=32,
+            label_hmac='primaryhmac',
+            pkek_cache={'rw_session': True, 'length': 32, 'ttl': 900,
+                        'limit': 100},
+        )
+        conf = configparser.ConfigParser(interpolation=None)
+        conf.read_string(self.env.get_template('barbican.conf').render(
+            options=options, hsm=hsm, secrets=None, shared_db_replica=None))
+        return conf
+
+    def test_software_store_waits_for_kek(self):
+        conf = self._render(hsm=self.hsm)
+        self.assertFalse(conf.has_section('secretstore:software'))
+        self.assertNotIn('enable_multiple_secret_stores', conf['secretstore'])
+        self.assertEqual(conf['crypto']['enabled_crypto_plugins'],
+                         'p11_crypto')
+
+    def test_software_store_with_kek(self):
+        conf = self._render(kek=self.KEK, hsm=self.hsm, default_store='hsm')
+        self.assertEqual(conf['secretstore']['stores_lookup_suffix'],
+                         'software, hsm')
+        self.assertEqual(conf['secretstore:software']['global_default'],
+                         'False')
+        self.assertEqual(conf['secretstore:hsm']['global_default'], 'True')
+        self.assertEqual(conf['crypto']['enabled_crypto_plugins'],
+                         'simple_crypto, p11_crypto')
+        self.assertEqual(conf['simple_crypto_plugin']['kek'],
+                         "'{}'".format(self.KEK))